@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Compares the cost of building a cache key for geometry arguments with ucache's default key function (pickle every
+# coordinate, then hash) against src/geometry_keys.py (hash each geometry's WKB once, then reuse the fingerprint).
+#
+# Run from the repository root with: python -m benchmarks.cache_keys
+import timeit
+
+import numpy as np
+import shapely
+from shapely.geometry import Point
+from ucache import _key_fn
+
+from src import geometry_keys
+
+
+def get_isochrone_like_multipolygon(fragments_count, resolution, seed=0):
+    # Lots of small, fairly detailed fragments scattered across a city, roughly like a public transport isochrone
+    random = np.random.default_rng(seed)
+    centres = random.uniform([-0.5, 51.3], [0.3, 51.7], size=(fragments_count, 2))
+    radiuses = random.uniform(0.001, 0.01, size=fragments_count)
+
+    return shapely.MultiPolygon([
+        Point(centre).buffer(radius, resolution) for centre, radius in zip(centres, radiuses)
+    ])
+
+
+def time_per_call_ms(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1000
+
+
+def benchmark_key_construction(label, args, number=20):
+    kwargs = {}
+
+    before_ms = time_per_call_ms(lambda: _key_fn(args, kwargs), number)
+
+    # A cold fingerprint is paid once per geometry object, i.e. the first time it's passed to a cached function.
+    # Decode fresh copies from WKB up front so each timed call sees geometries it hasn't fingerprinted before.
+    args_wkb = shapely.to_wkb(args[0])
+    fresh_args = [(shapely.from_wkb(args_wkb),) + args[1:] for _ in range(number * 5)]
+    fresh_args_iter = iter(fresh_args)
+    cold_ms = time_per_call_ms(lambda: geometry_keys.geometry_key_fn(next(fresh_args_iter), kwargs), number)
+
+    warm_ms = time_per_call_ms(lambda: geometry_keys.geometry_key_fn(args, kwargs), number)
+
+    # For context: one of the GEOS operations these keys are built for
+    operation_ms = time_per_call_ms(lambda: shapely.union_all(shapely.get_parts(args[0])), 3)
+
+    print("%-44s %10.3f %10.3f %10.3f %12.3f" % (label, before_ms, cold_ms, warm_ms, operation_ms))
+
+
+if __name__ == '__main__':
+    print("Cache key construction time per call, in ms\n")
+    print("%-44s %10s %10s %10s %12s" % ('Argument', 'pickle', 'wkb cold', 'wkb warm', 'union (GEOS)'))
+
+    for fragments_count, resolution in [(10, 8), (200, 16), (2000, 16), (5000, 32)]:
+        multi_polygon = get_isochrone_like_multipolygon(fragments_count, resolution)
+        vertices_count = len(shapely.get_coordinates(multi_polygon))
+
+        benchmark_key_construction(
+            "MultiPolygon, %d parts, %d vertices" % (fragments_count, vertices_count), (multi_polygon, 0.0000001))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Compares union and intersection over a 60 minute driving isochrone around London, computed in a single process with
+# Shapely, against src/tiled_geometry.py with increasing numbers of worker processes.
+#
+# Run from the repository root with: python -m benchmarks.tiled_geometry [isochrone.geojson]
+#
+# Pass a GeoJSON file of real isochrone shapes (e.g. saved from the TravelTime API) to benchmark with those; otherwise
+# a synthetic isochrone of similar extent and complexity is generated, so no API key is needed.
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from src import tiled_geometry
+
+london_lng_lat = (-0.1276, 51.5072)
+
+
+def get_synthetic_driving_isochrone_shapes(shapes_count=1500, seed=0):
+    # A 60 minute drive from central London reaches 30-50 miles out along the motorways, with a ragged edge and lots of
+    # reachable pockets, so: lots of overlapping irregular blobs, spreading out in fingers from the centre
+    random = np.random.default_rng(seed)
+    angles = random.uniform(0, 2 * np.pi, shapes_count)
+    distances = random.power(0.6, shapes_count) * 0.7
+    centres = np.column_stack([
+        london_lng_lat[0] + np.cos(angles) * distances,
+        london_lng_lat[1] + np.sin(angles) * distances * 0.62
+    ])
+
+    shapes = []
+    for centre in centres:
+        vertices_count = random.integers(80, 400)
+        vertex_angles = np.sort(random.uniform(0, 2 * np.pi, vertices_count))
+        vertex_radiuses = random.uniform(0.3, 1.0, vertices_count) * random.uniform(0.01, 0.06)
+        shapes.append(shapely.Polygon(np.column_stack([
+            centre[0] + np.cos(vertex_angles) * vertex_radiuses,
+            centre[1] + np.sin(vertex_angles) * vertex_radiuses * 0.62
+        ])).buffer(0))
+
+    return np.array(shapes, dtype=object)
+
+
+def get_synthetic_rank_layer(bounds, cell_size=0.004, seed=1):
+    # Roughly LSOA sized cells, about half of which pass a rank filter, dissolved like a compiled rank layer
+    random = np.random.default_rng(seed)
+    min_x, min_y, max_x, max_y = bounds
+    cells_x, cells_y = np.meshgrid(np.arange(min_x, max_x, cell_size), np.arange(min_y, max_y, cell_size))
+    passing = random.uniform(size=cells_x.shape) > 0.5
+
+    return shapely.union_all(shapely.box(
+        cells_x[passing], cells_y[passing], cells_x[passing] + cell_size, cells_y[passing] + cell_size
+    ))
+
+
+def load_isochrone_shapes(geojson_path):
+    with open(geojson_path) as geojson_file:
+        geojson = json.load(geojson_file)
+
+    features = geojson['features'] if 'features' in geojson else [geojson]
+    return shapely.get_parts(np.array([shape(feature.get('geometry', feature)) for feature in features]))
+
+
+def time_ms(method):
+    ts = time.time()
+    result = method()
+    return (time.time() - ts) * 1000, result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        isochrone_shapes = load_isochrone_shapes(sys.argv[1])
+    else:
+        isochrone_shapes = get_synthetic_driving_isochrone_shapes()
+
+    print("Isochrone: %d shapes, %d vertices" % (
+        len(isochrone_shapes), shapely.get_num_coordinates(isochrone_shapes).sum()))
+
+    single_union_ms, isochrone = time_ms(lambda: shapely.union_all(isochrone_shapes))
+    rank_layer = get_synthetic_rank_layer(isochrone.bounds)
+    single_intersection_ms, intersection = time_ms(lambda: shapely.intersection(isochrone, rank_layer))
+
+    print("Rank layer: %d parts, %d vertices\n" % (
+        len(shapely.get_parts(rank_layer)), shapely.get_num_coordinates(rank_layer)))
+    print("%-22s %12s %9s %12s %9s" % ('', 'union (ms)', 'speed up', 'intersect', 'speed up'))
+    print("%-22s %12.0f %9s %12.0f %9s" % ('shapely, 1 process', single_union_ms, '', single_intersection_ms, ''))
+
+    for processes in [1, 2, 4, 8, 16]:
+        if processes > os.cpu_count() and processes > 2:
+            break
+
+        # Start the pool before timing, as a server would have it running already
+        tiled_geometry.get_geometry_process_pool(processes).submit(int).result()
+
+        tiled_union_ms, tiled_isochrone = time_ms(lambda: tiled_geometry.tiled_union(isochrone_shapes, processes))
+        tiled_intersection_ms, tiled_intersection = time_ms(
+            lambda: tiled_geometry.tiled_intersection(isochrone, rank_layer, processes))
+
+        # Tiling must give the same answer, no seams or slivers
+        assert abs(tiled_isochrone.area - isochrone.area) < isochrone.area * 1e-9
+        assert abs(tiled_intersection.area - intersection.area) < intersection.area * 1e-9
+
+        print("%-22s %12.0f %8.1fx %12.0f %8.1fx" % (
+            'tiled, %d process%s' % (processes, '' if processes == 1 else 'es'),
+            tiled_union_ms, single_union_ms / tiled_union_ms,
+            tiled_intersection_ms, single_intersection_ms / tiled_intersection_ms
+        ))
+
+    print("\nCPU cores available: %d" % os.cpu_count())
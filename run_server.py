@@ -2,16 +2,17 @@
 import json
 import logging
 import os
+import threading
 
 import requests_cache
 # This import of shapely is to workaround a GEOS bug: https://github.com/Toblerity/Shapely/issues/553
 # noinspection PyUnresolvedReferences
 import shapely.geometry
-import ucache
 from flask import Flask, render_template, Response, request
 from flask_sslify import SSLify
 
-from src import utils
+from src import utils, imd_dataset, eurostat_dataset, rate_limiter
+from src.tiered_cache import TieredSqliteCache
 from src.utils import preload_files
 
 app = Flask(__name__)
@@ -36,17 +37,35 @@ requests_cache = requests_cache.core.CachedSession(
     cache_name='caches/requests_cache', backend="sqlite", allowable_methods=('GET', 'POST'))
 
 # Set up disk caching for API calls which are made through a 3rd party library rather than the requests library
-api_cache = ucache.SqliteCache(
-    filename='caches/api_cache.sqlite', cache_size=5000, timeout=32000000, compression=True)
+api_cache = TieredSqliteCache(
+    filename='caches/api_cache.sqlite', cache_size=5000, timeout=32000000, compression=True,
+    memory_size_bytes=16 * 1024 * 1024)
 
 # Set up disk caching for complex computations which should not need to change -
-static_cache = ucache.SqliteCache(
-    filename='caches/static_cache.sqlite', cache_size=5000, timeout=32000000, compression=True)
+static_cache = TieredSqliteCache(
+    filename='caches/static_cache.sqlite', cache_size=5000, timeout=32000000, compression=True,
+    memory_size_bytes=64 * 1024 * 1024)
 
 # Set up disk caching for complex computations, with max size 5GB, compression and 1 year expiry;
-# this cache is transient and will be wiped whenever the Heroku dyno is redeployed
-transient_cache = ucache.SqliteCache(
-    filename='caches/transient_cache.sqlite', cache_size=5000, timeout=32000000, compression=True)
+# this cache is transient and will be wiped whenever the Heroku dyno is redeployed.
+# Each of these caches also keeps its most recently used values in memory, so repeated searches skip SQLite entirely;
+# HOMEAREA_MEMORY_CACHE_MB sets the memory budget for this one, as it holds the large computed geometries.
+transient_cache = TieredSqliteCache(
+    filename='caches/transient_cache.sqlite', cache_size=5000, timeout=32000000, compression=True,
+    memory_size_bytes=int(os.environ.get('HOMEAREA_MEMORY_CACHE_MB', 256)) * 1024 * 1024)
+
+memory_tiered_caches = {'api_cache': api_cache, 'static_cache': static_cache, 'transient_cache': transient_cache}
+
+
+def log_memory_caches_stats():
+    for cache_name, cache in memory_tiered_caches.items():
+        cache.log_memory_stats(cache_name)
+
+
+@app.errorhandler(utils.InvalidRequestError)
+def invalid_request_error(error):
+    logging.warning("Invalid request: " + str(error))
+    return Response(str(error), status=400, mimetype='text/plain')
 
 
 @app.route('/')
@@ -86,6 +105,7 @@ def target_cities_json():
     results = target_cities.get_target_cities_data_json(req_data)
 
     utils.log_method_timings()
+    log_memory_caches_stats()
 
     return Response(results, mimetype='application/json')
 
@@ -95,7 +115,26 @@ def eurostat_testing(country):
     logging.log(logging.INFO, "Target eurostat received: " + str(country))
 
     from src import target_cities
-    results = target_cities.get_country_cities_combined_data(country)
+    results = json.dumps(target_cities.get_country_cities_combined_data(country))
+
+    return Response(results, mimetype='application/json')
+
+
+@app.route('/rate_limits', methods=['GET'])
+def rate_limits_json():
+    # Current token levels and expected wait for each external API, so the UI can show an ETA while searching
+    results = json.dumps(rate_limiter.get_all_rate_limits_status())
+
+    return Response(results, mimetype='application/json')
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats_json():
+    # Hit rates for the in-memory tier and the SQLite store behind it are counted separately
+    results = json.dumps({
+        cache_name: {'memory': cache.memory_stats, 'sqlite': cache.stats}
+        for cache_name, cache in memory_tiered_caches.items()
+    })
 
     return Response(results, mimetype='application/json')
 
@@ -109,10 +148,48 @@ def target_area_json():
     results = target_area.get_target_areas_polygons_json(req_data)
 
     utils.log_method_timings()
+    log_memory_caches_stats()
 
     return Response(results, mimetype='application/json')
 
 
+@app.route('/geocode/suggest', methods=['GET'])
+def geocode_suggest_json():
+    # Address autocomplete, entirely from the local geocode index, so it's quick enough to call on every keypress
+    from src import geocode_index
+    results = json.dumps(geocode_index.suggest_addresses(
+        request.args.get('q', ''), limit=min(max(request.args.get('limit', 10, type=int), 1), 50)))
+
+    return Response(results, mimetype='application/json')
+
+
+@app.route('/zone_scores', methods=['POST'])
+def zone_scores_json():
+    req_data = request.get_json()
+    logging.log(logging.INFO, "Zone scores request received: " + str(req_data))
+
+    from src import zone_scores
+    results = zone_scores.get_zone_scores_json(req_data)
+
+    utils.log_method_timings()
+
+    return Response(results, mimetype='application/json')
+
+
+def compile_datasets():
+    # Compile the IMD shapefiles into a memory-mapped format once, so every worker process can share the same pages.
+    # This takes minutes, so it's never done on import (which every spawned worker process repeats): the server
+    # starts it in the background instead, and anything which needs the dataset first waits for it on a file lock.
+    # It can also be run ahead of time with: python -m src.imd_dataset
+    imd_dataset.compile_imd_dataset()
+
+    # Likewise compile the Eurostat city statistics into typed columnar files, so no request ever parses the source
+    # TSVs; or ahead of time with: python -m src.eurostat_dataset
+    eurostat_dataset.compile_eurostat_dataset()
+
+
 if __name__ == '__main__':
+    threading.Thread(target=compile_datasets, name='compile_datasets', daemon=True).start()
+
     port = os.environ['PORT'] if 'PORT' in os.environ else 9876
     app.run(debug=app_debug, host='0.0.0.0', port=port, use_evalex=False)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import logging
+import os
+import threading
+
+import pandas as pd
+
+from src import google_maps
+from src.eurostat_dataset import eurostat_data_dir, get_eurostat_cities
+from src.utils import timeit, file_lock
+
+# Centre point of every Eurostat city, keyed by city code. It's filled in by geocoding each city once (run this module
+# to geocode them all up front), then saved alongside the Eurostat dataset so that listing a country's cities never
+# needs a network round trip per city. Any city not in it yet is geocoded on demand and added.
+city_gazetteer_path = eurostat_data_dir + 'city_gazetteer.csv'
+
+city_gazetteer = None
+city_gazetteer_lock = threading.Lock()
+
+
+@timeit
+def load_city_gazetteer():
+    if not os.path.isfile(city_gazetteer_path):
+        return {}
+
+    gazetteer_df = pd.read_csv(city_gazetteer_path, dtype={'code': str})
+
+    return {
+        city_code: [lng, lat]
+        for city_code, lng, lat in zip(gazetteer_df['code'], gazetteer_df['lng'], gazetteer_df['lat'])
+    }
+
+
+@timeit
+def save_city_gazetteer(gazetteer):
+    gazetteer_df = pd.DataFrame(
+        [(city_code, lng_lat[0], lng_lat[1]) for city_code, lng_lat in sorted(gazetteer.items())],
+        columns=['code', 'lng', 'lat']
+    )
+
+    # Written to a temporary file first, so another process never reads a half-written gazetteer
+    gazetteer_tmp_path = city_gazetteer_path + '.tmp-' + str(os.getpid())
+    gazetteer_df.to_csv(gazetteer_tmp_path, index=False)
+    os.replace(gazetteer_tmp_path, city_gazetteer_path)
+
+
+@timeit
+def get_city_gazetteer():
+    global city_gazetteer
+
+    if city_gazetteer is None:
+        city_gazetteer = load_city_gazetteer()
+        logging.info("Loaded city gazetteer with cities: " + str(len(city_gazetteer)))
+
+    return city_gazetteer
+
+
+@timeit
+def get_city_address(city_code, city_name):
+    # Eurostat city codes start with the country code, e.g. UK007C1
+    return city_name + ', ' + city_code[:2]
+
+
+@timeit
+def get_cities_centre_points(cities_df):
+    # Centre [lng, lat] for each row of a Eurostat cities DataFrame (CODE, NAME), in the same order; None for any city
+    # which couldn't be geocoded
+    gazetteer = get_city_gazetteer()
+    city_codes = list(cities_df['CODE'])
+    city_names = list(cities_df['NAME'])
+
+    missing_indexes = [city_index for city_index, city_code in enumerate(city_codes) if city_code not in gazetteer]
+
+    if missing_indexes:
+        logging.info("Geocoding cities missing from gazetteer: " + str(len(missing_indexes)))
+
+        missing_centre_points = google_maps.get_centre_points_lng_lat_for_addresses([
+            get_city_address(city_codes[city_index], city_names[city_index]) for city_index in missing_indexes
+        ])
+
+        # Other worker processes may have added cities since we loaded the gazetteer, so ours is merged with what's on
+        # disk while holding the file lock, rather than overwriting their additions
+        with city_gazetteer_lock, file_lock(city_gazetteer_path + '.lock'):
+            gazetteer.update(load_city_gazetteer())
+
+            for city_index, centre_point in zip(missing_indexes, missing_centre_points):
+                if centre_point is not None:
+                    gazetteer[city_codes[city_index]] = centre_point
+
+            save_city_gazetteer(gazetteer)
+
+    return [gazetteer.get(city_code) for city_code in city_codes]
+
+
+@timeit
+def build_city_gazetteer():
+    cities_df = get_eurostat_cities()
+
+    # Only the cities themselves (e.g. UK007C1), not greater cities or functional urban areas
+    cities_df = cities_df[cities_df['CODE'].str.contains('^[A-Z]+[0-9]+C[0-9]+$')]
+
+    centre_points = get_cities_centre_points(cities_df)
+
+    logging.info("City gazetteer has centre points for %d of %d Eurostat cities" % (
+        sum(centre_point is not None for centre_point in centre_points), len(cities_df)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    build_city_gazetteer()
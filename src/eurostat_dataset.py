@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+
+import pandas as pd
+
+from src.utils import timeit, file_lock
+
+eurostat_data_dir = 'datasets/europe/eurostat-cities-2019/'
+
+eurostat_category_files = {
+    'Economy and finance': 'urb_cecfi',
+    'Environment': 'urb_cenv',
+    'Fertility and mortality': 'urb_cfermor',
+    'Education': 'urb_ceduc',
+    'Living conditions': 'urb_clivcon',
+    'Labour market': 'urb_clma',
+    'Population': 'urb_cpop1',
+    'Culture and tourism': 'urb_ctour',
+    'Transport': 'urb_ctran',
+    'Perception survey': 'urb_percep',
+}
+
+compiled_eurostat_dataset_dir = eurostat_data_dir + 'compiled/'
+compiled_eurostat_dataset_version = 1
+
+# Each compiled table (every category, the cities and the labels) is only read from disk the first time a query needs
+# it, then kept for the lifetime of the process
+compiled_eurostat_manifest = None
+compiled_eurostat_tables = {}
+
+
+# The source TSVs are slow to parse (and the metadata spreadsheets need xlrd), and every value is a string such as
+# "515855 d" - a number followed by Eurostat flags - or ": " when missing. So we compile them once into Feather files:
+# - cities.feather: CODE and NAME of every city
+# - labels.feather: code and label for every indicator / variable / perception survey code
+# - categories/<file>.feather: one row per indicator and city, with "indicator" and "city" codes, then a float64 column
+#   for each year (NaN when missing) and a "<year> flags" column with any flags on that year's value
+# The manifest lists each category's years, newest first.
+
+@timeit
+def read_eurostat_category_tsv(category_file):
+    return pd.read_csv(eurostat_data_dir + category_file + '.tsv.gz', sep='\t', header=0, dtype=str,
+                       compression='gzip', on_bad_lines='skip')
+
+
+@timeit
+def read_eurostat_labels():
+    indicators_df = pd.read_excel(eurostat_data_dir + 'urb_esms_an1.xlsx')
+    variables_df = pd.read_excel(eurostat_data_dir + 'urb_esms_an3.xls')
+    perception_df = pd.read_csv(eurostat_data_dir + 'urb_percep_indicators.tsv', sep='\t', header=None,
+                                names=['Code', 'Label'])
+
+    # Variable labels take precedence over indicator labels, then perception survey labels
+    labels = pd.concat([
+        variables_df.rename(columns={'Code': 'code', 'Label': 'label'})[['code', 'label']],
+        indicators_df.rename(columns={'CODE': 'code', 'LABEL': 'label'})[['code', 'label']],
+        perception_df.rename(columns={'Code': 'code', 'Label': 'label'})[['code', 'label']]
+    ], ignore_index=True).dropna()
+
+    return labels.astype(str).drop_duplicates('code', keep='first').reset_index(drop=True)
+
+
+@timeit
+def split_value_flags(year_values):
+    # e.g. "515855 d" -> 515855.0, "d"; ": c" -> NaN, "c"; ": " -> NaN, ""
+    value_parts = year_values.fillna(':').str.strip().str.extract(r'^(\S*)\s*(.*)$')
+
+    return pd.to_numeric(value_parts[0], errors='coerce'), value_parts[1].fillna('')
+
+
+@timeit
+def compile_eurostat_category(category_file):
+    source_df = read_eurostat_category_tsv(category_file)
+
+    # The first column is e.g. "indic_ur,cities\time" or "indic_ur,unit,cities\time": the indicator code comes first
+    # and the city code last
+    row_keys = source_df.iloc[:, 0].str.split(',')
+    category_columns = {
+        'indicator': row_keys.str[0].str.strip(),
+        'city': row_keys.str[-1].str.strip()
+    }
+
+    years = [str(year_column).strip() for year_column in source_df.columns[1:]]
+    for year, year_column in zip(years, source_df.columns[1:]):
+        category_columns[year], category_columns[year + ' flags'] = split_value_flags(source_df[year_column])
+
+    # Newest first, as the source files are, so the latest value is always the first one present
+    years.sort(key=lambda year: int(re.sub('[^0-9]', '', year) or 0), reverse=True)
+
+    return pd.DataFrame(category_columns), years
+
+
+@timeit
+def is_eurostat_dataset_compiled():
+    manifest_path = compiled_eurostat_dataset_dir + 'manifest.json'
+
+    if not os.path.isfile(manifest_path):
+        return False
+
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file).get('version') == compiled_eurostat_dataset_version
+
+
+@timeit
+def compile_eurostat_dataset(force=False):
+    if not force and is_eurostat_dataset_compiled():
+        logging.info("Compiled Eurostat dataset already exists: " + compiled_eurostat_dataset_dir)
+        return
+
+    # Every worker process may find the dataset missing at once, so only one compiles it and the rest wait for it
+    with file_lock(compiled_eurostat_dataset_dir.rstrip('/') + '.lock'):
+        if not force and is_eurostat_dataset_compiled():
+            logging.info("Compiled Eurostat dataset was compiled by another process: " + compiled_eurostat_dataset_dir)
+            return
+
+        compile_eurostat_dataset_from_source()
+
+
+@timeit
+def compile_eurostat_dataset_from_source():
+    logging.info("Compiling Eurostat dataset into: " + compiled_eurostat_dataset_dir)
+
+    # Write everything into a temporary directory first, so a half-written dataset is never picked up
+    compile_dir = compiled_eurostat_dataset_dir.rstrip('/') + '.tmp-' + str(os.getpid()) + '/'
+    shutil.rmtree(compile_dir, ignore_errors=True)
+    os.makedirs(compile_dir + 'categories')
+
+    cities_df = pd.read_excel(eurostat_data_dir + 'urb_esms_an4.xls')[['CODE', 'NAME']].dropna().astype(str)
+    cities_df.reset_index(drop=True).to_feather(compile_dir + 'cities.feather')
+    read_eurostat_labels().to_feather(compile_dir + 'labels.feather')
+
+    categories_years = {}
+    for category_name, category_file in eurostat_category_files.items():
+        category_df, categories_years[category_name] = compile_eurostat_category(category_file)
+        category_df.to_feather(compile_dir + 'categories/' + category_file + '.feather')
+
+        logging.info("Compiled Eurostat category " + category_name + " with rows: " + str(len(category_df)))
+
+    with open(compile_dir + 'manifest.json', 'w') as manifest_file:
+        json.dump({
+            'version': compiled_eurostat_dataset_version,
+            'categories': {
+                category_name: {'file': category_file, 'years': categories_years[category_name]}
+                for category_name, category_file in eurostat_category_files.items()
+            }
+        }, manifest_file)
+
+    shutil.rmtree(compiled_eurostat_dataset_dir, ignore_errors=True)
+    os.rename(compile_dir, compiled_eurostat_dataset_dir)
+
+    logging.info("Compiled Eurostat dataset with cities: " + str(len(cities_df)))
+
+
+@timeit
+def get_compiled_eurostat_manifest():
+    global compiled_eurostat_manifest
+
+    if compiled_eurostat_manifest is None:
+        if not is_eurostat_dataset_compiled():
+            compile_eurostat_dataset()
+
+        with open(compiled_eurostat_dataset_dir + 'manifest.json') as manifest_file:
+            compiled_eurostat_manifest = json.load(manifest_file)
+
+    return compiled_eurostat_manifest
+
+
+@timeit
+def get_eurostat_category_names():
+    return list(get_compiled_eurostat_manifest()['categories'].keys())
+
+
+@timeit
+def get_eurostat_cities():
+    if 'cities' not in compiled_eurostat_tables:
+        get_compiled_eurostat_manifest()
+        compiled_eurostat_tables['cities'] = pd.read_feather(compiled_eurostat_dataset_dir + 'cities.feather')
+
+    return compiled_eurostat_tables['cities']
+
+
+@timeit
+def get_eurostat_labels():
+    if 'labels' not in compiled_eurostat_tables:
+        get_compiled_eurostat_manifest()
+        compiled_eurostat_tables['labels'] = pd.read_feather(
+            compiled_eurostat_dataset_dir + 'labels.feather').set_index('code')['label']
+
+    return compiled_eurostat_tables['labels']
+
+
+@timeit
+def get_eurostat_category(category_name):
+    # Returns the category's DataFrame (see above) and its years, newest first
+    if category_name not in compiled_eurostat_tables:
+        category_manifest = get_compiled_eurostat_manifest()['categories'][category_name]
+        compiled_eurostat_tables[category_name] = (
+            pd.read_feather(compiled_eurostat_dataset_dir + 'categories/' + category_manifest['file'] + '.feather'),
+            category_manifest['years']
+        )
+
+        logging.info("Loaded compiled Eurostat category: " + category_name)
+
+    return compiled_eurostat_tables[category_name]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    compile_eurostat_dataset(force='--force' in sys.argv)
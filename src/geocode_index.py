@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import bisect
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src import google_maps
+from src.city_gazetteer import get_city_gazetteer
+from src.eurostat_dataset import get_eurostat_cities, is_eurostat_dataset_compiled
+from src.utils import timeit
+
+# A local index of addresses we can resolve without calling a geocoding API, which also backs address autocomplete.
+# It's made of two sorted key lists, so every prefix search is a binary search rather than a scan:
+# - places: an optional offline dataset (e.g. a postcode or place name directory), given as a CSV with address, lng
+#   and lat columns by HOMEAREA_GEOCODE_DATASET, plus the Eurostat city gazetteer; loaded once into numpy arrays
+# - resolved: every address we've geocoded with the API before, stored in SQLite next to the caches so it's shared by
+#   every worker process and survives restarts; kept in memory as a Python list, so new addresses can be inserted
+geocode_index_db_path = 'caches/geocode_index.sqlite'
+geocode_dataset_path = os.environ.get('HOMEAREA_GEOCODE_DATASET', '')
+
+geocode_index = None
+geocode_index_lock = threading.Lock()
+
+
+@timeit
+def normalise_address(address_string):
+    # Case, punctuation and spacing don't change what an address refers to, so they don't change its key either
+    return ' '.join(re.sub(r'[^\w\s]', ' ', str(address_string).lower()).split())
+
+
+@timeit
+def get_geocode_index_db():
+    geocode_index_db = sqlite3.connect(geocode_index_db_path, timeout=60, isolation_level=None)
+    geocode_index_db.execute(
+        'CREATE TABLE IF NOT EXISTS resolved_addresses (key TEXT PRIMARY KEY, address TEXT, lng REAL, lat REAL)')
+
+    return geocode_index_db
+
+
+@timeit
+def load_places_dataframe():
+    places_dfs = []
+
+    if geocode_dataset_path:
+        places_dfs.append(pd.read_csv(geocode_dataset_path, usecols=['address', 'lng', 'lat']))
+
+    # Cities are looked up by the same "Name, CC" address the target cities search uses to geocode them
+    city_gazetteer = get_city_gazetteer()
+    if city_gazetteer and is_eurostat_dataset_compiled():
+        cities_df = get_eurostat_cities()
+        cities_df = cities_df[cities_df['CODE'].isin(city_gazetteer.keys())]
+
+        places_dfs.append(pd.DataFrame({
+            'address': cities_df['NAME'] + ', ' + cities_df['CODE'].str[:2],
+            'lng': [city_gazetteer[city_code][0] for city_code in cities_df['CODE']],
+            'lat': [city_gazetteer[city_code][1] for city_code in cities_df['CODE']]
+        }))
+
+    if not places_dfs:
+        return pd.DataFrame({'address': [], 'lng': [], 'lat': []})
+
+    return pd.concat(places_dfs, ignore_index=True)
+
+
+@timeit
+def build_geocode_index():
+    places_df = load_places_dataframe()
+    places_df = places_df.assign(key=places_df['address'].map(normalise_address))
+    places_df = places_df.drop_duplicates('key').sort_values('key')
+
+    geocode_index_db = get_geocode_index_db()
+    try:
+        resolved_rows = geocode_index_db.execute(
+            'SELECT key, address, lng, lat FROM resolved_addresses ORDER BY key').fetchall()
+    finally:
+        geocode_index_db.close()
+
+    logging.info("Built geocode index with places: %d, resolved addresses: %d" % (
+        len(places_df), len(resolved_rows)))
+
+    return {
+        'places_keys': places_df['key'].to_numpy(dtype=str),
+        'places_addresses': places_df['address'].to_numpy(dtype=object),
+        'places_lng_lat': places_df[['lng', 'lat']].to_numpy(dtype=np.float64),
+        'resolved_keys': [resolved_row[0] for resolved_row in resolved_rows],
+        'resolved': {
+            resolved_row[0]: {'address': resolved_row[1], 'coords': [resolved_row[2], resolved_row[3]]}
+            for resolved_row in resolved_rows
+        }
+    }
+
+
+@timeit
+def get_geocode_index():
+    global geocode_index
+
+    if geocode_index is None:
+        geocode_index = build_geocode_index()
+
+    return geocode_index
+
+
+@timeit
+def add_resolved_address(address_key, address_string, lng_lat):
+    index = get_geocode_index()
+
+    with geocode_index_lock:
+        if address_key not in index['resolved']:
+            bisect.insort(index['resolved_keys'], address_key)
+        index['resolved'][address_key] = {'address': address_string, 'coords': list(lng_lat)}
+
+
+@timeit
+def lookup_address(address_string):
+    # The coordinates for an exact (normalised) match in the local index, or None
+    index = get_geocode_index()
+    address_key = normalise_address(address_string)
+
+    if address_key in index['resolved']:
+        return index['resolved'][address_key]['coords']
+
+    place_index = np.searchsorted(index['places_keys'], address_key)
+    if place_index < len(index['places_keys']) and index['places_keys'][place_index] == address_key:
+        return index['places_lng_lat'][place_index].tolist()
+
+    # Another worker process may have resolved it since we built our index
+    geocode_index_db = get_geocode_index_db()
+    try:
+        resolved_row = geocode_index_db.execute(
+            'SELECT address, lng, lat FROM resolved_addresses WHERE key = ?', (address_key,)).fetchone()
+    finally:
+        geocode_index_db.close()
+
+    if resolved_row is not None:
+        add_resolved_address(address_key, resolved_row[0], resolved_row[1:])
+        return [resolved_row[1], resolved_row[2]]
+
+    return None
+
+
+@timeit
+def resolve_address(address_string):
+    # Local index first, then the geocoding API, recording whatever it resolves so it's local next time
+    lng_lat = lookup_address(address_string)
+    if lng_lat is not None:
+        return lng_lat
+
+    lng_lat = google_maps.get_centre_point_lng_lat_for_address(address_string)
+    if not lng_lat:
+        return None
+
+    address_key = normalise_address(address_string)
+    geocode_index_db = get_geocode_index_db()
+    try:
+        geocode_index_db.execute(
+            'INSERT OR REPLACE INTO resolved_addresses (key, address, lng, lat) VALUES (?, ?, ?, ?)',
+            (address_key, str(address_string).strip(), lng_lat[0], lng_lat[1]))
+    finally:
+        geocode_index_db.close()
+
+    add_resolved_address(address_key, str(address_string).strip(), lng_lat)
+
+    return lng_lat
+
+
+@timeit
+def suggest_addresses(prefix_string, limit=10):
+    # Addresses starting with the given prefix, those we've resolved before first, each as {address, coords}
+    index = get_geocode_index()
+    prefix_key = normalise_address(prefix_string)
+    if not prefix_key:
+        return []
+
+    # Every key starting with the prefix sorts between the prefix itself and the prefix followed by the highest
+    # possible character
+    prefix_end_key = prefix_key + '\uffff'
+    suggestions = []
+
+    with geocode_index_lock:
+        resolved_start = bisect.bisect_left(index['resolved_keys'], prefix_key)
+        resolved_end = bisect.bisect_left(index['resolved_keys'], prefix_end_key)
+        resolved_keys = index['resolved_keys'][resolved_start:min(resolved_end, resolved_start + limit)]
+        suggestions.extend(index['resolved'][resolved_key] for resolved_key in resolved_keys)
+
+    places_start, places_end = np.searchsorted(index['places_keys'], [prefix_key, prefix_end_key])
+
+    # Places we've already suggested as resolved addresses are skipped, so keep going until the limit is reached
+    # rather than stopping after a fixed number of places
+    suggested_keys = set(resolved_keys)
+    for place_index in range(places_start, places_end):
+        if len(suggestions) >= limit:
+            break
+
+        if index['places_keys'][place_index] not in suggested_keys:
+            suggestions.append({
+                'address': index['places_addresses'][place_index],
+                'coords': index['places_lng_lat'][place_index].tolist()
+            })
+
+    return suggestions
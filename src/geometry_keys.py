@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import copyreg
+import hashlib
+import io
+import pickle
+import weakref
+
+import shapely
+from shapely.geometry import Point, LineString, LinearRing, Polygon, MultiPoint, MultiLineString, MultiPolygon, \
+    GeometryCollection
+
+# ucache's default key function pickles every argument and hashes the result, which for Shapely geometries means
+# serialising every coordinate of every polygon on every call - often slower than the GEOS operation being cached.
+# Instead, each geometry is fingerprinted once (a SHA-1 of its WKB, which is quicker than MD5 for large buffers) and
+# the fingerprint is pickled in its place.
+#
+# Shapely 2 geometries are immutable and support weak references but not extra attributes, so fingerprints are kept
+# in a dict keyed by id(), and a weakref.finalize callback removes each entry when its geometry is garbage collected,
+# before that id can be reused by another object.
+geometry_fingerprints = {}
+
+
+def get_geometry_fingerprint(geometry):
+    geometry_id = id(geometry)
+    fingerprint = geometry_fingerprints.get(geometry_id)
+
+    if fingerprint is None:
+        fingerprint = hashlib.sha1(shapely.to_wkb(geometry)).hexdigest()
+        geometry_fingerprints[geometry_id] = fingerprint
+        weakref.finalize(geometry, geometry_fingerprints.pop, geometry_id, None)
+
+    return fingerprint
+
+
+def reduce_geometry_to_fingerprint(geometry):
+    # Only ever used to build a key, never unpickled, so any reduce value which is unique to the geometry will do
+    return str, ('geometry:' + get_geometry_fingerprint(geometry),)
+
+
+# Pickle looks up reducers by exact type, and only for types it doesn't handle natively, so lists, tuples, floats etc.
+# are still pickled at C speed and only the geometries themselves hit the Python reducer above
+geometry_key_dispatch_table = {
+    **copyreg.dispatch_table,
+    **{geometry_type: reduce_geometry_to_fingerprint for geometry_type in [
+        Point, LineString, LinearRing, Polygon, MultiPoint, MultiLineString, MultiPolygon, GeometryCollection
+    ]}
+}
+
+
+def geometry_key_fn(args, kwargs):
+    # Drop-in replacement for ucache's default key_fn, for use as: @transient_cache.cached(key_fn=geometry_key_fn)
+    key_buffer = io.BytesIO()
+
+    key_pickler = pickle.Pickler(key_buffer, pickle.HIGHEST_PROTOCOL)
+    key_pickler.dispatch_table = geometry_key_dispatch_table
+    key_pickler.dump((args, kwargs))
+
+    return hashlib.md5(key_buffer.getvalue()).hexdigest()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import hashlib
+import io
+import logging
+import pickle
+import weakref
+import zlib
+
+import shapely
+
+from src.geometry_keys import get_geometry_fingerprint
+
+
+# Cached values are still pickled, but every Shapely geometry inside them is swapped out (via pickle's persistent_id)
+# for the hash of its WKB, and the WKB itself is stored once in a separate geometry_blobs table in the same SQLite
+# database. So the same IMD layer or isochrone cached under many different keys is only stored once, the pickles
+# themselves stay tiny, and loading decodes each geometry straight from WKB with no Python coordinate lists.
+#
+# Optionally, geometries can be snapped to a grid before storing (e.g. 0.000001 degrees, roughly 10cm), which makes
+# identical-looking results share a blob and makes the WKB compress far better. This uses GEOS set_precision, so the
+# snapped geometries are still valid, but it's lossy, so it's off unless a grid size is given.
+#
+# Blobs are never deleted when the values referencing them expire; they're only cleared by flush(). The transient
+# cache is wiped on every deploy anyway, and with deduplication the orphans are a small fraction of what was saved.
+
+class MissingGeometryBlobError(pickle.UnpicklingError):
+    pass
+
+
+class GeometryBlobSerializer(object):
+    def __init__(self, database, grid_size=None, compression_level=1):
+        self.database = database
+        self.grid_size = grid_size
+        self.compression_level = compression_level
+
+        # Blobs this process knows are already stored, so repeat writes of the same geometry skip encoding entirely
+        self.stored_hashes = set()
+
+        # Geometries are immutable, so any decoded geometry still alive in this process can be handed out again
+        self.loaded_geometries = weakref.WeakValueDictionary()
+
+    def create_table(self):
+        self.database.execute_sql(
+            'CREATE TABLE IF NOT EXISTS geometry_blobs (hash TEXT PRIMARY KEY, wkb BLOB) WITHOUT ROWID')
+
+    def flush(self):
+        self.database.execute_sql('DELETE FROM geometry_blobs')
+        self.stored_hashes.clear()
+        self.loaded_geometries.clear()
+
+    def store_geometry(self, geometry):
+        if self.grid_size:
+            geometry = shapely.set_precision(geometry, self.grid_size)
+            geometry_wkb = shapely.to_wkb(geometry)
+            geometry_hash = hashlib.sha1(geometry_wkb).hexdigest()
+        else:
+            # Same hash as the cache keys use, so a geometry which was just used in a key isn't hashed again
+            geometry_hash = get_geometry_fingerprint(geometry)
+            geometry_wkb = None
+
+        if geometry_hash not in self.stored_hashes:
+            if geometry_wkb is None:
+                geometry_wkb = shapely.to_wkb(geometry)
+
+            self.database.execute_sql(
+                'INSERT OR IGNORE INTO geometry_blobs (hash, wkb) VALUES (?, ?)',
+                (geometry_hash, zlib.compress(geometry_wkb, self.compression_level)))
+            self.stored_hashes.add(geometry_hash)
+
+        return geometry_hash
+
+    def load_geometry(self, geometry_hash):
+        geometry = self.loaded_geometries.get(geometry_hash)
+
+        if geometry is None:
+            blob_row = self.database.execute_sql(
+                'SELECT wkb FROM geometry_blobs WHERE hash = ?', (geometry_hash,)).fetchone()
+
+            if blob_row is None:
+                raise MissingGeometryBlobError(geometry_hash)
+
+            geometry = shapely.from_wkb(zlib.decompress(blob_row[0]))
+            self.loaded_geometries[geometry_hash] = geometry
+            self.stored_hashes.add(geometry_hash)
+
+        return geometry
+
+    def pack(self, value):
+        value_buffer = io.BytesIO()
+
+        value_pickler = pickle.Pickler(value_buffer, pickle.HIGHEST_PROTOCOL)
+        value_pickler.persistent_id = self.get_persistent_id
+        value_pickler.dump(value)
+
+        return value_buffer.getvalue()
+
+    def unpack(self, data):
+        value_unpickler = pickle.Unpickler(io.BytesIO(data))
+        value_unpickler.persistent_load = self.load_persistent_id
+
+        # Values pickled before this serializer was added (e.g. in the pre-seeded static cache download) have no
+        # persistent ids, so they still load as normal
+        try:
+            return value_unpickler.load()
+        except MissingGeometryBlobError as e:
+            # Another process must have flushed the blobs; treat it as a cache miss so the value is recomputed, and
+            # forget what we thought was stored so the geometries are written again
+            logging.warning('Cached value references missing geometry blob, treating as a miss: ' + str(e))
+            self.stored_hashes.clear()
+            return None
+
+    def get_persistent_id(self, value):
+        if isinstance(value, shapely.Geometry):
+            return 'geometry:' + self.store_geometry(value)
+
+        return None
+
+    def load_persistent_id(self, persistent_id):
+        if not persistent_id.startswith('geometry:'):
+            raise pickle.UnpicklingError('Unsupported persistent id in cached value: ' + persistent_id)
+
+        return self.load_geometry(persistent_id[len('geometry:'):])
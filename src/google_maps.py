@@ -1,16 +1,39 @@
 #!/usr/bin/env python3
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import googlemaps
 
+from run_server import api_cache
+from src.rate_limiter import rate_limited
 from src.utils import timeit
 
+# One client per process, reused for every geocode: creating one per call meant a new HTTP session (and so a new TLS
+# connection to Google) for every single address
+gmaps_client = None
+
+# Geocodes for a batch of addresses (e.g. every city in a country) are almost entirely waiting on HTTP round trips, so
+# they're made concurrently; this bounds how many are in flight at once, and the rate limiter still applies
+geocode_executor = ThreadPoolExecutor(max_workers=8)
+
 
 @timeit
-def get_centre_point_lng_lat_for_address(address_string):
-    gmaps = googlemaps.Client(key=os.environ['GMAPS_API_KEY'])
+def get_gmaps_client():
+    global gmaps_client
 
-    geocode_result = gmaps.geocode(address_string)
+    if gmaps_client is None:
+        gmaps_client = googlemaps.Client(key=os.environ['GMAPS_API_KEY'])
+
+    return gmaps_client
+
+
+@timeit
+@api_cache.cached()
+@rate_limited('googlemaps')  # Shared token bucket across all worker processes, see src/rate_limiter.py
+def get_centre_point_lng_lat_for_address(address_string):
+    # An address Google can't find is cached as an empty list rather than None, which the cache would treat as a miss
+    # and so look up (and spend a rate limit token on) again every time; callers treat the empty list as no result
+    geocode_result = get_gmaps_client().geocode(address_string)
 
     if len(geocode_result) > 0:
         return [
@@ -18,4 +41,13 @@ def get_centre_point_lng_lat_for_address(address_string):
             geocode_result[0]['geometry']['location']['lat']
         ]
     else:
-        return None
+        return []
+
+
+@timeit
+def get_centre_points_lng_lat_for_addresses(address_strings):
+    # Results are in the same order as the addresses, None for any which couldn't be found; any already in the cache
+    # return without touching the network
+    return [
+        lng_lat or None for lng_lat in geocode_executor.map(get_centre_point_lng_lat_for_address, address_strings)
+    ]
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import shutil
+import sys
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from src.level_of_detail import lod_tolerances
+from src.utils import timeit, file_lock
+
+rank_type_properties = {
+    'deprivation': {'england': 'IMDDec0', 'scotland': 'Decile'},
+    'income': {'england': 'IncDec', 'scotland': 'IncRank'},
+    'crime': {'england': 'CriDec', 'scotland': 'CrimeRank'},
+    'health': {'england': 'HDDDec', 'scotland': 'HlthRank'},
+    'education': {'england': 'EduDec', 'scotland': 'EduRank'},
+    'services': {'england': 'GBDec', 'scotland': 'GAccRank'},
+    'environment': {'england': 'EnvDec', 'scotland': 'HouseRank'}
+}
+
+uk_zones_shapefiles = {
+    'england': 'datasets/uk/IMD_2019_WGS.shp',
+    'scotland': 'datasets/uk/SG_SIMD_2016_WGS.shp'
+}
+
+# Minimum Scottish rank for each decile 2-10, as per the SIMD16-Rank-Decile-Mapping-00504608.xlsx dataset info
+scotland_decile_min_ranks = [698, 1396, 2093, 2791, 3489, 4186, 4884, 5581, 6279]
+
+compiled_imd_dataset_dir = 'datasets/uk/compiled/'
+compiled_imd_dataset_version = 3
+
+# The compiled dataset is opened once per process; the arrays are memory-mapped so the pages are shared between
+# every worker process reading the same files
+compiled_imd_dataset = None
+compiled_rank_layers = {}
+
+
+# The shapefiles are slow to read (fiona + shape() for every zone, on every query), so we compile them once into:
+# - zones.wkb: every zone geometry as WKB, concatenated, with zones_offsets.npy giving the byte range of each zone
+# - zones_bounds.npy / zones_centroids.npy: envelope and centroid for each zone, for indexing without decoding WKB
+# - zones_countries.npy: index into manifest['countries'] for each zone
+# - deciles/<rank_type>.npy: decile 1-10 for each zone and rank type, with Scottish ranks already mapped to deciles
+# - columns/<country>.<column>.npy: every numeric column from the source shapefiles, NaN for the other country
+# - layers/<rank_type>.<min_decile>.<lod>.wkb: every zone with at least that decile, dissolved into one geometry,
+#   simplified to each level of detail in src/level_of_detail.py and stored as its separate parts, with
+#   _offsets.npy / _bounds.npy so the parts can be indexed
+# All zones arrays are in the same zone order, so a boolean mask over one can be applied to any of the others.
+
+@timeit
+def get_zone_decile(country, rank_type, zone_properties):
+    zone_value = zone_properties[rank_type_properties[rank_type][country]]
+
+    # Scotland only has Decile values for the combined deprivation rank, everything else is a Rank out of 6976
+    if country == 'scotland' and rank_type != 'deprivation':
+        return 1 + int(np.searchsorted(scotland_decile_min_ranks, zone_value, side='right'))
+
+    return int(zone_value)
+
+
+@timeit
+def write_geometry_array(path_prefix, geometries):
+    geometries_wkb = shapely.to_wkb(geometries)
+    geometries_offsets = np.zeros(len(geometries_wkb) + 1, dtype=np.int64)
+    np.cumsum([len(single_wkb) for single_wkb in geometries_wkb], out=geometries_offsets[1:])
+
+    with open(path_prefix + '.wkb', 'wb') as wkb_file:
+        for single_wkb in geometries_wkb:
+            wkb_file.write(single_wkb)
+
+    np.save(path_prefix + '_offsets.npy', geometries_offsets)
+    np.save(path_prefix + '_bounds.npy', shapely.bounds(geometries).reshape(-1, 4))
+
+
+@timeit
+def load_geometry_array(path_prefix):
+    return {
+        'wkb': np.memmap(path_prefix + '.wkb', dtype=np.uint8, mode='r'),
+        'offsets': np.load(path_prefix + '_offsets.npy', mmap_mode='r'),
+        'bounds': np.load(path_prefix + '_bounds.npy', mmap_mode='r')
+    }
+
+
+@timeit
+def decode_geometries(geometry_array, geometry_indexes):
+    geometries_wkb = geometry_array['wkb']
+    geometries_offsets = geometry_array['offsets']
+
+    return shapely.from_wkb([
+        geometries_wkb[geometries_offsets[geometry_index]:geometries_offsets[geometry_index + 1]].tobytes()
+        for geometry_index in geometry_indexes
+    ])
+
+
+@timeit
+def compile_rank_layers(layers_dir, zone_polygons, zone_deciles):
+    for rank_type, deciles in zone_deciles.items():
+        dissolved_layer = None
+
+        # Work down from the highest decile, so each layer only needs to merge one more decile's zones into the last
+        for min_decile in range(10, 0, -1):
+            decile_zones = list(zone_polygons[deciles == min_decile])
+            if dissolved_layer is not None:
+                decile_zones.append(dissolved_layer)
+
+            dissolved_layer = shapely.unary_union(decile_zones)
+
+            for lod, lod_tolerance in enumerate(lod_tolerances):
+                simplified_layer = dissolved_layer.simplify(lod_tolerance, preserve_topology=True)
+
+                write_geometry_array(
+                    layers_dir + rank_type + '.' + str(min_decile) + '.' + str(lod),
+                    shapely.get_parts(simplified_layer)
+                )
+
+        logging.info("Compiled dissolved rank layers for: " + rank_type)
+
+
+@timeit
+def is_imd_dataset_compiled():
+    manifest_path = compiled_imd_dataset_dir + 'manifest.json'
+
+    if not os.path.isfile(manifest_path):
+        return False
+
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file).get('version') == compiled_imd_dataset_version
+
+
+@timeit
+def compile_imd_dataset(force=False):
+    if not force and is_imd_dataset_compiled():
+        logging.info("Compiled IMD dataset already exists: " + compiled_imd_dataset_dir)
+        return
+
+    # Every worker process may find the dataset missing at once, so only one compiles it and the rest wait for it
+    with file_lock(compiled_imd_dataset_dir.rstrip('/') + '.lock'):
+        if not force and is_imd_dataset_compiled():
+            logging.info("Compiled IMD dataset was compiled by another process: " + compiled_imd_dataset_dir)
+            return
+
+        compile_imd_dataset_from_shapefiles()
+
+
+@timeit
+def compile_imd_dataset_from_shapefiles():
+    # Only needed for compilation, so the query path never has to import fiona
+    import fiona
+
+    logging.info("Compiling IMD dataset from shapefiles into: " + compiled_imd_dataset_dir)
+
+    countries = list(uk_zones_shapefiles.keys())
+    zone_polygons = []
+    zone_countries = []
+    zone_deciles = {rank_type: [] for rank_type in rank_type_properties}
+    zone_columns = {}
+
+    for country_index, (country, shapefile_path) in enumerate(uk_zones_shapefiles.items()):
+        with fiona.open(shapefile_path) as allZones:
+            for singleZone in allZones:
+                zone_index = len(zone_polygons)
+                zone_polygons.append(shape(singleZone['geometry']))
+                zone_countries.append(country_index)
+
+                for rank_type in rank_type_properties:
+                    zone_deciles[rank_type].append(get_zone_decile(country, rank_type, singleZone['properties']))
+
+                for column_name, column_value in singleZone['properties'].items():
+                    if not isinstance(column_value, (int, float)) or isinstance(column_value, bool):
+                        continue
+
+                    column_key = country + '.' + column_name
+                    if column_key not in zone_columns:
+                        zone_columns[column_key] = {}
+                    zone_columns[column_key][zone_index] = column_value
+
+        logging.info("Read " + country + " zones, total zones so far: " + str(len(zone_polygons)))
+
+    zone_polygons = np.array(zone_polygons, dtype=object)
+    zone_deciles = {rank_type: np.array(deciles, dtype=np.uint8) for rank_type, deciles in zone_deciles.items()}
+    zones_count = len(zone_polygons)
+
+    # Write everything into a temporary directory first, so a half-written dataset is never picked up
+    compile_dir = compiled_imd_dataset_dir.rstrip('/') + '.tmp-' + str(os.getpid()) + '/'
+    shutil.rmtree(compile_dir, ignore_errors=True)
+    os.makedirs(compile_dir + 'deciles')
+    os.makedirs(compile_dir + 'columns')
+    os.makedirs(compile_dir + 'layers')
+
+    write_geometry_array(compile_dir + 'zones', zone_polygons)
+    np.save(compile_dir + 'zones_centroids.npy', shapely.get_coordinates(shapely.centroid(zone_polygons)))
+    np.save(compile_dir + 'zones_countries.npy', np.array(zone_countries, dtype=np.uint8))
+
+    for rank_type, deciles in zone_deciles.items():
+        np.save(compile_dir + 'deciles/' + rank_type + '.npy', deciles)
+
+    for column_key, column_values in zone_columns.items():
+        column_array = np.full(zones_count, np.nan)
+        column_array[list(column_values.keys())] = list(column_values.values())
+        np.save(compile_dir + 'columns/' + column_key + '.npy', column_array)
+
+    compile_rank_layers(compile_dir + 'layers/', zone_polygons, zone_deciles)
+
+    with open(compile_dir + 'manifest.json', 'w') as manifest_file:
+        json.dump({
+            'version': compiled_imd_dataset_version,
+            'zones': zones_count,
+            'countries': countries,
+            'rank_types': list(rank_type_properties.keys()),
+            'columns': sorted(zone_columns.keys()),
+            'rank_layers_lod_tolerances': lod_tolerances
+        }, manifest_file)
+
+    shutil.rmtree(compiled_imd_dataset_dir, ignore_errors=True)
+    os.rename(compile_dir, compiled_imd_dataset_dir)
+
+    logging.info("Compiled IMD dataset with zones: " + str(zones_count))
+
+
+@timeit
+def load_compiled_imd_dataset():
+    if not is_imd_dataset_compiled():
+        compile_imd_dataset()
+
+    with open(compiled_imd_dataset_dir + 'manifest.json') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    def load_array(filename):
+        return np.load(compiled_imd_dataset_dir + filename, mmap_mode='r')
+
+    return {
+        'manifest': manifest,
+        **load_geometry_array(compiled_imd_dataset_dir + 'zones'),
+        'centroids': load_array('zones_centroids.npy'),
+        'countries': load_array('zones_countries.npy'),
+        'deciles': {
+            rank_type: load_array('deciles/' + rank_type + '.npy') for rank_type in manifest['rank_types']
+        },
+        'columns': {
+            column_key: load_array('columns/' + column_key + '.npy') for column_key in manifest['columns']
+        }
+    }
+
+
+@timeit
+def get_compiled_imd_dataset():
+    global compiled_imd_dataset
+
+    if compiled_imd_dataset is None:
+        compiled_imd_dataset = load_compiled_imd_dataset()
+
+    return compiled_imd_dataset
+
+
+@timeit
+def get_zones_count():
+    return get_compiled_imd_dataset()['manifest']['zones']
+
+
+@timeit
+def get_zones_column(country, column_name):
+    return get_compiled_imd_dataset()['columns'][country + '.' + column_name]
+
+
+@timeit
+def decode_zone_polygons(zone_indexes):
+    return decode_geometries(get_compiled_imd_dataset(), zone_indexes)
+
+
+@timeit
+def get_compiled_rank_layer(rank_type, min_decile, lod=0):
+    layer_key = rank_type + '.' + str(min_decile) + '.' + str(lod)
+
+    if layer_key not in compiled_rank_layers:
+        # Make sure the dataset (and so its layers) has been compiled before we try to open any of them
+        get_compiled_imd_dataset()
+        compiled_rank_layers[layer_key] = load_geometry_array(compiled_imd_dataset_dir + 'layers/' + layer_key)
+
+    return compiled_rank_layers[layer_key]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    compile_imd_dataset(force='--force' in sys.argv)
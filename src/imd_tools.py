@@ -1,115 +1,206 @@
 #!/usr/bin/env python3
-import itertools
 import logging
 
-import fiona
-from shapely.geometry import MultiPolygon, shape, Polygon
-from shapely.ops import transform
-
-from run_server import static_cache, transient_cache
-from src.multi_polygons import filter_multipoly_by_bounding_box
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.strtree import STRtree
+
+from run_server import transient_cache
+from src.imd_dataset import rank_type_properties, scotland_decile_min_ranks, get_compiled_imd_dataset, \
+    get_zones_column, decode_zone_polygons, decode_geometries, get_compiled_rank_layer
+from src.level_of_detail import get_lod_tolerance
+from src.projections import reproject_geometries
+from src.tiled_geometry import tiled_intersection
 from src.utils import timeit
 
-rank_type_properties = {
-    'deprivation': {'england': 'IMDDec0', 'scotland': 'Decile'},
-    'income': {'england': 'IncDec', 'scotland': 'IncRank'},
-    'crime': {'england': 'CriDec', 'scotland': 'CrimeRank'},
-    'health': {'england': 'HDDDec', 'scotland': 'HlthRank'},
-    'education': {'england': 'EduDec', 'scotland': 'EduRank'},
-    'services': {'england': 'GBDec', 'scotland': 'GAccRank'},
-    'environment': {'england': 'EnvDec', 'scotland': 'HouseRank'}
-}
+# Spatial indexes over every UK data zone and every dissolved rank layer, built on first use and then kept for the
+# lifetime of the process
+uk_zones_index = None
+rank_layers_indexes = {}
 
 
 # This file assumes all input shapefiles are already in WGS84 projection.
 # If we wish to use a new source dataset, to avoid needing to do any reprojection in this code, it is much more
 # efficient to reproject the source dataset first. For example, to reproject a UK shapefile to WGS84, run:
 # ogr2ogr -f "ESRI Shapefile" output-wgs84.shp input-ukproj.shp -s_srs EPSG:27700 -t_srs EPSG:4326
+# The shapefiles are then compiled into a memory-mapped format by src/imd_dataset.py, which is what we read here.
 
 @timeit
 def get_polygon_for_least_deprived_zones_england(rank_type, min_rank_value):
     # Metadata as per https://www.arcgis.com/home/item.html?id=5e1c399d787e48c0902e5fe4fc1ccfe3
-    filtered_zones_polygons = []
-    with fiona.open('datasets/uk/IMD_2019_WGS.shp') as allZones:
-        # logging.debug("Total IMD data zones: " + str(len(allZones)))
-
-        for singleZone in allZones:
-            if singleZone['properties'][
-                rank_type_properties[rank_type]['england']
-            ] >= min_rank_value:
-                filtered_zones_polygons.append(shape(singleZone['geometry']))
+    zones_values = get_zones_column('england', rank_type_properties[rank_type]['england'])
 
-    return MultiPolygon(filtered_zones_polygons)
+    # Zones from the other country have NaN values here, so are never matched
+    return MultiPolygon(list(decode_zone_polygons(np.flatnonzero(zones_values >= min_rank_value))))
 
 
 @timeit
 def get_polygon_for_least_deprived_zones_scotland(rank_type, min_rank_value):
-    filtered_zones_polygons = []
-    with fiona.open('datasets/uk/SG_SIMD_2016_WGS.shp') as allZones:
-        # logging.debug("Total SIMD data zones: " + str(len(allZones)))
-
-        for singleZone in allZones:
-            # All of the other comparison properties in the Scotland dataset are
-            # actually Ranks, not Deciles - the shapefile doesn't contain Decile values for all
-            # the other specific values, grrrr. So, this is a manual mapping of Decile -> Rank,
-            # as per the SIMD16-Rank-Decile-Mapping-00504608.xlsx dataset info spreadsheet
-            if rank_type != 'deprivation':
-                if min_rank_value == 2:
-                    min_rank_value = 698
-                if min_rank_value == 3:
-                    min_rank_value = 1396
-                if min_rank_value == 4:
-                    min_rank_value = 2093
-                if min_rank_value == 5:
-                    min_rank_value = 2791
-                if min_rank_value == 6:
-                    min_rank_value = 3489
-                if min_rank_value == 7:
-                    min_rank_value = 4186
-                if min_rank_value == 8:
-                    min_rank_value = 4884
-                if min_rank_value == 9:
-                    min_rank_value = 5581
-                if min_rank_value == 10:
-                    min_rank_value = 6279
-
-            if singleZone['properties'][
-                rank_type_properties[rank_type]['scotland']
-            ] >= min_rank_value:
-                filtered_zones_polygons.append(shape(singleZone['geometry']))
-
-    return MultiPolygon(filtered_zones_polygons)
-
-
-@timeit
-@static_cache.cached()
+    # All of the other comparison properties in the Scotland dataset are
+    # actually Ranks, not Deciles - the shapefile doesn't contain Decile values for all
+    # the other specific values, grrrr. So, this is a manual mapping of Decile -> Rank,
+    # as per the SIMD16-Rank-Decile-Mapping-00504608.xlsx dataset info spreadsheet
+    if rank_type != 'deprivation' and 2 <= min_rank_value <= 10:
+        min_rank_value = scotland_decile_min_ranks[min_rank_value - 2]
+
+    zones_values = get_zones_column('scotland', rank_type_properties[rank_type]['scotland'])
+
+    return MultiPolygon(list(decode_zone_polygons(np.flatnonzero(zones_values >= min_rank_value))))
+
+
+@timeit
 def get_polygon_for_least_deprived_zones_uk(rank_type, min_rank_value):
     # Hah, guess you aren't a Scottish Independence voter ;)
-    return MultiPolygon(itertools.chain(
-        get_polygon_for_least_deprived_zones_scotland(rank_type, min_rank_value),
-        get_polygon_for_least_deprived_zones_england(rank_type, min_rank_value)
-    ))
+    # This is precomputed for both countries by the dataset compile step, already dissolved into as few parts as
+    # possible, so there's no need to combine and cache it at runtime any more
+    return MultiPolygon(list(get_indexed_geometries(
+        get_rank_layer_index(rank_type, min_rank_value),
+        np.arange(len(get_compiled_rank_layer(rank_type, min_rank_value)['bounds']))
+    )))
 
 
 @timeit
-@transient_cache.cached()
-def reproject_multipolygon(multipoly, proj_partial):
-    # proj_uk_to_wgs84 = partial(pyproj.transform, pyproj.Proj(init='epsg:27700'), pyproj.Proj(init='epsg:4326'))
+def build_geometry_array_index(geometry_array):
+    geometries_bounds = np.asarray(geometry_array['bounds'])
+
+    # The tree only needs each geometry's envelope, so nothing is decoded until a query actually needs it
+    return {
+        'geometry_array': geometry_array,
+        'geometries': np.full(len(geometries_bounds), None, dtype=object),
+        'tree': STRtree(shapely.box(
+            geometries_bounds[:, 0], geometries_bounds[:, 1], geometries_bounds[:, 2], geometries_bounds[:, 3]
+        ))
+    }
 
-    reproj_polygons_list = []
-    total_polygons = len(multipoly.geoms)
 
-    for single_polygon in multipoly:
-        logging.debug("Reprojecting polygon " + str(len(reproj_polygons_list)) + " out of " + str(total_polygons))
-        reproj_polygons_list.append(reproject_single_polygon(single_polygon, proj_partial))
+@timeit
+def get_indexed_geometries(geometry_index, geometry_indexes):
+    indexed_geometries = geometry_index['geometries']
+
+    # Decode any geometries we haven't needed before from the compiled WKB, and keep them for subsequent queries
+    undecoded_indexes = geometry_indexes[shapely.is_missing(indexed_geometries[geometry_indexes])]
+    if len(undecoded_indexes) > 0:
+        indexed_geometries[undecoded_indexes] = decode_geometries(geometry_index['geometry_array'], undecoded_indexes)
 
-    return MultiPolygon(reproj_polygons_list)
+    return indexed_geometries[geometry_indexes]
 
 
 @timeit
-@transient_cache.cached()
-def reproject_single_polygon(single_polygon, proj_partial):
-    return transform(proj_partial, single_polygon)
+def build_uk_zones_index():
+    imd_dataset = get_compiled_imd_dataset()
+
+    logging.info("Building spatial index over UK data zones: " + str(len(imd_dataset['bounds'])))
+
+    return {
+        **build_geometry_array_index(imd_dataset),
+        'centroids_x': imd_dataset['centroids'][:, 0],
+        'centroids_y': imd_dataset['centroids'][:, 1],
+        'deciles': imd_dataset['deciles'],
+        # Every zone's deciles side by side, one column per rank type, so weighted scores are a single matrix product
+        'deciles_matrix': np.column_stack([
+            imd_dataset['deciles'][rank_type] for rank_type in rank_type_properties
+        ]).astype(np.float64)
+    }
+
+
+@timeit
+def get_uk_zones_index():
+    global uk_zones_index
+
+    if uk_zones_index is None:
+        uk_zones_index = build_uk_zones_index()
+
+    return uk_zones_index
+
+
+@timeit
+def query_uk_zone_indexes_in_bounds(bounds_polygon):
+    zones_index = get_uk_zones_index()
+
+    # Zones are assigned to the bounds by centroid, so each zone is counted in exactly one of any adjacent bounds
+    candidate_indexes = zones_index['tree'].query(bounds_polygon)
+
+    shapely.prepare(bounds_polygon)
+    return candidate_indexes[shapely.contains_xy(
+        bounds_polygon, zones_index['centroids_x'][candidate_indexes], zones_index['centroids_y'][candidate_indexes]
+    )]
+
+
+@timeit
+def get_rank_weights_vector(rank_weights):
+    # One weight per rank type, in the same order as the columns of the deciles matrix, normalised to sum to 1.
+    # Negative weights are ignored, and if nothing is weighted every rank type counts equally.
+    weights = np.array([
+        max(float(rank_weights.get(rank_type) or 0), 0) for rank_type in rank_type_properties
+    ], dtype=np.float64)
+
+    if weights.sum() == 0:
+        weights[:] = 1
+
+    return weights / weights.sum()
+
+
+@timeit
+def get_zones_weighted_scores(zone_indexes, rank_weights):
+    # The weighted mean of each zone's deciles, so scores are on the same 1-10 scale as the min rank filters. This
+    # is only array arithmetic over the precomputed deciles, with no geometry involved, so it's cheap enough to redo
+    # for every change of weights.
+    return get_uk_zones_index()['deciles_matrix'][zone_indexes] @ get_rank_weights_vector(rank_weights)
+
+
+@timeit
+def get_uk_zones_geometries(zone_indexes, lod=0):
+    zone_polygons = get_indexed_geometries(get_uk_zones_index(), zone_indexes)
+
+    if lod > 0:
+        zone_polygons = shapely.simplify(zone_polygons, get_lod_tolerance(lod), preserve_topology=True)
+
+    return zone_polygons
+
+
+@timeit
+def get_rank_layer_index(rank_type, min_rank_value, lod=0):
+    layer_key = rank_type + '.' + str(min_rank_value) + '.' + str(lod)
+
+    if layer_key not in rank_layers_indexes:
+        rank_layers_indexes[layer_key] = build_geometry_array_index(
+            get_compiled_rank_layer(rank_type, min_rank_value, lod))
+
+    return rank_layers_indexes[layer_key]
+
+
+@timeit
+def clip_rank_layer_to_bounds(bounds_polygon, rank_type, min_rank_value, lod=0):
+    layer_index = get_rank_layer_index(rank_type, min_rank_value, lod)
+
+    # The layer parts are already dissolved and disjoint, so clipping each one to the bounds is all that's needed -
+    # no union of the results
+    layer_parts = get_indexed_geometries(layer_index, layer_index['tree'].query(bounds_polygon))
+    clipped_parts = shapely.get_parts(shapely.intersection(layer_parts, bounds_polygon))
+    clipped_polygons = clipped_parts[shapely.get_type_id(clipped_parts) == shapely.GeometryType.POLYGON]
+
+    logging.debug("Rank layer " + rank_type + "." + str(min_rank_value) + " at lod " + str(lod) +
+                  " parts within bounds envelope: " + str(len(layer_parts)) +
+                  " - clipped polygons: " + str(len(clipped_polygons)))
+
+    if len(clipped_polygons) == 0:
+        return []
+
+    return MultiPolygon(list(clipped_polygons))
+
+
+@timeit
+def reproject_multipolygon(multipoly, from_crs, to_crs):
+    # e.g. reproject_multipolygon(uk_multipoly, uk_national_grid_crs, wgs84_crs)
+    # Every polygon's coordinates are transformed together in one vectorised call, which is quick enough that it's
+    # cheaper to recompute than to build a cache key for
+    return MultiPolygon(list(reproject_geometries(shapely.get_parts(multipoly), from_crs, to_crs)))
+
+
+@timeit
+def reproject_single_polygon(single_polygon, from_crs, to_crs):
+    return reproject_geometries(single_polygon, from_crs, to_crs)
 
 
 @timeit
@@ -121,22 +212,87 @@ def get_world_min_deprivation_rank_wgs84_multipoly(rank_type, min_rank_value):
 
 @timeit
 @transient_cache.cached()
-def get_bounded_min_rank_multipoly(input_bounds, rank_type, min_rank_value):
-    min_rank_poly = get_world_min_deprivation_rank_wgs84_multipoly(rank_type, min_rank_value)
-
+def get_bounded_min_rank_multipoly(input_bounds, rank_type, min_rank_value, lod=0):
     input_multipoly_bounds = Polygon.from_bounds(*input_bounds).buffer(0.001)
 
-    return filter_multipoly_by_bounding_box(min_rank_poly,
-                                            input_multipoly_bounds)
+    return clip_rank_layer_to_bounds(input_multipoly_bounds, rank_type, min_rank_value, lod)
 
 
 @timeit
-def intersect_multipoly_by_min_rank(input_multipoly, rank_type, min_rank_value):
-    min_rank_poly = get_bounded_min_rank_multipoly(input_multipoly.bounds, rank_type, min_rank_value)
+def intersect_multipoly_by_min_rank(input_multipoly, rank_type, min_rank_value, lod=0):
+    layer_index = get_rank_layer_index(rank_type, min_rank_value, lod)
+
+    # The layer's parts are looked up from the bounds of what's left of the input, rather than the area the search
+    # started with, so as each filter shrinks the input the later filters touch fewer parts. The parts are already
+    # dissolved, so they're intersected with the input directly, without clipping them to the bounds first.
+    input_bounds_polygon = Polygon.from_bounds(*input_multipoly.bounds)
+    layer_parts = get_indexed_geometries(layer_index, layer_index['tree'].query(input_bounds_polygon))
+
+    logging.debug("Rank layer " + rank_type + "." + str(min_rank_value) + " at lod " + str(lod) +
+                  " parts within input bounds " + str(input_multipoly.bounds) + ": " + str(len(layer_parts)))
+
+    if len(layer_parts) == 0:
+        # Outside the UK there's no IMD data to filter by at all, so the rank filters can't rule anything out there.
+        # Anywhere with data zones, no layer parts means no zone passes this filter, so nothing is left.
+        if len(get_uk_zones_index()['tree'].query(input_bounds_polygon)) == 0:
+            logging.warning("No IMD data zones under the input, so not filtering it by rank")
+            return input_multipoly
+
+        logging.info("No zones under the input pass this rank filter, so nothing is left")
+        return MultiPolygon()
+
+    return get_polygonal_parts(tiled_intersection(MultiPolygon(list(layer_parts)), input_multipoly))
+
+
+@timeit
+def plan_min_rank_filters(input_bounds, min_rank_values, lod=0):
+    zones_index = get_uk_zones_index()
+    bounds_polygon = Polygon.from_bounds(*input_bounds).buffer(0.001)
+
+    # Estimate each filter's selectivity from the precomputed zone deciles: the fraction of zones in the area (by
+    # centroid) which pass it. Its cost is the number of its dissolved rank layer parts the area touches.
+    zone_indexes = query_uk_zone_indexes_in_bounds(bounds_polygon)
+
+    filter_plans = []
+    for rank_type, min_rank_value in min_rank_values.items():
+        passing_zones = np.count_nonzero(zones_index['deciles'][rank_type][zone_indexes] >= min_rank_value)
+        selectivity = passing_zones / len(zone_indexes) if len(zone_indexes) > 0 else 1.0
+        cost = len(get_rank_layer_index(rank_type, min_rank_value, lod)['tree'].query(bounds_polygon))
+
+        filter_plans.append((selectivity, cost, rank_type, min_rank_value))
+
+    filter_plans.sort()
+
+    logging.info("Planned rank filter order for " + str(len(zone_indexes)) + " zones: " + ', '.join(
+        "%s >= %d (%1.0f%% pass, %d layer parts)" % (rank_type, min_rank_value, selectivity * 100, cost)
+        for selectivity, cost, rank_type, min_rank_value in filter_plans
+    ))
+
+    # Every threshold ANDed over every zone which might touch the area, in one pass over the deciles. The clips can
+    # only leave area inside a zone which passes all of them, so when none does they needn't be run at all. With no
+    # zones under the area at all, e.g. outside the UK, the filters can't rule anything out.
+    touching_zone_indexes = zones_index['tree'].query(bounds_polygon)
+    zones_pass_all = np.ones(len(touching_zone_indexes), dtype=bool)
+    for rank_type, min_rank_value in min_rank_values.items():
+        zones_pass_all &= zones_index['deciles'][rank_type][touching_zone_indexes] >= min_rank_value
+
+    rules_out_everything = len(touching_zone_indexes) > 0 and not zones_pass_all.any()
+    if rules_out_everything:
+        logging.info("No zones under the area pass every rank filter, so nothing is left")
+
+    planned_filters = [(rank_type, min_rank_value) for selectivity, cost, rank_type, min_rank_value in filter_plans]
+
+    return planned_filters, rules_out_everything
+
+
+@timeit
+def get_polygonal_parts(geometry):
+    # Zones which only touch the input leave behind lines or points in an intersection, we only want the areas
+    geometry_parts = shapely.get_parts(geometry)
+    polygons = geometry_parts[shapely.get_type_id(geometry_parts) == shapely.GeometryType.POLYGON]
+
+    if len(polygons) == 1:
+        return polygons[0]
 
-    if isinstance(min_rank_poly, list):
-        logging.warning("min_rank_poly is list, not attempting to intersect it as presumably this is empty?")
-    else:
-        input_multipoly = min_rank_poly.intersection(input_multipoly)
+    return MultiPolygon(list(polygons))
 
-    return input_multipoly
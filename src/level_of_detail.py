@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+from src.utils import timeit, InvalidRequestError
+
+# Simplification tolerance (in degrees) for each level of detail, finest first: roughly 1m, 10m, 40m and 150m in the
+# UK. The IMD rank layers are compiled at every level, and isochrones are simplified to the level of their search.
+lod_tolerances = [0.00001, 0.0001, 0.0004, 0.0015]
+
+# Roughly how many distinct points we need across the width of a search's extent; a city-wide search shown on a
+# typical screen can't display detail finer than its extent divided by this, so there's no point computing it
+lod_target_resolution = 2000
+
+
+@timeit
+def get_lod_for_bounds(bounds):
+    min_x, min_y, max_x, max_y = bounds
+    required_precision = max(max_x - min_x, max_y - min_y) / lod_target_resolution
+
+    # The coarsest level which is still at least as precise as the search extent needs
+    lod = 0
+    for level, tolerance in enumerate(lod_tolerances):
+        if tolerance <= required_precision:
+            lod = level
+
+    return lod
+
+
+@timeit
+def resolve_lod(lod, bounds):
+    # An explicit lod (e.g. from the request) wins, otherwise it's picked from the extent being searched
+    if lod is None or lod == '' or lod == 'auto':
+        return get_lod_for_bounds(bounds)
+
+    try:
+        lod = int(lod)
+    except (TypeError, ValueError):
+        raise InvalidRequestError("Invalid level of detail: " + str(lod))
+
+    return min(max(lod, 0), len(lod_tolerances) - 1)
+
+
+@timeit
+def get_lod_tolerance(lod):
+    return lod_tolerances[lod]
@@ -5,27 +5,35 @@ import time
 import webbrowser
 
 import jinja2
-from backoff import on_exception, expo
 from mapbox import Geocoder
-from ratelimit import RateLimitException, limits
+from requests import Request
 from shapely.geometry import Polygon
 
 from run_server import requests_cache, transient_cache
+from src.rate_limiter import rate_limited
 from src.utils import timeit
 
 
 @timeit
-@on_exception(expo, RateLimitException, max_tries=10)  # Backoff exponentially and retry if rate limit hit
-@limits(calls=300, period=60)  # Mapbox allow 300 (!) requests per minute
 def call_mapbox_api(url):
-    response = requests_cache.get(url)
+    # A response which is already in the HTTP cache is returned without waiting on the rate limiter, as it doesn't
+    # make an API call at all
+    mapbox_request = requests_cache.prepare_request(Request('GET', url))
+    cached_response, cached_time = requests_cache.cache.get_response_and_time(
+        requests_cache.cache.create_key(mapbox_request))
 
-    if response.from_cache:
+    if cached_response is not None:
         logging.debug('Cache HIT - this response was fetched from the local SQLite DB without a new API call')
-    else:
-        logging.warning('Cache MISS - this response required a new API call')
+        return cached_response
 
-    return response
+    logging.warning('Cache MISS - this response required a new API call')
+    return send_mapbox_request(url)
+
+
+@timeit
+@rate_limited('mapbox')  # Shared token bucket across all worker processes, see src/rate_limiter.py
+def send_mapbox_request(url):
+    return requests_cache.get(url)
 
 
 @timeit
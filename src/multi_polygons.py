@@ -1,19 +1,27 @@
 #!/usr/bin/env python3
-import json
 import logging
-from functools import partial
+import time
 
-import pyproj
+import numpy as np
+import shapely
 import shapely.ops
-from shapely.affinity import scale
-from shapely.geometry import Point, MultiPoint, Polygon, LineString, mapping, MultiPolygon
+from scipy.spatial import cKDTree
+from shapely.geometry import Point, MultiPoint, Polygon, LineString, MultiPolygon
 
 from run_server import transient_cache
+from src.geometry_keys import geometry_key_fn
+from src.polygon_predicates import get_polygons_array, mask_centroids_within, mask_representative_points_within, \
+    mask_min_area_square_miles
+from src.projections import get_circle_for_point, reproject_geometries
+from src.tiled_geometry import tiled_union
 from src.utils import timeit
 
+# Only the expensive GEOS operations here are cached, keyed by geometry fingerprints (see src/geometry_keys.py).
+# Cheap functions, e.g. buffering a single point or the vectorised filters, are deliberately left uncached, as a
+# cache lookup (building the key, an SQLite read and unpickling the result) would cost more than recomputing.
+
 
 @timeit
-@transient_cache.cached()
 def get_bounding_square_for_point(target_lng_lat, bounding_box_radius_miles):
     if bounding_box_radius_miles == 0:
         return None
@@ -23,57 +31,39 @@ def get_bounding_square_for_point(target_lng_lat, bounding_box_radius_miles):
 
 
 @timeit
-@transient_cache.cached()
 def get_bounding_circle_for_point(target_lng_lat, bounding_box_radius_miles):
     if bounding_box_radius_miles == 0:
         return None
 
-    # This is an ugly and inaccurate approximation of miles->degrees to avoid implementing a proper projection
-    # It's good enough for now, and much easier than proper projection
-    buffer_distance_degrees = bounding_box_radius_miles / 50
-    target_bounding_circle = Point(target_lng_lat).buffer(buffer_distance_degrees, 6)
-
-    # Scale the bounding circle to make up for the UK projection issue
-    target_bounding_circle = scale(target_bounding_circle, xfact=1.0, yfact=0.65)
-
-    return target_bounding_circle
+    # Drawn in an equal-area projection centred on the target, so the radius is in true miles in every direction
+    return get_circle_for_point(target_lng_lat, bounding_box_radius_miles)
 
 
 @timeit
-@transient_cache.cached()
 def filter_uk_multipoly_by_target_radius(multi_polygon_to_filter, target_lng_lat, max_distance_limit_miles):
     # For convenience, allow passing in a List of Polygons, or even a List of coordinate lists; convert to MultiPolygon
     multi_polygon_to_filter = convert_list_to_refined_multipoly(multi_polygon_to_filter)
 
-    wgs84_to_uk_project = partial(pyproj.transform, pyproj.Proj(init='epsg:4326'), pyproj.Proj(init='epsg:27700'))
-
+    # The bounding circle is already accurate in WGS84, the same CRS as the polygons, so no reprojection is needed
     target_bounding_circle = get_bounding_circle_for_point(target_lng_lat, max_distance_limit_miles)
-    target_bounding_circle_uk_project = reproject_polygon(wgs84_to_uk_project, target_bounding_circle)
 
-    filtered_multipolygon = []
-    for single_polygon in multi_polygon_to_filter:
-        if target_bounding_circle_uk_project.contains(single_polygon.centroid):
-            filtered_multipolygon.append(single_polygon)
+    polygons_array = get_polygons_array(multi_polygon_to_filter)
 
-    return filtered_multipolygon
+    return list(polygons_array[mask_centroids_within(polygons_array, target_bounding_circle)])
 
 
 @timeit
-@transient_cache.cached()
 def filter_multipoly_by_bounding_box(multi_polygon_to_filter, wgs84_bounding_polygon):
     # For convenience, allow passing in a List of Polygons, or even a List of coordinate lists; convert to MultiPolygon
     multi_polygon_to_filter = convert_list_to_refined_multipoly(multi_polygon_to_filter)
 
-    filtered_multipolygon = []
-    for single_polygon in multi_polygon_to_filter:
-        if wgs84_bounding_polygon.contains(single_polygon.centroid):
-            filtered_multipolygon.append(single_polygon)
+    polygons_array = get_polygons_array(multi_polygon_to_filter)
+    filtered_multipolygon = list(polygons_array[mask_centroids_within(polygons_array, wgs84_bounding_polygon)])
 
     return convert_list_to_refined_multipoly(filtered_multipolygon)
 
 
 @timeit
-@transient_cache.cached()
 def simplify_multi(multi_polygon_to_simplify, simplification_factor):
     # For convenience, allow passing in a List of Polygons, or even a List of coordinate lists; convert to MultiPolygon
     multi_polygon_to_simplify = convert_list_to_refined_multipoly(multi_polygon_to_simplify)
@@ -93,90 +83,124 @@ def simplify_multi(multi_polygon_to_simplify, simplification_factor):
 
 
 @timeit
-@transient_cache.cached()
+@transient_cache.cached(key_fn=geometry_key_fn)
 def join_multi_to_single_poly(multi_polygon_to_join):
     # logging.debug("join_multi_to_single_poly called with " + str(type(multi_polygon_to_join)))
 
     # For convenience, allow passing in a List of Polygons, or even a List of coordinate lists; convert to MultiPolygon
     multi_polygon_to_join = convert_list_to_refined_multipoly(multi_polygon_to_join)
 
-    # Recursively join all polygons in this multipolygon with lines until it's no longer a multipolygon
     # If the object doesn't have a "geoms" property, it must already be a single Polygon object anyway
-    while hasattr(multi_polygon_to_join, 'geoms') and len(multi_polygon_to_join) > 0:
-        multi_polygon_to_join = join_multi_with_connecting_lines(multi_polygon_to_join)
-
-    return multi_polygon_to_join
+    if not hasattr(multi_polygon_to_join, 'geoms') or len(multi_polygon_to_join.geoms) == 0:
+        return multi_polygon_to_join
 
+    join_start_time = time.time()
 
-@timeit
-@transient_cache.cached()
-def join_multi_with_connecting_lines(multi_polygon_to_join):
-    # logging.debug("join_multi_with_connecting_lines called with " + str(type(multi_polygon_to_join)))
-
-    if hasattr(multi_polygon_to_join, 'geoms'):
-        previous_length = len(multi_polygon_to_join.geoms)
-    else:
-        previous_length = 1
-
-    # First, try simply unioning it, as it's possible this may be a multipoly which doesn't need any more loines
+    # First, try simply unioning it, as it's possible this may be a multipoly which doesn't need any lines
     multi_polygon_to_join = union_polygons(multi_polygon_to_join)
+    fragments_count = len(multi_polygon_to_join.geoms) if hasattr(multi_polygon_to_join, 'geoms') else 1
 
-    connecting_lines_array = []
-    if hasattr(multi_polygon_to_join, 'geoms'):
-        connecting_lines_array = get_connecting_lines_for_multi(multi_polygon_to_join)
-        multi_polygon_to_join = union_polygons([multi_polygon_to_join, *connecting_lines_array])
-        multi_polygon_to_join = union_polygons(multi_polygon_to_join)
-
-    if hasattr(multi_polygon_to_join, 'geoms'):
-        new_length = len(multi_polygon_to_join.geoms)
-    else:
-        new_length = 1
+    # Join all of the fragments with connecting lines along a minimum spanning tree, all in a single union. Very
+    # occasionally a corridor doesn't quite overlap a fragment after the union, so allow a couple of extra passes
+    join_passes = 0
+    while hasattr(multi_polygon_to_join, 'geoms') and len(multi_polygon_to_join.geoms) > 1 and join_passes < 3:
+        connecting_lines = get_minimum_spanning_connecting_lines(get_polygons_array(multi_polygon_to_join))
+        multi_polygon_to_join = union_polygons([multi_polygon_to_join, *connecting_lines])
+        join_passes += 1
 
-    logging.debug("Length of MultiPolygon before join: " + str(previous_length) + " - after: " + str(new_length))
+    remaining_count = len(multi_polygon_to_join.geoms) if hasattr(multi_polygon_to_join, 'geoms') else 1
 
-    if new_length == previous_length:
-        logging.warning("Connecting lines: ")
-        for connecting_line in connecting_lines_array:
-            logging.warning(json.dumps(mapping(connecting_line)))
-        logging.warning("Result MultiPolygon: " + json.dumps(mapping(multi_polygon_to_join)))
+    logging.info("Joined %1.0f fragments into %1.0f in %1.0f passes, time: %1.0f ms" % (
+        fragments_count, remaining_count, join_passes, (time.time() - join_start_time) * 1000
+    ))
 
-        logging.warning("Joining MultiPolygon with connecting lines failed to decrease length of geoms!")
-
-        for single_geom in multi_polygon_to_join.geoms:
-            logging.warning("Geom length: " + str(single_geom.area))
+    if remaining_count > 1:
+        logging.warning("Joining MultiPolygon with connecting lines failed to reduce it to a single Polygon!")
 
     return multi_polygon_to_join
 
 
 @timeit
-@transient_cache.cached()
-def get_connecting_lines_for_multi(multi_polygon_to_join):
-    # logging.debug("get_connecting_lines_for_multi called with " + str(type(multi_polygon_to_join)))
-
-    logging.debug("get_connecting_lines_for_multi multi_polygon_to_join length: " + str(len(multi_polygon_to_join)))
-
-    connecting_line_polygons = []
-    rep_points_list = [polygon.representative_point() for polygon in multi_polygon_to_join]
-
-    logging.debug("get_connecting_lines_for_multi rep_points_list length: " + str(len(rep_points_list)))
-    logging.debug(rep_points_list)
-
-    # For each polygon in this multipolygon, generate a line which connects it to the nearest /other/ polygon
-    # by both of their representative points (for speed), and add that line to the above array
-    for single_rep in rep_points_list:
-        rep_points_list.remove(single_rep)
-
-        single_connecting_line_polygon = get_line_connecting_single_point_to_others(single_rep, rep_points_list)
-        connecting_line_polygons.append(single_connecting_line_polygon)
-
-    logging.debug("get_connecting_lines_for_multi returning connecting_line_polygons with length: " + str(
-        len(connecting_line_polygons)))
-
-    return connecting_line_polygons
+def get_minimum_spanning_connecting_lines(fragments_array):
+    # Every boundary vertex of every fragment, split per fragment
+    vertices, vertices_fragment = shapely.get_coordinates(fragments_array, return_index=True)
+    fragments_vertices = np.split(vertices, np.flatnonzero(np.diff(vertices_fragment)) + 1)
+    fragments_bounds = shapely.bounds(fragments_array)
+    fragments_count = len(fragments_array)
+
+    # Union-find over the fragments, so we know which component of the spanning tree each fragment is in
+    fragments_parent = list(range(fragments_count))
+
+    def find_root(fragment_index):
+        while fragments_parent[fragment_index] != fragment_index:
+            fragments_parent[fragment_index] = fragments_parent[fragments_parent[fragment_index]]
+            fragment_index = fragments_parent[fragment_index]
+        return fragment_index
+
+    # Boruvka's algorithm: each round, every component is joined to its nearest other component by the shortest line
+    # between their boundary vertices, which at least halves the number of components each round
+    spanning_edges = []
+    while len(spanning_edges) < fragments_count - 1:
+        fragments_root = np.array([find_root(fragment_index) for fragment_index in range(fragments_count)])
+        component_edges = []
+
+        for component_root in np.unique(fragments_root):
+            component_fragments = np.flatnonzero(fragments_root == component_root)
+            component_vertices = np.concatenate([fragments_vertices[f] for f in component_fragments])
+            component_tree = cKDTree(component_vertices)
+            component_bounds = np.concatenate([
+                fragments_bounds[component_fragments, :2].min(axis=0),
+                fragments_bounds[component_fragments, 2:].max(axis=0)
+            ])
+
+            # The distance between bounding boxes is a lower bound on the distance between vertices, so we check the
+            # other fragments nearest first, and stop as soon as no remaining fragment could be any closer
+            bounds_gap_x = np.maximum(0, np.maximum(fragments_bounds[:, 0] - component_bounds[2],
+                                                    component_bounds[0] - fragments_bounds[:, 2]))
+            bounds_gap_y = np.maximum(0, np.maximum(fragments_bounds[:, 1] - component_bounds[3],
+                                                    component_bounds[1] - fragments_bounds[:, 3]))
+            bounds_distances = np.hypot(bounds_gap_x, bounds_gap_y)
+            bounds_distances[component_fragments] = np.inf
+
+            nearest_distance, nearest_edge = np.inf, None
+            for other_fragment in np.argsort(bounds_distances):
+                if bounds_distances[other_fragment] >= nearest_distance:
+                    break
+
+                component_distances, component_nearest = component_tree.query(
+                    fragments_vertices[other_fragment], distance_upper_bound=nearest_distance)
+                nearest_vertex = np.argmin(component_distances)
+
+                if component_distances[nearest_vertex] < nearest_distance:
+                    nearest_distance = component_distances[nearest_vertex]
+                    nearest_edge = (
+                        component_root,
+                        other_fragment,
+                        component_vertices[component_nearest[nearest_vertex]],
+                        fragments_vertices[other_fragment][nearest_vertex]
+                    )
+
+            component_edges.append(nearest_edge)
+
+        for component_root, other_fragment, from_vertex, to_vertex in component_edges:
+            from_root = find_root(component_root)
+            to_root = find_root(other_fragment)
+
+            # Two components can pick each other (or equally short edges), so skip any edge which would form a cycle
+            if from_root != to_root:
+                fragments_parent[from_root] = to_root
+                spanning_edges.append((from_vertex, to_vertex))
+
+    logging.debug("Minimum spanning tree connecting %1.0f fragments using %1.0f boundary vertices" % (
+        fragments_count, len(vertices)
+    ))
+
+    return [
+        get_connecting_line_polygon(Point(from_vertex), Point(to_vertex)) for from_vertex, to_vertex in spanning_edges
+    ]
 
 
 @timeit
-@transient_cache.cached()
 def get_nearest_points_between_polygon_and_others(single_polygon, other_polygons):
     this_polygon_multipoint = MultiPoint(single_polygon.exterior.coords)
 
@@ -187,7 +211,6 @@ def get_nearest_points_between_polygon_and_others(single_polygon, other_polygons
 
 
 @timeit
-@transient_cache.cached()
 def get_nearest_polygon_from_list(single_polygon, other_polygons):
     other_centroids_multipoint = MultiPoint([o.centroid for o in other_polygons])
 
@@ -201,7 +224,6 @@ def get_nearest_polygon_from_list(single_polygon, other_polygons):
 
 
 @timeit
-@transient_cache.cached()
 def get_multipoint_for_all_polygons_coords(polygons_list):
     coords_list = []
     if type(polygons_list) is Polygon:
@@ -214,7 +236,7 @@ def get_multipoint_for_all_polygons_coords(polygons_list):
 
 
 @timeit
-@transient_cache.cached()
+@transient_cache.cached(key_fn=geometry_key_fn)
 def convert_list_to_refined_multipoly(multi_polygon_list):
     # logging.debug("convert_list_to_refined_multipoly called with " + str(type(multi_polygon_list)))
 
@@ -245,12 +267,8 @@ def filter_multipoly_by_polygon(multi_polygon_to_filter, filter_polygon):
     if hasattr(multi_polygon_to_filter, 'geoms'):
         logging.debug("Length of MultiPolygon before filter: " + str(len(multi_polygon_to_filter.geoms)))
 
-        filtered_polygons_list = []
-        for single_polygon in multi_polygon_to_filter:
-            logging.debug(
-                "Calling contains on filter_polygon, filtered list length: " + str(len(filtered_polygons_list)))
-            if filter_polygon.contains(single_polygon.representative_point()):
-                filtered_polygons_list.append(single_polygon)
+        polygons_array = get_polygons_array(multi_polygon_to_filter)
+        filtered_polygons_list = list(polygons_array[mask_representative_points_within(polygons_array, filter_polygon)])
 
         multi_polygon_to_filter = union_polygons(filtered_polygons_list)
 
@@ -265,21 +283,15 @@ def filter_multipoly_by_polygon(multi_polygon_to_filter, filter_polygon):
 
 
 @timeit
-@transient_cache.cached()
+@transient_cache.cached(key_fn=geometry_key_fn)
 def filter_multipoly_by_min_area(multi_polygon_to_filter, min_area_miles):
     multi_polygon_to_filter = convert_list_to_refined_multipoly(multi_polygon_to_filter)
 
     if hasattr(multi_polygon_to_filter, 'geoms'):
         logging.debug("Length of MultiPolygon before area filter: " + str(len(multi_polygon_to_filter.geoms)))
 
-        filtered_polygons_list = []
-        for single_polygon in multi_polygon_to_filter:
-            if single_polygon.area > min_area_miles:
-                logging.debug(
-                    "Keeping large enough single_polygon.area = " + str("{0:.6f}".format(single_polygon.area)))
-                filtered_polygons_list.append(single_polygon)
-            else:
-                logging.debug("Excluding small single_polygon.area = " + str("{0:.6f}".format(single_polygon.area)))
+        polygons_array = get_polygons_array(multi_polygon_to_filter)
+        filtered_polygons_list = list(polygons_array[mask_min_area_square_miles(polygons_array, min_area_miles)])
 
         multi_polygon_to_filter = union_polygons(filtered_polygons_list)
 
@@ -294,7 +306,6 @@ def filter_multipoly_by_min_area(multi_polygon_to_filter, min_area_miles):
 
 
 @timeit
-@transient_cache.cached()
 def instanciate_multipolygons(polygons_list):
     if type(polygons_list) is not list:
         raise Exception("instanciate_multipolygons expected a list, was given a " + str(type(polygons_list)))
@@ -316,7 +327,7 @@ def instanciate_multipolygons(polygons_list):
 
 
 @timeit
-@transient_cache.cached()
+@transient_cache.cached(key_fn=geometry_key_fn)
 def refine_multipolygon(multipolygon, simplify_amount=0.0000001, buffer_amount=0.0000001):
     if type(multipolygon) is not MultiPolygon and type(multipolygon) is not Polygon:
         raise Exception("refine_multipolygon expected a MultiPolygon, was given a " + str(type(multipolygon)))
@@ -324,10 +335,10 @@ def refine_multipolygon(multipolygon, simplify_amount=0.0000001, buffer_amount=0
     # For each polygon in the multipolygon, buffer to remove self-intersections and simplify
 
     if type(multipolygon) is Polygon:
-        multipolygon = [multipolygon]
+        multipolygon = MultiPolygon([multipolygon])
 
     refined_polygons_list = []
-    for single_polygon in multipolygon:
+    for single_polygon in multipolygon.geoms:
         single_polygon = simplify_polygon(single_polygon, simplify_amount)
         single_polygon = buffer_polygon(single_polygon, buffer_amount)
         refined_polygons_list.append(simplify_polygon(single_polygon, simplify_amount))
@@ -338,7 +349,7 @@ def refine_multipolygon(multipolygon, simplify_amount=0.0000001, buffer_amount=0
 
 
 @timeit
-@transient_cache.cached()
+@transient_cache.cached(key_fn=geometry_key_fn)
 def refine_polygons(polygons_list, simplify_amount=0.0000001, buffer_amount=0.0000001):
     if type(polygons_list) is MultiPolygon:
         logging.warning("refine_polygons was given a MultiPolygon - simply returning")
@@ -362,18 +373,6 @@ def refine_polygons(polygons_list, simplify_amount=0.0000001, buffer_amount=0.00
     return polygons_list
 
 
-@timeit
-def get_line_connecting_single_point_to_others(single_point, other_points):
-    other_points_multipoint = MultiPoint(other_points)
-    nearest_points = get_nearest_points(single_point, other_points_multipoint)
-
-    single_connecting_line_polygon = get_connecting_line_polygon(
-        nearest_points[0], nearest_points[1]
-    )
-
-    return single_connecting_line_polygon
-
-
 @timeit
 def get_line_connecting_single_polygon_to_others(single_polygon, other_polygons):
     nearest_polygon = get_nearest_polygon_from_list(single_polygon, other_polygons)
@@ -387,10 +386,9 @@ def get_line_connecting_single_polygon_to_others(single_polygon, other_polygons)
 
 @timeit
 def get_connecting_line_polygon(point_1, point_2):
-    return simplify_polygon(buffer_polygon(
-        LineString([point_1, point_2]),
-        0.0000000001
-    ), 0.0000000001)
+    # Buffer the line by a tiny amount so it has an area which overlaps both polygons at its ends. This mustn't be
+    # simplified afterwards, or the rounded ends are lost and the line only touches the polygons it should join
+    return buffer_polygon(LineString([point_1, point_2]), 0.0000001)
 
 
 @timeit
@@ -429,7 +427,7 @@ def instanciate_polygon(coords_list):
 @timeit
 def union_polygons(multi_polygons):
     # Combine a list of polygons into either a single polygon, or a MultiPolygon if there are gaps
-    return shapely.ops.unary_union(multi_polygons)
+    return tiled_union(multi_polygons)
 
 
 @timeit
@@ -439,6 +437,6 @@ def get_nearest_points(object_1, object_2):
 
 
 @timeit
-def reproject_polygon(projection_transform, single_polygon):
+def reproject_polygon(single_polygon, from_crs, to_crs):
     # Reproject a polygon from one coordinate system to another
-    return shapely.ops.transform(projection_transform, single_polygon)
+    return reproject_geometries(single_polygon, from_crs, to_crs)
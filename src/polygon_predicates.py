@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+import shapely
+
+from src.projections import get_areas_square_miles
+from src.utils import timeit
+
+
+# These predicates work on whole arrays of polygons at once using Shapely's vectorised functions, rather than
+# calling centroid / representative_point() / area on each polygon in a Python loop. Each one returns a boolean
+# mask which lines up with the polygons array, so it can be used to index that array (or any array parallel to it).
+
+@timeit
+def get_polygons_array(multi_polygon):
+    # Split a Polygon / MultiPolygon into a flat array of its individual polygons
+    return shapely.get_parts(multi_polygon)
+
+
+@timeit
+def mask_centroids_within(polygons_array, filter_polygon):
+    centroids_coords = shapely.get_coordinates(shapely.centroid(polygons_array))
+
+    shapely.prepare(filter_polygon)
+    return shapely.contains_xy(filter_polygon, centroids_coords[:, 0], centroids_coords[:, 1])
+
+
+@timeit
+def mask_representative_points_within(polygons_array, filter_polygon):
+    points_coords = shapely.get_coordinates(shapely.point_on_surface(polygons_array))
+
+    shapely.prepare(filter_polygon)
+    return shapely.contains_xy(filter_polygon, points_coords[:, 0], points_coords[:, 1])
+
+
+@timeit
+def mask_min_area_square_miles(polygons_array, min_area_miles):
+    # Areas in degrees shrink towards the poles, so they're measured in a local equal-area projection instead
+    return get_areas_square_miles(polygons_array) > min_area_miles
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import threading
+
+import numpy as np
+import pyproj
+import shapely
+
+from src.utils import timeit
+
+wgs84_crs = 'EPSG:4326'
+uk_national_grid_crs = 'EPSG:27700'
+
+metres_per_mile = 1609.344
+square_metres_per_square_mile = metres_per_mile ** 2
+
+# Local equal-area projections are centred on the nearest tenth of a degree, so nearby targets share a Transformer.
+# Within a few hundred miles of the centre the area / distance error of a Lambert azimuthal equal-area projection is
+# well under 1%, which is plenty for search radiuses and minimum areas.
+local_projection_centre_precision = 1
+
+# Building a Transformer means parsing both CRS definitions and looking up the transformation pipeline, which is far
+# slower than actually transforming a few thousand points, so they're built once per CRS pair. Transformers aren't
+# safe to share between threads, so each thread keeps its own.
+cached_transformers = threading.local()
+
+
+@timeit
+def get_transformer(from_crs, to_crs):
+    if not hasattr(cached_transformers, 'transformers'):
+        cached_transformers.transformers = {}
+
+    transformer_key = (from_crs, to_crs)
+    if transformer_key not in cached_transformers.transformers:
+        # always_xy, so coordinates are always (lng, lat) / (easting, northing), as Shapely and GeoJSON expect
+        cached_transformers.transformers[transformer_key] = pyproj.Transformer.from_crs(
+            from_crs, to_crs, always_xy=True)
+
+    return cached_transformers.transformers[transformer_key]
+
+
+@timeit
+def reproject_geometries(geometries, from_crs, to_crs):
+    # Accepts a single geometry or an array of them; every coordinate of all of them is transformed in one call
+    transformer = get_transformer(from_crs, to_crs)
+
+    def transform_coordinates(coordinates):
+        return np.column_stack(transformer.transform(coordinates[:, 0], coordinates[:, 1]))
+
+    return shapely.transform(geometries, transform_coordinates)
+
+
+@timeit
+def get_local_equal_area_crs(centre_lng_lat):
+    centre_lng, centre_lat = np.round(centre_lng_lat, local_projection_centre_precision)
+
+    return '+proj=laea +lat_0=%s +lon_0=%s +datum=WGS84 +units=m +no_defs' % (centre_lat, centre_lng)
+
+
+@timeit
+def get_geometries_centre(geometries):
+    min_x, min_y, max_x, max_y = shapely.total_bounds(geometries)
+
+    return (min_x + max_x) / 2, (min_y + max_y) / 2
+
+
+@timeit
+def get_areas_square_miles(geometries):
+    # Areas of WGS84 geometries in square miles, measured in an equal-area projection centred on them
+    if np.size(geometries) == 0:
+        return np.zeros(0)
+
+    local_crs = get_local_equal_area_crs(get_geometries_centre(geometries))
+
+    return shapely.area(reproject_geometries(geometries, wgs84_crs, local_crs)) / square_metres_per_square_mile
+
+
+@timeit
+def get_circle_for_point(centre_lng_lat, radius_miles, quad_segs=6):
+    # A true circle on the ground, i.e. drawn in a projection centred on the point, then reprojected back to WGS84
+    local_crs = get_local_equal_area_crs(centre_lng_lat)
+    local_centre = reproject_geometries(shapely.Point(centre_lng_lat), wgs84_crs, local_crs)
+
+    return reproject_geometries(local_centre.buffer(radius_miles * metres_per_mile, quad_segs), local_crs, wgs84_crs)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import functools
+import logging
+import math
+import sqlite3
+import time
+
+from src.utils import timeit
+
+# Token buckets for each external API, stored in SQLite next to the caches so every worker process shares them
+rate_limits_db_path = 'caches/rate_limits.sqlite'
+
+rate_limit_providers = {
+    # TravelTime only allows 10 requests per minute, and sends nag emails when near this...
+    'traveltime': {'capacity': 8, 'period': 60},
+    # Mapbox allow 300 (!) requests per minute
+    'mapbox': {'capacity': 300, 'period': 60},
+    # Google's Geocoding API allows 50 requests per second
+    'googlemaps': {'capacity': 50, 'period': 1},
+}
+
+
+@timeit
+def get_rate_limits_db():
+    rate_limits_db = sqlite3.connect(rate_limits_db_path, timeout=60, isolation_level=None)
+    rate_limits_db.execute(
+        'CREATE TABLE IF NOT EXISTS token_buckets (provider TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+    return rate_limits_db
+
+
+@timeit
+def get_refilled_tokens(rate_limits_db, provider, now):
+    capacity = rate_limit_providers[provider]['capacity']
+    refill_per_second = capacity / rate_limit_providers[provider]['period']
+
+    bucket_row = rate_limits_db.execute(
+        'SELECT tokens, updated FROM token_buckets WHERE provider = ?', (provider,)).fetchone()
+
+    if bucket_row is None:
+        return capacity
+
+    return min(capacity, bucket_row[0] + (now - bucket_row[1]) * refill_per_second)
+
+
+@timeit
+def reserve_rate_limit_token(provider):
+    refill_per_second = rate_limit_providers[provider]['capacity'] / rate_limit_providers[provider]['period']
+    rate_limits_db = get_rate_limits_db()
+
+    try:
+        # Take the write lock before reading, so no other process can reserve the same token
+        rate_limits_db.execute('BEGIN IMMEDIATE')
+        now = time.time()
+
+        # Tokens are allowed to go negative: each caller reserves the next token to become available, so callers
+        # queue up in the order they arrived, and each one knows exactly how long it has to wait
+        tokens = get_refilled_tokens(rate_limits_db, provider, now) - 1
+        rate_limits_db.execute(
+            'REPLACE INTO token_buckets (provider, tokens, updated) VALUES (?, ?, ?)', (provider, tokens, now))
+        rate_limits_db.execute('COMMIT')
+    finally:
+        rate_limits_db.close()
+
+    return max(0.0, -tokens / refill_per_second)
+
+
+@timeit
+def get_rate_limit_status(provider):
+    capacity = rate_limit_providers[provider]['capacity']
+    refill_per_second = capacity / rate_limit_providers[provider]['period']
+    rate_limits_db = get_rate_limits_db()
+
+    try:
+        tokens = get_refilled_tokens(rate_limits_db, provider, time.time())
+    finally:
+        rate_limits_db.close()
+
+    return {
+        'provider': provider,
+        'capacity': capacity,
+        'tokens': max(0.0, tokens),
+        'queued': max(0, math.ceil(-tokens)),
+        # How long a new caller would have to wait for a token right now
+        'wait_seconds': max(0.0, (1 - tokens) / refill_per_second)
+    }
+
+
+@timeit
+def get_all_rate_limits_status():
+    return [get_rate_limit_status(provider) for provider in rate_limit_providers]
+
+
+def rate_limited(provider):
+    def decorator(method):
+        @functools.wraps(method)
+        def rate_limited_method(*args, **kw):
+            wait_seconds = reserve_rate_limit_token(provider)
+
+            if wait_seconds > 0:
+                logging.warning('Rate limit reached for %s API, waiting for %1.1f seconds' % (provider, wait_seconds))
+                time.sleep(wait_seconds)
+
+            return method(*args, **kw)
+
+        return rate_limited_method
+
+    return decorator
@@ -1,15 +1,78 @@
 #!/usr/bin/env python3
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
+from shapely.geometry import mapping
 
-from src import travel_time, google_maps
+from run_server import transient_cache
+from src import travel_time, geocode_index
+from src.geometry_keys import geometry_key_fn
+from src.level_of_detail import resolve_lod, get_lod_tolerance
 from src.imd_tools import *
 from src.multi_polygons import *
 from src.utils import timeit
 
+# Isochrone fetches are almost entirely waiting on HTTP round trips, so they're run concurrently on a thread pool.
+# This is shared between requests to bound the total number of API calls in flight; the rate limiter still applies.
+transport_fetch_executor = ThreadPoolExecutor(max_workers=6)
+
+# Set HOMEAREA_TARGET_PROCESSES to compute the targets of a multi-target search in parallel worker processes, as the
+# GEOS work for each target is CPU-bound. The IMD dataset is memory-mapped, so workers share its pages read-only.
+target_processes = int(os.environ.get('HOMEAREA_TARGET_PROCESSES', 0))
+target_process_pool = None
+
+# These are also the keys used for each mode's max travel time in the target search params
+transport_mode_names = ['walking', 'cycling', 'bus', 'coach', 'train', 'driving']
+
+# The stages a target area search is computed in, in order; see target_area_stage below
+target_area_stages = ['geocode', 'isochrones', 'transport union', 'criterion clip', 'area filter', 'refine', 'join']
+
+
+def target_area_stage(stage_name):
+    stage_number = target_area_stages.index(stage_name) + 1
+
+    def decorator(stage_method):
+        stage_key_prefix = '%s.%s:' % (stage_method.__module__, stage_method.__name__)
+
+        def stage_method_memoized(*args, **kw):
+            ts = time.time()
+            stage_key = stage_key_prefix + geometry_key_fn(args, kw)
+
+            # Results are wrapped in a tuple so a stage which legitimately returns None is still memoized
+            cached_result = transient_cache.get(stage_key)
+            if cached_result is not None:
+                logging.info('Stage %d/%d (%s) %s: cache hit, %1.0f ms' % (
+                    stage_number, len(target_area_stages), stage_name, stage_method.__name__, (time.time() - ts) * 1000
+                ))
+                return cached_result[0]
+
+            result = stage_method(*args, **kw)
+            transient_cache.set(stage_key, (result,))
+
+            logging.info('Stage %d/%d (%s) %s: computed, %1.0f ms' % (
+                stage_number, len(target_area_stages), stage_name, stage_method.__name__, (time.time() - ts) * 1000
+            ))
+            return result
+
+        stage_method_memoized.__name__ = stage_method.__name__
+        return stage_method_memoized
+
+    return decorator
+
+
+def get_polygons_count(polygons):
+    if polygons is None:
+        return 0
+
+    return len(polygons.geoms) if hasattr(polygons, 'geoms') else 1
+
 
 @timeit
-@transient_cache.cached()
 def get_target_area_polygons(
         target_location_address: str,
         max_walking_time_mins: int,
@@ -29,22 +92,23 @@ def get_target_area_polygons(
         fallback_radius_miles: float,
         max_radius_miles: float,
         simplify_factor: float,
-        buffer_factor: float
+        buffer_factor: float,
+        lod=None
 ) -> dict:
+    # Not cached as a whole: each stage below is memoized on its own inputs, so changing one parameter only re-runs
+    # the stages downstream of it, e.g. moving the simplify slider only re-runs refine and join.
+    # lod picks how simplified the isochrones and IMD layers we work from are (see src/level_of_detail.py); by
+    # default it's chosen from the extent of each search, so city-wide searches don't process 1m detail.
     return_object = {}
 
-    target_lng_lat = google_maps.get_centre_point_lng_lat_for_address(
-        target_location_address
-    )
+    target_lng_lat = get_target_lng_lat(target_location_address)
 
     return_object['target'] = {
         'label': 'Target: ' + target_location_address,
         'coords': target_lng_lat
     }
 
-    result_polygons = []
     max_radius_polygon = get_bounding_circle_for_point(target_lng_lat, max_radius_miles)
-    result_intersection = max_radius_polygon
 
     if max_radius_polygon is not None:
         return_object['radius'] = {
@@ -61,84 +125,90 @@ def get_target_area_polygons(
         {"mode": "driving", "max_time": max_driving_time_mins, "label": '%s min Drive'}
     ]
 
-    for transport in transport_modes:
-        transport_poly = fetch_transport_mode_multipoly(
-            target_lng_lat, transport['mode'], transport['max_time'], max_radius_polygon)
+    transport_polys = list(transport_fetch_executor.map(
+        lambda transport: get_transport_mode_multipoly(
+            target_lng_lat, transport['mode'], transport['max_time'], max_radius_miles, lod),
+        transport_modes
+    ))
 
+    for transport, transport_poly in zip(transport_modes, transport_polys):
         if transport_poly is not None:
-            result_polygons.append(transport_poly)
-            transport_poly = join_multi_to_single_poly(transport_poly)
-
             return_object[transport['mode']] = {
                 'label': transport['label'] % str(transport['max_time']),
-                'polygon': transport_poly
+                'polygon': join_multi_to_single_poly(transport_poly)
             }
 
-    logging.info("Total result_polygons with all transports: " + str(len(result_polygons)))
+    transport_polys = [transport_poly for transport_poly in transport_polys if transport_poly is not None]
+    logging.info("Total result_polygons with all transports: " + str(len(transport_polys)))
 
-    result_polygons_length = len(result_polygons)
-
-    if result_polygons_length > 0:
-        if min_area_miles > 0:
-            result_polygons = filter_multipoly_by_min_area(result_polygons, min_area_miles)
-
-        result_polygons_length = 1 if not hasattr(result_polygons, 'geoms') else len(result_polygons.geoms)
-        logging.info("Total result_polygons after transport min area filter: " + str(result_polygons_length))
-    else:
+    if not transport_polys:
         if fallback_radius_miles == 0:
             fallback_radius_miles = 1
-        result_intersection = get_bounding_circle_for_point(target_lng_lat, fallback_radius_miles)
-
-    if result_polygons_length > 0:
-        # combined_transport_poly = join_multi_to_single_poly(result_polygons)
-        #
-        # if type(combined_transport_poly) is not list and combined_transport_poly.bounds:
-        #     # Buffer to remove any self-intersections
-        #     combined_transport_poly = combined_transport_poly.buffer(0.00001)
-        #
-        #     return_object['combined_transport'] = {
-        #         'label': 'Combined Transport',
-        #         'polygon': combined_transport_poly
-        #     }
-
-        deprivation_filter_values = {
-            'deprivation': {'label': 'Deprivation Rank', 'value': min_deprivation_rank},
-            'income': {'label': 'Income Rank', 'value': min_income_rank},
-            'crime': {'label': 'Crime Rank', 'value': min_crime_rank},
-            'health': {'label': 'Health Rank', 'value': min_health_rank},
-            'education': {'label': 'Education Rank', 'value': min_education_rank},
-            'services': {'label': 'Access to Services Rank', 'value': min_services_rank},
-            'environment': {'label': 'Living Environment Rank', 'value': min_environment_rank},
-        }
-
-        for filter_name, filter_obj in deprivation_filter_values.items():
-            if filter_obj['value'] > 0:
-                imd_multipoly = get_bounded_min_rank_multipoly(result_polygons.bounds, filter_name, filter_obj['value'])
-                imd_multipoly_joined = join_multi_to_single_poly(imd_multipoly)
-                return_object[filter_name] = {
-                    'label': filter_obj['label'] + ' >= ' + str(filter_obj['value']),
-                    'polygon': imd_multipoly_joined
-                }
 
-                result_polygons = intersect_multipoly_by_min_rank(result_polygons, filter_name, filter_obj['value'])
-
-                result_polygons_length = 1 if not hasattr(result_polygons, 'geoms') else len(result_polygons.geoms)
-                logging.info("Total result_polygons after " + filter_name + " filter: " + str(result_polygons_length))
-
-        if result_polygons_length > 0:
-            if min_area_miles > 0:
-                result_polygons = filter_multipoly_by_min_area(result_polygons, min_area_miles)
+        return_object['result_intersection'] = {
+            'label': 'Intersection',
+            'polygon': get_bounding_circle_for_point(target_lng_lat, fallback_radius_miles)
+        }
+        return return_object
+
+    result_polygons = union_transport_polygons(transport_polys, min_area_miles)
+    logging.info("Total result_polygons after transport min area filter: " + str(get_polygons_count(result_polygons)))
+
+    deprivation_filter_values = {
+        'deprivation': {'label': 'Deprivation Rank', 'value': min_deprivation_rank},
+        'income': {'label': 'Income Rank', 'value': min_income_rank},
+        'crime': {'label': 'Crime Rank', 'value': min_crime_rank},
+        'health': {'label': 'Health Rank', 'value': min_health_rank},
+        'education': {'label': 'Education Rank', 'value': min_education_rank},
+        'services': {'label': 'Access to Services Rank', 'value': min_services_rank},
+        'environment': {'label': 'Living Environment Rank', 'value': min_environment_rank},
+    }
 
-            result_polygons_length = 1 if not hasattr(result_polygons, 'geoms') else len(result_polygons.geoms)
-            logging.info(
-                "Total result_polygons after post-intersection min area filter: " + str(result_polygons_length))
+    min_rank_values = {
+        filter_name: filter_obj['value'] for filter_name, filter_obj in deprivation_filter_values.items()
+        if filter_obj['value'] > 0
+    }
 
-        if result_polygons_length > 0:
-            result_polygons = refine_multipolygon(result_polygons,
-                                                  simplify_factor,
-                                                  buffer_factor)
+    if min_rank_values and get_polygons_count(result_polygons) > 0:
+        transport_bounds = result_polygons.bounds
+        rank_layers_lod = resolve_lod(lod, transport_bounds)
+
+        # The most selective (then cheapest) filter is applied first, so each later one has less area left to clip
+        planned_filters, rules_out_everything = plan_min_rank_filters(
+            transport_bounds, min_rank_values, rank_layers_lod)
+        if rules_out_everything:
+            result_polygons = MultiPolygon()
+
+        for filter_name, min_rank_value in planned_filters:
+            # The map shows each rank layer over the whole transport area, while the intersection below only looks
+            # at the layer under what's left of the result after the filters before it
+            imd_multipoly = get_bounded_min_rank_multipoly(
+                transport_bounds, filter_name, min_rank_value, rank_layers_lod)
+            return_object[filter_name] = {
+                'label': deprivation_filter_values[filter_name]['label'] + ' >= ' + str(min_rank_value),
+                'polygon': join_multi_to_single_poly(imd_multipoly)
+            }
 
-            result_intersection = join_multi_to_single_poly(result_polygons)
+            # The fused AND over the zones is only a precheck: each criterion is still its own clip stage, so changing
+            # one rank only re-runs the clips planned after it, and each clip uses the precomputed dissolved layer at
+            # this lod rather than unioning raw zones at full detail on every search
+            if get_polygons_count(result_polygons) > 0:
+                result_polygons = clip_polygons_by_min_rank(
+                    result_polygons, filter_name, min_rank_value, rank_layers_lod)
+                logging.info("Total result_polygons after " + filter_name + " filter: " +
+                             str(get_polygons_count(result_polygons)) + ", within bounds: " +
+                             str(result_polygons.bounds if get_polygons_count(result_polygons) > 0 else None))
+
+    if get_polygons_count(result_polygons) > 0:
+        result_polygons = filter_polygons_by_min_area(result_polygons, min_area_miles)
+        logging.info("Total result_polygons after post-intersection min area filter: " +
+                     str(get_polygons_count(result_polygons)))
+
+    # If the filters ruled out everything there's no result area at all, rather than the whole radius
+    result_intersection = None
+    if get_polygons_count(result_polygons) > 0:
+        result_polygons = refine_result_polygons(result_polygons, simplify_factor, buffer_factor)
+        result_intersection = join_result_polygons(result_polygons)
 
     return_object['result_intersection'] = {
         'label': 'Intersection',
@@ -149,35 +219,43 @@ def get_target_area_polygons(
 
 
 @timeit
-@transient_cache.cached()
-def fetch_single_transport_mode_poly(target_lng_lat, mode, max_time_mins, filter_polygon=None):
-    if max_time_mins > 0:
-        transport_poly = fetch_transport_mode_multipoly(target_lng_lat, mode, max_time_mins, filter_polygon)
+@target_area_stage('geocode')
+def get_target_lng_lat(target_location_address):
+    return geocode_index.resolve_address(target_location_address)
 
-        if hasattr(transport_poly, '__len__') and len(transport_poly) > 0:
-            transport_poly = join_multi_to_single_poly(transport_poly)
-            return transport_poly
 
-        if type(transport_poly) is Polygon:
-            return transport_poly
+@timeit
+def get_transport_mode_multipoly(target_lng_lat, mode, max_time_mins, max_radius_miles, lod=None):
+    if max_time_mins > 0:
+        # Passed through to the stage so it's part of its key, and a revalidated isochrone is processed again
+        isochrone_fetched = travel_time.get_public_transport_isochrone_fetched(target_lng_lat, mode, max_time_mins)
+
+        return fetch_transport_mode_multipoly(
+            target_lng_lat, mode, max_time_mins, max_radius_miles, lod, isochrone_fetched=isochrone_fetched)
 
     return None
 
 
 @timeit
-@transient_cache.cached()
-def fetch_transport_mode_multipoly(target_lng_lat, mode, max_time_mins, filter_polygon=None):
+@target_area_stage('isochrones')
+def fetch_transport_mode_multipoly(target_lng_lat, mode, max_time_mins, max_radius_miles, lod=None,
+                                   isochrone_fetched=None):
     if max_time_mins > 0:
         transport_poly = travel_time.get_public_transport_isochrone_geometry(target_lng_lat, mode, max_time_mins)
 
-        poly_len = 1
-        if hasattr(transport_poly, '__len__'):
-            poly_len = len(transport_poly)
+        logging.debug("Total polygons in " + mode + " multipolygon: " + str(get_polygons_count(transport_poly)))
 
-        logging.debug("Total polygons in " + mode + " multipolygon: " + str(poly_len))
+        max_radius_polygon = get_bounding_circle_for_point(target_lng_lat, max_radius_miles)
+        if max_radius_polygon is not None:
+            transport_poly = filter_multipoly_by_polygon(transport_poly, max_radius_polygon)
+        else:
+            transport_poly = convert_list_to_refined_multipoly(transport_poly)
 
-        if filter_polygon is not None:
-            transport_poly = filter_multipoly_by_polygon(transport_poly, filter_polygon)
+        # The isochrone is kept at full detail for the finest level, every other level is simplified once here and
+        # then memoized with this stage
+        transport_lod = resolve_lod(lod, transport_poly.bounds)
+        if transport_lod > 0:
+            transport_poly = transport_poly.simplify(get_lod_tolerance(transport_lod), preserve_topology=True)
 
         return transport_poly
 
@@ -185,37 +263,129 @@ def fetch_transport_mode_multipoly(target_lng_lat, mode, max_time_mins, filter_p
 
 
 @timeit
-@transient_cache.cached()
+@target_area_stage('transport union')
+def union_transport_polygons(transport_polys, min_area_miles):
+    result_polygons = convert_list_to_refined_multipoly(transport_polys)
+
+    if min_area_miles > 0:
+        result_polygons = filter_multipoly_by_min_area(result_polygons, min_area_miles)
+
+    return result_polygons
+
+
+@timeit
+@target_area_stage('criterion clip')
+def clip_polygons_by_min_rank(result_polygons, rank_type, min_rank_value, lod):
+    return intersect_multipoly_by_min_rank(result_polygons, rank_type, min_rank_value, lod)
+
+
+@timeit
+@target_area_stage('area filter')
+def filter_polygons_by_min_area(result_polygons, min_area_miles):
+    if min_area_miles > 0:
+        return filter_multipoly_by_min_area(result_polygons, min_area_miles)
+
+    return result_polygons
+
+
+@timeit
+@target_area_stage('refine')
+def refine_result_polygons(result_polygons, simplify_factor, buffer_factor):
+    return refine_multipolygon(result_polygons, simplify_factor, buffer_factor)
+
+
+@timeit
+@target_area_stage('join')
+def join_result_polygons(result_polygons):
+    return join_multi_to_single_poly(result_polygons)
+
+
+@timeit
+def prefetch_targets_isochrones(targets_params: list):
+    isochrone_searches = []
+
+    for params in targets_params:
+        target_lng_lat = get_target_lng_lat(str(params['target']))
+
+        for mode in transport_mode_names:
+            if int(params[mode]) > 0:
+                isochrone_searches.append((target_lng_lat, mode, int(params[mode])))
+
+    # Fetch every isochrone any target needs up front in as few API calls as possible; each target then finds all
+    # of its isochrones already cached. Returns when each of them was fetched from the API, in search order.
+    if isochrone_searches:
+        isochrones = travel_time.get_public_transport_isochrones(isochrone_searches)
+
+        search_ids = [travel_time.get_isochrone_search_id(*search) for search in isochrone_searches]
+
+        return [isochrones[search_id]['fetched'] if search_id in isochrones else None for search_id in search_ids]
+
+    return []
+
+
+@timeit
+def get_target_process_pool():
+    global target_process_pool
+
+    # Spawn rather than fork, so workers open their own cache database connections rather than sharing ours
+    if target_process_pool is None:
+        target_process_pool = ProcessPoolExecutor(
+            max_workers=target_processes, mp_context=multiprocessing.get_context('spawn'))
+
+    return target_process_pool
+
+
+# This is deliberately not wrapped with @timeit or a cache decorator, so it can be pickled and sent to worker processes
+def get_target_area_polygons_for_params(params: dict):
+    return get_target_area_polygons(
+        target_location_address=str(params['target']),
+        min_deprivation_rank=int(params['deprivation']),
+        min_income_rank=int(params['income']),
+        min_crime_rank=int(params['crime']),
+        min_health_rank=int(params['health']),
+        min_education_rank=int(params['education']),
+        min_services_rank=int(params['services']),
+        min_environment_rank=int(params['environment']),
+        max_walking_time_mins=int(params['walking']),
+        max_cycling_time_mins=int(params['cycling']),
+        max_bus_time_mins=int(params['bus']),
+        max_coach_time_mins=int(params['coach']),
+        max_train_time_mins=int(params['train']),
+        max_driving_time_mins=int(params['driving']),
+        fallback_radius_miles=float(params['fallbackradius']),
+        max_radius_miles=float(params['maxradius']),
+        min_area_miles=float(params['minarea']),
+        simplify_factor=float(params['simplify']),
+        buffer_factor=float(params['buffer']),
+        lod=params.get('lod')
+    )
+
+
+@timeit
 def get_target_areas_polygons_json(targets_params: list):
+    # The cached result is keyed on when each of its isochrones was fetched as well as on the params, so once a stale
+    # isochrone is revalidated the search is computed again from the new one
+    isochrones_fetched = prefetch_targets_isochrones(targets_params)
+
+    return get_target_areas_polygons_json_for_isochrones(targets_params, isochrones_fetched)
+
+
+@timeit
+@transient_cache.cached()
+def get_target_areas_polygons_json_for_isochrones(targets_params: list, isochrones_fetched: list):
     response_object = {
         'targets_results': [],
         'result_intersection': None
     }
     intersections_to_combine = []
 
-    for target_index, params in enumerate(targets_params):
-        target_results = get_target_area_polygons(
-            target_location_address=str(params['target']),
-            min_deprivation_rank=int(params['deprivation']),
-            min_income_rank=int(params['income']),
-            min_crime_rank=int(params['crime']),
-            min_health_rank=int(params['health']),
-            min_education_rank=int(params['education']),
-            min_services_rank=int(params['services']),
-            min_environment_rank=int(params['environment']),
-            max_walking_time_mins=int(params['walking']),
-            max_cycling_time_mins=int(params['cycling']),
-            max_bus_time_mins=int(params['bus']),
-            max_coach_time_mins=int(params['coach']),
-            max_train_time_mins=int(params['train']),
-            max_driving_time_mins=int(params['driving']),
-            fallback_radius_miles=float(params['fallbackradius']),
-            max_radius_miles=float(params['maxradius']),
-            min_area_miles=float(params['minarea']),
-            simplify_factor=float(params['simplify']),
-            buffer_factor=float(params['buffer'])
-        )
+    if target_processes > 1 and len(targets_params) > 1:
+        logging.info("Computing " + str(len(targets_params)) + " targets in parallel worker processes")
+        targets_results = get_target_process_pool().map(get_target_area_polygons_for_params, targets_params)
+    else:
+        targets_results = map(get_target_area_polygons_for_params, targets_params)
 
+    for target_results in targets_results:
         if target_results['result_intersection']['polygon'] and \
                 target_results['result_intersection']['polygon'] is not None:
             intersections_to_combine.append(target_results['result_intersection']['polygon'])
@@ -243,7 +413,7 @@ def get_target_areas_polygons_json(targets_params: list):
 
 
 @timeit
-@transient_cache.cached()
+@transient_cache.cached(key_fn=geometry_key_fn)
 def plot_target_area_polygons_mpl(intersection_results):
     for key, value in intersection_results.items():
         if 'polygon' in value:
@@ -1,34 +1,42 @@
 #!/usr/bin/env python3
 import json
 import logging
+import re
 
+import numpy as np
 import pandas as pd
 from shapely.geometry import mapping
 
 from run_server import transient_cache, static_cache
-from src import google_maps
+from src.city_gazetteer import get_cities_centre_points
+from src.eurostat_dataset import get_eurostat_category, get_eurostat_category_names, get_eurostat_cities, \
+    get_eurostat_labels
 from src.multi_polygons import get_bounding_circle_for_point, join_multi_to_single_poly
-from src.utils import timeit
+from src.utils import timeit, InvalidRequestError, parse_boolean_param
+
+# Every city's latest value for each Eurostat indicator, one table per category, built the first time a query needs
+# that category and kept for the lifetime of the process; see build_eurostat_category_table
+eurostat_category_tables = {}
+eurostat_category_matrices = {}
+
+# The indicator the original minimum population filter applies to
+population_category = 'Population'
+population_indicator = 'Population on the 1st of January, total'
 
 
 @transient_cache.cached()
 def get_target_cities(params: dict):
     target_cities_result = []
 
-    country_code = str(params['countryCodeInput'])
-    target_cities = get_country_cities_combined_data(country_code)
-
-    for target_city in target_cities:
-        # Filter by arbitrary user-given params
-        if params['minPopulationInput']:
-            if int(target_city['Population']["Population on the 1st of January, total"]) < int(
-                    params['minPopulationInput']):
-                continue
+    # The paging details are returned along with the cities, so a request only ever runs its query once
+    cities_query = query_country_cities(params)
+    cities_df = cities_query['cities']
+    target_cities = get_cities_combined_data(cities_df)
 
-        city_center_coords = google_maps.get_centre_point_lng_lat_for_address(
-            target_city['Name'] + ', ' + country_code
-        )
+    # Centre points come from the gazetteer where possible, with any other cities geocoded concurrently in one batch
+    cities_centre_coords = get_cities_centre_points(cities_df)
 
+    for target_city, city_center_coords in zip(target_cities, cities_centre_coords):
         if city_center_coords is not None:
             city_polygon = get_bounding_circle_for_point(city_center_coords, 2)
 
@@ -39,7 +47,184 @@ def get_target_cities(params: dict):
                 'data': target_city
             })
 
-    return target_cities_result
+    return {
+        'cities': target_cities_result,
+        'total_cities': cities_query['total_cities'],
+        'page': cities_query['page'],
+        'pages': cities_query['pages']
+    }
+
+
+@timeit
+def parse_number_param(value, param_name, number_type=float):
+    # Blank means not set; anything else which isn't a number is a mistake in the request, so it's a 400 not a 500
+    if value in (None, ''):
+        return None
+
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        raise InvalidRequestError("Invalid number for " + param_name + ": " + str(value))
+
+
+@timeit
+def parse_indicator_param(indicator_param, param_name):
+    # e.g. {"category": "Population", "indicator": "Population on the 1st of January, total"}. An unknown category
+    # can't be looked up at all, whereas an unknown indicator just has no values (see get_cities_indicator_columns)
+    if not isinstance(indicator_param, dict) or not isinstance(indicator_param.get('indicator'), str):
+        raise InvalidRequestError("Invalid indicator for " + param_name + ": " + str(indicator_param))
+
+    if indicator_param.get('category') not in get_eurostat_category_names():
+        raise InvalidRequestError("Unknown Eurostat category for " + param_name + ": " +
+                                  str(indicator_param.get('category')))
+
+    return indicator_param['category'], indicator_param['indicator']
+
+
+@timeit
+def get_indicator_predicates(params: dict):
+    # Each predicate is e.g. {"category": "Population", "indicator": "Population on the 1st of January, total",
+    # "min": 100000}, with any of "min", "max", "minPercentile", "maxPercentile" (0-100, relative to the other cities
+    # in the country) and "notMissing". Cities missing a value never pass a min / max / percentile predicate.
+    # They're returned validated, with every bound parsed to a float or None.
+    filters = params.get('filters') or []
+    if not isinstance(filters, list):
+        raise InvalidRequestError("Invalid filters, expected a list: " + str(filters))
+
+    predicates = []
+    for filter_index, filter_param in enumerate(filters):
+        param_name = 'filters[' + str(filter_index) + ']'
+        category_name, indicator = parse_indicator_param(filter_param, param_name)
+
+        predicates.append({
+            'category': category_name,
+            'indicator': indicator,
+            'notMissing': bool(filter_param.get('notMissing')),
+            **{
+                bound: parse_number_param(filter_param.get(bound), param_name + '.' + bound)
+                for bound in ['min', 'max', 'minPercentile', 'maxPercentile']
+            }
+        })
+
+    # The original population filter is still accepted, as a shorthand for a min population predicate
+    min_population = parse_number_param(params.get('minPopulationInput'), 'minPopulationInput')
+    if min_population:
+        predicates.append({
+            'category': population_category,
+            'indicator': population_indicator,
+            'notMissing': False,
+            'min': min_population,
+            'max': None,
+            'minPercentile': None,
+            'maxPercentile': None
+        })
+
+    return predicates
+
+
+@timeit
+def get_cities_indicator_columns(city_codes, indicators):
+    # A numeric city x indicator matrix for just the given (category, indicator) pairs, rows in city_codes order;
+    # an indicator a category doesn't have is all NaN, so it simply fails any predicate on it
+    indicator_columns = {}
+
+    for category_name, indicator in indicators:
+        if (category_name, indicator) in indicator_columns:
+            continue
+
+        category_matrix = get_category_indicator_matrix(category_name)
+        if indicator in category_matrix.columns:
+            indicator_column = category_matrix[indicator].reindex(city_codes).to_numpy()
+        else:
+            logging.warning("Unknown Eurostat indicator, no cities have values for: " + category_name + " / " +
+                            indicator)
+            indicator_column = np.full(len(city_codes), np.nan)
+
+        indicator_columns[(category_name, indicator)] = indicator_column
+
+    return indicator_columns
+
+
+@timeit
+def mask_cities_by_predicates(indicator_columns, predicates):
+    cities_mask = None
+
+    for predicate in predicates:
+        indicator_values = indicator_columns[(predicate['category'], predicate['indicator'])]
+        present = ~np.isnan(indicator_values)
+        predicate_mask = np.ones(len(indicator_values), dtype=bool)
+
+        if predicate['notMissing']:
+            predicate_mask &= present
+        if predicate['min'] is not None:
+            predicate_mask &= indicator_values >= predicate['min']
+        if predicate['max'] is not None:
+            predicate_mask &= indicator_values <= predicate['max']
+
+        if predicate['minPercentile'] is not None or predicate['maxPercentile'] is not None:
+            # Percentile of each city's value among the cities which have one, NaN for those which don't
+            indicator_percentiles = pd.Series(indicator_values).rank(pct=True).to_numpy() * 100
+
+            if predicate['minPercentile'] is not None:
+                predicate_mask &= indicator_percentiles >= predicate['minPercentile']
+            if predicate['maxPercentile'] is not None:
+                predicate_mask &= indicator_percentiles <= predicate['maxPercentile']
+
+        cities_mask = predicate_mask if cities_mask is None else cities_mask & predicate_mask
+
+    return cities_mask
+
+
+@timeit
+def query_country_cities(params: dict):
+    # Filters, sorts and paginates a country's cities by their indicator values, without building any per-city data:
+    # every predicate is a vectorised comparison over one column of the city x indicator matrix. Only the cities on
+    # the requested page go on to be geocoded, which is by far the slowest part of a target cities search.
+    # Optional params: "filters" (see get_indicator_predicates), "sortBy" ({"category", "indicator"}),
+    # "sortDescending" (default true), "page" (from 1) and "pageSize" (default 0, meaning every city on one page).
+    # Every param is validated before any work is done, so a bad request is a 400 rather than a 500 part way through
+    country = str(params.get('countryCodeInput') or '')
+    if not re.match('^[A-Z]{2}$', country):
+        raise InvalidRequestError("Invalid country code: " + country)
+
+    predicates = get_indicator_predicates(params)
+    sort_by = params.get('sortBy')
+    sort_indicator = parse_indicator_param(sort_by, 'sortBy') if sort_by else None
+    sort_descending = parse_boolean_param(params.get('sortDescending'), 'sortDescending', True)
+    page_size = parse_number_param(params.get('pageSize'), 'pageSize', int) or 0
+    page = max(parse_number_param(params.get('page'), 'page', int) or 1, 1)
+
+    cities_df = get_country_cities(country)
+    city_codes = cities_df['CODE'].to_numpy()
+
+    indicator_columns = get_cities_indicator_columns(
+        city_codes,
+        [(predicate['category'], predicate['indicator']) for predicate in predicates] +
+        ([sort_indicator] if sort_indicator else [])
+    )
+
+    if predicates:
+        cities_df = cities_df[mask_cities_by_predicates(indicator_columns, predicates)]
+
+    if sort_indicator:
+        # A stable sort, with cities missing the value last whichever way it's sorted
+        sort_values = pd.Series(indicator_columns[sort_indicator], index=city_codes)[cities_df['CODE']].to_numpy()
+        sort_order = np.argsort(-sort_values if sort_descending else sort_values, kind='stable')
+        cities_df = cities_df.iloc[sort_order]
+
+    total_cities = len(cities_df)
+
+    if page_size > 0:
+        cities_df = cities_df.iloc[(page - 1) * page_size:page * page_size]
+
+    logging.info("Target cities query matched %d cities, returning %d" % (total_cities, len(cities_df)))
+
+    return {
+        'cities': cities_df,
+        'total_cities': total_cities,
+        'page': page,
+        'pages': max(1, -(-total_cities // page_size)) if page_size > 0 else 1
+    }
 
 
 @static_cache.cached()
@@ -80,137 +265,90 @@ def get_eurostat_countries():
     ]
 
 
-@static_cache.cached()
-def load_eurostat_metadata():
-    eurostat_data_dir = 'datasets/europe/eurostat-cities-2019/'
-
-    eurostat_meta_df = {
-        'Indicator list': pd.read_excel(eurostat_data_dir + 'urb_esms_an1.xlsx'),
-        'Validation rules': pd.read_excel(eurostat_data_dir + 'urb_esms_an2.xlsx'),
-        'Variable list': pd.read_excel(eurostat_data_dir + 'urb_esms_an3.xls'),
-        'List of cities': pd.read_excel(eurostat_data_dir + 'urb_esms_an4.xls'),
-        'Perception Indicators': pd.read_csv(eurostat_data_dir + 'urb_percep_indicators.tsv', sep='\t', header=None,
-                                             names=['Code', 'Label']),
-    }
+@timeit
+def get_eurostat_category_table(category_name):
+    if category_name not in eurostat_category_tables:
+        eurostat_category_tables[category_name] = build_eurostat_category_table(category_name)
 
-    # Columns:
-    # List of cities: ["CODE", "NAME"]
-    # Indicator list: ["CODE", "LABEL", "indicator calculation nominator", "indicator calculation denominator"]
-    # Validation rules: ["Rule name", "New Rule Name",…]
-    # Variable list: ["Domain", "Code", "Label", "To be collected by NSI included in Annex A of Grants 2014/2015",…]
+    return eurostat_category_tables[category_name]
 
-    return eurostat_meta_df
 
+@timeit
+def build_eurostat_category_table(category_name):
+    category_df, years = get_eurostat_category(category_name)
 
-@static_cache.cached()
-def load_eurostat_data():
-    eurostat_data_dir = 'datasets/europe/eurostat-cities-2019/'
-
-    eurostat_df = {
-        'Economy and finance':
-            pd.read_csv(eurostat_data_dir + 'urb_cecfi.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Environment':
-            pd.read_csv(eurostat_data_dir + 'urb_cenv.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Fertility and mortality':
-            pd.read_csv(eurostat_data_dir + 'urb_cfermor.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Education':
-            pd.read_csv(eurostat_data_dir + 'urb_ceduc.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Living conditions':
-            pd.read_csv(eurostat_data_dir + 'urb_clivcon.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Labour market':
-            pd.read_csv(eurostat_data_dir + 'urb_clma.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Population':
-            pd.read_csv(eurostat_data_dir + 'urb_cpop1.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Culture and tourism':
-            pd.read_csv(eurostat_data_dir + 'urb_ctour.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Transport':
-            pd.read_csv(eurostat_data_dir + 'urb_ctran.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-        'Perception survey':
-            pd.read_csv(eurostat_data_dir + 'urb_percep.tsv.gz', sep='\t', header=0,
-                        compression='gzip', error_bad_lines=False),
-    }
+    # Values are already parsed to numbers when the dataset is compiled, and years run newest first, so each row's
+    # latest value is simply its first one which isn't NaN
+    year_values = category_df[years].to_numpy()
+    year_flags = category_df[[year + ' flags' for year in years]].to_numpy()
+    present = ~np.isnan(year_values)
+    latest_year_indexes = present.argmax(axis=1)
+    rows = np.arange(len(category_df))
 
-    # Columns:
-    # Culture and tourism: ["indic_ur,cities\time", "2019 ", "2018 ", "2017 ", "2016 ", "2015 ", "2014 ", "2013 " ...]
-    # Economy and finance: ["indic_ur,cities\time", "2018 ", "2017 ", "2016 ", "2015 ", "2014 ", "2013 ", "2012 "...]
-    # Education: ["indic_ur,cities\time", "2019 ", "2018 ", "2017 ", "2016 ", "2015 ", "2014 ", "2013 ", "2012 " ...]
-    # Environment: ["indic_ur,cities\time", "2019 ", "2018 ", "2017 ", "2016 ", "2015 ", "2014 ", "2013 ", "2012 " ...]
-    # Fertility and mortality: ["indic_ur,cities\time", "2019 ", "2018 ", "2017 ", "2016 ", "2015 ", "2014 " ...]
-    # Labour market: ["indic_ur,cities\time", "2019 ", "2018 ", "2017 ", "2016 ", "2015 ", "2014 ", "2013 ", ...]
-    # Living conditions: ["indic_ur,cities\time", "2018 ", "2017 ", "2016 ", "2015 ", "2014 ", "2013 ", "2012 " ...]
-    # Perception survey: ["indic_ur,unit,cities\time", "2015 ", "2012 ", "2009 ", "2006 ", "2004 "]
-    # Population: ["indic_ur,cities\time", "2019 ", "2018 ", "2017 ", "2016 ", "2015 " ...]
-    # Transport: ["indic_ur,cities\time", "2019 ", "2018 ", "2017 ", "2016 ", "2015 ", "2014 ", "2013 ", "2012 " ...]
+    category_table = pd.DataFrame({
+        'city': category_df['city'],
+        'indicator': category_df['indicator'].map(get_eurostat_labels()).fillna(category_df['indicator']),
+        'value': year_values[rows, latest_year_indexes],
+        'flags': year_flags[rows, latest_year_indexes],
+        'year': np.array(years)[latest_year_indexes]
+    })[present.any(axis=1)]
 
-    return eurostat_df
+    # Several rows can map to the same label (e.g. the perception survey's units), the last one with a value wins
+    category_table = category_table.drop_duplicates(['city', 'indicator'], keep='last')
 
+    logging.info("Built Eurostat " + category_name + " table with rows: " + str(len(category_table)))
 
-@static_cache.cached()
-def get_country_cities_combined_data(country):
-    eurostat_meta_df = load_eurostat_metadata()
-    eurostat_df = load_eurostat_data()
+    # A stable sort keeps each city's indicators in their original order
+    return category_table.set_index('city').sort_index(kind='stable')
 
-    # Example CODE value for a UK city: UK007C1
-    city_code_regex = '^' + country + '[0-9]+C[0-9]+$'
 
-    cities_filtered_df = eurostat_meta_df['List of cities'][
-        eurostat_meta_df['List of cities']['CODE'].str.contains(city_code_regex)
-    ]
+@timeit
+def get_category_indicator_matrix(category_name):
+    # The category's table pivoted to one row per city and one float column per indicator
+    if category_name not in eurostat_category_matrices:
+        eurostat_category_matrices[category_name] = get_eurostat_category_table(category_name).pivot(
+            columns='indicator', values='value')
 
-    indicators_map = eurostat_meta_df['Indicator list'].set_index('CODE').to_dict(orient='index')
-    variables_map = eurostat_meta_df['Variable list'].set_index('Code').to_dict(orient='index')
-    perception_map = eurostat_meta_df['Perception Indicators'].set_index('Code').to_dict(orient='index')
+    return eurostat_category_matrices[category_name]
 
-    result_cities_list = []
 
-    for cities_idx, cities_row in cities_filtered_df.iterrows():
-        city_code = cities_row['CODE']
+@timeit
+def get_country_cities(country):
+    cities_df = get_eurostat_cities()
 
-        single_city_data = {
-            'Code': city_code,
-            'Name': cities_row['NAME']
-        }
+    # Example CODE value for a UK city: UK007C1
+    city_code_regex = '^' + country + '[0-9]+C[0-9]+$'
 
-        city_data_regex = city_code + '$'
+    return cities_df[cities_df['CODE'].str.contains(city_code_regex)]
 
-        for category_index, category_name in enumerate(eurostat_df):
-            category_df = eurostat_df[category_name]
-            first_col_name = category_df.columns[0]
-            city_data_df = category_df[
-                category_df[first_col_name].str.contains(city_data_regex)
-            ]
-            single_city_data[category_name] = {}
 
-            for city_data_idx, city_data_row in city_data_df.iterrows():
-                city_data_indicator = city_data_row[first_col_name]
-                city_data_indicator = city_data_indicator.split(',')[0]
+@timeit
+def get_country_cities_combined_data(country, category_names=None):
+    return get_cities_combined_data(get_country_cities(country), category_names)
 
-                if city_data_indicator in variables_map.keys():
-                    city_data_indicator = variables_map[city_data_indicator]['Label']
-                elif city_data_indicator in indicators_map.keys():
-                    city_data_indicator = indicators_map[city_data_indicator]['LABEL']
-                elif city_data_indicator in perception_map.keys():
-                    city_data_indicator = perception_map[city_data_indicator]['Label']
 
-                for city_data_col_idx, city_data_year in enumerate(category_df.columns):
-                    if city_data_col_idx == 0:
-                        continue
+@timeit
+def get_cities_combined_data(cities_filtered_df, category_names=None):
+    # Not cached: the slow parts are done once by compiling the dataset, this just picks out these cities' rows from
+    # each category's table. Only the categories asked for (by default all of them) are ever loaded.
+    if category_names is None:
+        category_names = get_eurostat_category_names()
+
+    result_cities = {
+        city_code: {
+            'Code': city_code,
+            'Name': city_name,
+            **{category_name: {} for category_name in category_names}
+        }
+        for city_code, city_name in zip(cities_filtered_df['CODE'], cities_filtered_df['NAME'])
+    }
 
-                    city_data_value = city_data_row[city_data_year]
-                    if city_data_value != ': ':
-                        single_city_data[category_name][city_data_indicator] = city_data_value
-                        break
+    for category_name in category_names:
+        category_table = get_eurostat_category_table(category_name)
+        cities_table = category_table[category_table.index.isin(cities_filtered_df['CODE'])]
 
-        result_cities_list.append(single_city_data)
+        for city_code, indicator, value in zip(cities_table.index, cities_table['indicator'], cities_table['value']):
+            result_cities[city_code][category_name][indicator] = value
 
     # Result object shape:
     # [
@@ -218,16 +356,16 @@ def get_country_cities_combined_data(country):
     #       "Code": "UK002C1",
     #       "Name": "Birmingham",
     #       "Economy and finance": {
-    #           "All companies": "34565 d"
+    #           "All companies": 34565.0
     #       },
     #       "Population": {
-    #           "Population on the 1st of January, total": "515855 "
+    #           "Population on the 1st of January, total": 515855.0
     #       }
     #       ...
     #   }
     # ]
 
-    return result_cities_list
+    return list(result_cities.values())
 
 
 @timeit
@@ -238,10 +376,14 @@ def get_target_cities_data_json(params: dict):
         'result_intersection': None
     }
 
-    target_cities_polygons = []
     target_cities = get_target_cities(params)
+    response_object['total_cities'] = target_cities['total_cities']
+    response_object['page'] = target_cities['page']
+    response_object['pages'] = target_cities['pages']
+
+    target_cities_polygons = []
 
-    for target_city in target_cities:
+    for target_city in target_cities['cities']:
         response_object['targets_results'].append({
             'target': {
                 'label': target_city['label'],
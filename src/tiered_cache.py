@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import shapely
+import ucache
+
+from src.geometry_serializer import GeometryBlobSerializer
+
+
+# Even a hot hit on a SqliteCache pays for an SQLite read, zlib decompression and unpickling a large geometry, and
+# slider tweaks in the UI re-request near-identical searches constantly. So each store gets an in-process LRU of the
+# unpickled values in front of it, bounded by (estimated) bytes rather than entry count, since one cached isochrone
+# can be a thousand times the size of a cached geocode. Writes go through to SQLite as before, so the SQLite store
+# remains the source of truth shared between processes, and survives restarts.
+
+def estimate_value_size(value):
+    # A rough in-memory footprint, only needs to be good enough for relative sizes when bounding the LRU
+    if isinstance(value, shapely.Geometry):
+        return 100 + 16 * int(shapely.get_num_coordinates(value))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_value_size(key) + estimate_value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_value_size(item) for item in value)
+
+    return sys.getsizeof(value)
+
+
+def copy_value_containers(value):
+    # Values from SQLite are unpickled fresh on every hit, and some callers modify what they're given (e.g.
+    # get_target_areas_polygons_json converts polygons to GeoJSON in place), so each memory hit gets its own copy of
+    # any dicts and lists. Geometries, strings and numbers are immutable, so they're shared rather than copied.
+    if isinstance(value, dict):
+        return {key: copy_value_containers(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_value_containers(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(copy_value_containers(item) for item in value)
+
+    return value
+
+
+class TieredSqliteCache(ucache.SqliteCache):
+    def __init__(self, filename, memory_size_bytes=64 * 1024 * 1024, geometry_grid_size=None, **params):
+        self.memory_size_bytes = memory_size_bytes
+        self.memory_entries = OrderedDict()
+        self.memory_entries_size = 0
+        self.memory_lock = threading.Lock()
+        self.memory_hits = self.memory_misses = self.memory_evictions = 0
+
+        super(TieredSqliteCache, self).__init__(filename, **params)
+
+        # Store geometries in values as deduplicated WKB blobs rather than pickling them, see src/geometry_serializer.py
+        self.geometry_serializer = GeometryBlobSerializer(self._db, geometry_grid_size)
+        self.geometry_serializer.create_table()
+
+        self.pack, self.unpack = self.geometry_serializer.pack, self.geometry_serializer.unpack
+        if self.compression:
+            self.pack, self.unpack = ucache.with_compression(
+                self.pack, self.unpack, params.get('compression_len', 256))
+
+    def memory_get(self, key):
+        with self.memory_lock:
+            entry = self.memory_entries.get(key)
+
+            if entry is not None and entry[1] < time.time():
+                self.memory_delete_locked(key)
+                entry = None
+
+            if entry is None:
+                self.memory_misses += 1
+                return None
+
+            self.memory_entries.move_to_end(key)
+            self.memory_hits += 1
+
+        return copy_value_containers(entry[0])
+
+    def memory_set(self, key, value, timeout=None):
+        value_size = estimate_value_size(value)
+
+        with self.memory_lock:
+            self.memory_delete_locked(key)
+
+            # Anything this large would evict the whole tier for one entry, so leave it in SQLite only
+            if value_size > self.memory_size_bytes / 4:
+                return
+
+            # Values loaded from SQLite are given the full default timeout from now, which can outlive their SQLite
+            # expiry; with timeouts measured in months that's not worth an extra query to find out
+            self.memory_entries[key] = (copy_value_containers(value), ucache.expires_at(self._timeout(timeout)),
+                                        value_size)
+            self.memory_entries_size += value_size
+
+            while self.memory_entries_size > self.memory_size_bytes:
+                evicted_key, evicted_entry = self.memory_entries.popitem(last=False)
+                self.memory_entries_size -= evicted_entry[2]
+                self.memory_evictions += 1
+
+    def memory_delete_locked(self, key):
+        entry = self.memory_entries.pop(key, None)
+        if entry is not None:
+            self.memory_entries_size -= entry[2]
+
+    def get(self, key):
+        if self.debug:
+            return
+
+        value = self.memory_get(key)
+        if value is not None:
+            return value
+
+        value = super(TieredSqliteCache, self).get(key)
+        if value is not None:
+            self.memory_set(key, value)
+
+        return value
+
+    def get_many(self, keys):
+        if self.debug:
+            return
+
+        values = {}
+        for key in keys:
+            value = self.memory_get(key)
+            if value is not None:
+                values[key] = value
+
+        missing_keys = [key for key in keys if key not in values]
+        if missing_keys:
+            stored_values = super(TieredSqliteCache, self).get_many(missing_keys) or {}
+
+            for key, value in stored_values.items():
+                if value is not None:
+                    self.memory_set(key, value)
+                    values[key] = value
+
+        return values
+
+    def set(self, key, value, timeout=None):
+        if self.debug:
+            return
+
+        self.memory_set(key, value, timeout)
+        return super(TieredSqliteCache, self).set(key, value, timeout)
+
+    def set_many(self, __data=None, timeout=None, **kwargs):
+        if self.debug:
+            return
+
+        if __data is not None:
+            kwargs.update(__data)
+
+        for key, value in kwargs.items():
+            self.memory_set(key, value, timeout)
+
+        return super(TieredSqliteCache, self).set_many(kwargs, timeout)
+
+    def delete(self, key):
+        with self.memory_lock:
+            self.memory_delete_locked(key)
+
+        return super(TieredSqliteCache, self).delete(key)
+
+    def delete_many(self, keys):
+        with self.memory_lock:
+            for key in keys:
+                self.memory_delete_locked(key)
+
+        return super(TieredSqliteCache, self).delete_many(keys)
+
+    def flush(self):
+        with self.memory_lock:
+            self.memory_entries.clear()
+            self.memory_entries_size = 0
+
+        self.geometry_serializer.flush()
+        return super(TieredSqliteCache, self).flush()
+
+    @property
+    def memory_stats(self):
+        with self.memory_lock:
+            memory_lookups = self.memory_hits + self.memory_misses
+
+            return {
+                'hits': self.memory_hits,
+                'misses': self.memory_misses,
+                'hit_rate': self.memory_hits / memory_lookups if memory_lookups else 0.0,
+                'evictions': self.memory_evictions,
+                'entries': len(self.memory_entries),
+                'size_bytes': self.memory_entries_size,
+                'max_size_bytes': self.memory_size_bytes
+            }
+
+    def log_memory_stats(self, cache_name):
+        memory_stats = self.memory_stats
+
+        logging.info('%s memory tier: %1.0f%% hit rate (%d hits, %d misses), %d entries, %1.1f of %1.1f MB' % (
+            cache_name,
+            memory_stats['hit_rate'] * 100,
+            memory_stats['hits'],
+            memory_stats['misses'],
+            memory_stats['entries'],
+            memory_stats['size_bytes'] / 1024 / 1024,
+            memory_stats['max_size_bytes'] / 1024 / 1024
+        ))
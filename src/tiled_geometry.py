@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+from src.utils import timeit
+
+# GEOS overlay operations are single threaded, and over a large driving isochrone a single union or intersection can
+# take many seconds. So for large enough inputs the extent is split into a grid of tiles, each tile's share of the
+# work is clipped out and run in a separate worker process, and the results are stitched back together.
+#
+# The tiles don't overlap, so the pieces computed for neighbouring tiles only ever meet along tile edges. Both sides of
+# a seam come from clipping the same input segments against the same tile edge, so they meet exactly, which makes the
+# pieces a coverage: they can be stitched with GEOS' coverage union, which just drops the shared edges rather than
+# running a full overlay, and leaves no slivers behind. Only the pieces touching a seam need stitching at all.
+#
+# Set HOMEAREA_GEOMETRY_PROCESSES to the number of worker processes to use; 0 (the default) keeps everything in the
+# calling process, with no tiling at all.
+geometry_processes = int(os.environ.get('HOMEAREA_GEOMETRY_PROCESSES', 0))
+geometry_process_pool = None
+geometry_process_pool_processes = 0
+
+# Below this many vertices in total, the overhead of tiling and sending WKB to workers outweighs the speed up
+tiled_min_vertices = 100000
+
+# Tiles per worker; more tiles than workers evens out the load, as some tiles are always much busier than others
+tiles_per_process = 4
+
+
+@timeit
+def get_geometry_process_pool(processes):
+    global geometry_process_pool, geometry_process_pool_processes
+
+    # Spawn rather than fork, so workers don't inherit cache database connections; they only ever import this module
+    if geometry_process_pool is None or geometry_process_pool_processes != processes:
+        if geometry_process_pool is not None:
+            geometry_process_pool.shutdown(wait=False)
+
+        geometry_process_pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        geometry_process_pool_processes = processes
+
+    return geometry_process_pool
+
+
+@timeit
+def get_tiles(bounds, tiles_count):
+    min_x, min_y, max_x, max_y = bounds
+    tiles_x = max(1, int(math.ceil(math.sqrt(tiles_count))))
+    tiles_y = max(1, int(math.ceil(tiles_count / tiles_x)))
+
+    # Tile edges are shared exactly between neighbours, and the outer edges are pushed out a little so geometries
+    # lying on the extent's boundary are never clipped
+    x_edges = np.linspace(min_x, max_x, tiles_x + 1)
+    y_edges = np.linspace(min_y, max_y, tiles_y + 1)
+    x_edges[0], x_edges[-1] = x_edges[0] - 1, x_edges[-1] + 1
+    y_edges[0], y_edges[-1] = y_edges[0] - 1, y_edges[-1] + 1
+
+    return [
+        shapely.box(x_edges[x], y_edges[y], x_edges[x + 1], y_edges[y + 1])
+        for x in range(tiles_x) for y in range(tiles_y)
+    ]
+
+
+def clip_to_tile(geometries, tile):
+    clipped = shapely.intersection(geometries, tile)
+    return clipped[~shapely.is_empty(clipped)]
+
+
+# These run in the worker processes, so they take and return WKB rather than Shapely objects
+
+def union_tile(tile_wkb, geometries_wkb):
+    tile = shapely.from_wkb(tile_wkb)
+    return shapely.to_wkb(shapely.union_all(clip_to_tile(shapely.from_wkb(geometries_wkb), tile)))
+
+
+def intersect_tile(tile_wkb, geometries_a_wkb, geometries_b_wkb):
+    tile = shapely.from_wkb(tile_wkb)
+
+    # The parts of each input are already disjoint, so after clipping they can go straight into a MultiPolygon
+    geometry_a = shapely.multipolygons(get_polygons(clip_to_tile(shapely.from_wkb(geometries_a_wkb), tile)))
+    geometry_b = shapely.multipolygons(get_polygons(clip_to_tile(shapely.from_wkb(geometries_b_wkb), tile)))
+
+    return shapely.to_wkb(shapely.intersection(geometry_a, geometry_b))
+
+
+def get_polygons(geometries):
+    # Only polygons are kept; clipping can leave lines or points where inputs just touch a tile edge
+    geometries_parts = shapely.get_parts(geometries)
+    return geometries_parts[shapely.get_type_id(geometries_parts) == shapely.GeometryType.POLYGON]
+
+
+@timeit
+def get_parts_in_tiles(geometries_parts, tiles):
+    # Each tile is only sent the parts whose envelope touches it
+    parts_tree = STRtree(geometries_parts)
+    parts_wkb = shapely.to_wkb(geometries_parts)
+
+    return [parts_wkb[parts_tree.query(tile)] for tile in tiles]
+
+
+@timeit
+def stitch_tiles(tiles_results_wkb, tiles):
+    tiles_polygons = get_polygons(shapely.from_wkb(tiles_results_wkb))
+
+    # Seams are the tile edges inside the extent; the outermost edges of the grid aren't shared with another tile
+    tiles_bounds = shapely.bounds(tiles)
+    seams_x = np.unique(tiles_bounds[:, [0, 2]])[1:-1]
+    seams_y = np.unique(tiles_bounds[:, [1, 3]])[1:-1]
+
+    polygons_bounds = shapely.bounds(tiles_polygons)
+    on_seam = np.isin(polygons_bounds[:, 0], seams_x) | np.isin(polygons_bounds[:, 2], seams_x) | \
+        np.isin(polygons_bounds[:, 1], seams_y) | np.isin(polygons_bounds[:, 3], seams_y)
+
+    stitched_polygons = get_polygons(shapely.coverage_union_all(tiles_polygons[on_seam]))
+
+    return shapely.multipolygons(np.concatenate([tiles_polygons[~on_seam], stitched_polygons]))
+
+
+@timeit
+def get_processes(processes):
+    return geometry_processes if processes is None else processes
+
+
+@timeit
+def should_tile(geometries_parts, processes):
+    return processes > 0 and int(shapely.get_num_coordinates(geometries_parts).sum()) >= tiled_min_vertices
+
+
+@timeit
+def tiled_union(geometries, processes=None):
+    # Equivalent to shapely.union_all(geometries), split across worker processes when it's worth it
+    processes = get_processes(processes)
+    geometries_parts = shapely.get_parts(geometries)
+
+    if not should_tile(geometries_parts, processes):
+        return shapely.union_all(geometries_parts)
+
+    ts = time.time()
+    tiles = get_tiles(shapely.total_bounds(geometries_parts), processes * tiles_per_process)
+
+    tiles_results_wkb = list(get_geometry_process_pool(processes).map(
+        union_tile, shapely.to_wkb(tiles), get_parts_in_tiles(geometries_parts, tiles)
+    ))
+    result = stitch_tiles(tiles_results_wkb, tiles)
+
+    logging.info("Tiled union of %d parts over %d tiles with %d processes, time: %1.0f ms" % (
+        len(geometries_parts), len(tiles), processes, (time.time() - ts) * 1000))
+
+    return result
+
+
+@timeit
+def tiled_intersection(geometry_a, geometry_b, processes=None):
+    # Equivalent to shapely.intersection(geometry_a, geometry_b), split across worker processes when it's worth it
+    processes = get_processes(processes)
+    geometry_a_parts = shapely.get_parts(geometry_a)
+    geometry_b_parts = shapely.get_parts(geometry_b)
+
+    if not should_tile(np.concatenate([geometry_a_parts, geometry_b_parts]), processes):
+        return shapely.intersection(geometry_a, geometry_b)
+
+    ts = time.time()
+
+    # Only the area both geometries cover can be in the result, so that's all that needs tiling
+    a_min_x, a_min_y, a_max_x, a_max_y = shapely.total_bounds(geometry_a_parts)
+    b_min_x, b_min_y, b_max_x, b_max_y = shapely.total_bounds(geometry_b_parts)
+    if a_min_x > b_max_x or b_min_x > a_max_x or a_min_y > b_max_y or b_min_y > a_max_y:
+        return shapely.MultiPolygon()
+
+    tiles = get_tiles(
+        (max(a_min_x, b_min_x), max(a_min_y, b_min_y), min(a_max_x, b_max_x), min(a_max_y, b_max_y)),
+        processes * tiles_per_process
+    )
+
+    tiles_results_wkb = list(get_geometry_process_pool(processes).map(
+        intersect_tile,
+        shapely.to_wkb(tiles),
+        get_parts_in_tiles(geometry_a_parts, tiles),
+        get_parts_in_tiles(geometry_b_parts, tiles)
+    ))
+    result = stitch_tiles(tiles_results_wkb, tiles)
+
+    logging.info("Tiled intersection of %d and %d parts over %d tiles with %d processes, time: %1.0f ms" % (
+        len(geometry_a_parts), len(geometry_b_parts), len(tiles), processes, (time.time() - ts) * 1000))
+
+    return result
@@ -1,66 +1,283 @@
 #!/usr/bin/env python3
+import calendar
+import datetime
 import logging
 import os
-from time import strftime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from backoff import on_exception, expo
-from ratelimit import RateLimitException, limits
+from requests import Request, Session
 
 from run_server import requests_cache, transient_cache
+from src.rate_limiter import rate_limited
 from src.utils import timeit
 
+# Can be pointed at a local mock server, e.g. for testing without using up any of our API quota
+traveltime_api_url = os.environ.get('TRAVELTIME_API_URL', 'http://api.traveltimeapp.com/v4/time-map')
+
+# TravelTime limits how many searches may be sent in a single time-map request
+traveltime_max_searches_per_request = 10
+
+# Isochrones are searched for a canonical departure slot, e.g. "a weekday at 08:00", rather than for a specific date,
+# and both our isochrone cache and the HTTP cache key them on the slot's name rather than the date. So a search is
+# reused from one day to the next, and the pre-seeded requests cache shipped with a release doesn't go stale the day
+# after it's shipped. The request actually sent to TravelTime departs at the next real time in the slot, so it's always
+# within their timetables, and a revalidation (see below) picks up whatever timetable is current. Times are UTC.
+departure_slots = {
+    'weekday-peak': {'weekdays': [0, 1, 2, 3, 4], 'hour': 8, 'minute': 0},
+    'weekend-peak': {'weekdays': [5], 'hour': 11, 'minute': 0},
+}
+default_departure_slot = 'weekday-peak'
+
+
+def get_configured_departure_slot():
+    departure_slot_name = os.environ.get('HOMEAREA_DEPARTURE_SLOT', default_departure_slot)
+
+    if departure_slot_name not in departure_slots:
+        logging.error('Unknown HOMEAREA_DEPARTURE_SLOT: %s - using %s instead, allowed slots are: %s' % (
+            departure_slot_name, default_departure_slot, ', '.join(departure_slots.keys())))
+        return default_departure_slot
+
+    return departure_slot_name
+
+
+departure_slot = get_configured_departure_slot()
+
+# Once a cached isochrone was fetched from the API longer ago than this it's still used, but it's refetched in the
+# background (stale while revalidate), so timetable changes are picked up without a search ever waiting on the rate
+# limited API for them
+isochrone_revalidate_seconds = float(os.environ.get('HOMEAREA_ISOCHRONE_REVALIDATE_DAYS', 14)) * 24 * 60 * 60
+
+isochrone_cache_prefix = 'src.travel_time.isochrone.v4:'
+
+# Background refreshes are sent one batch at a time, as they're never urgent and share the rate limit with searches.
+# Each process only queues a stale search once, but separate worker processes may each refresh the same one.
+isochrone_refresh_executor = ThreadPoolExecutor(max_workers=1)
+isochrone_refreshing_keys = set()
+isochrone_refreshing_lock = threading.Lock()
+
 
 @timeit
-@on_exception(expo, RateLimitException, max_tries=10)  # Backoff exponentially and retry if rate limit hit
-@limits(calls=8, period=60)  # TravelTime only allows 10 requests per minute, and sends nag emails when near this...
-def call_traveltime_api(url, body, headers):
-    response = requests_cache.post(
-        url,
-        json=body,
-        headers=headers,
-    )
+def get_traveltime_request(url, body, headers):
+    return requests_cache.prepare_request(Request('POST', url, json=body, headers=headers))
+
+
+@timeit
+def uncache_traveltime_response(url, cache_body, headers):
+    # For a response which came back successfully but isn't usable, so the same request is sent again next time
+    requests_cache.cache.delete(requests_cache.cache.create_key(get_traveltime_request(url, cache_body, headers)))
+
+
+@timeit
+def call_traveltime_api(url, body, headers, cache_body, refresh=False):
+    # Returns the response, and when it was fetched from the API. It's cached under cache_body rather than body, so
+    # anything in the body which changes from day to day (i.e. the departure time) doesn't change its cache key.
+    # A response which is already in the HTTP cache is returned without waiting on the rate limiter, as it doesn't
+    # make an API call at all, unless it's being refreshed.
+    cache_key = requests_cache.cache.create_key(get_traveltime_request(url, cache_body, headers))
+
+    if not refresh:
+        cached_response, cached_time = requests_cache.cache.get_response_and_time(cache_key)
+
+        if cached_response is not None:
+            logging.debug('Cache HIT - this response was fetched from the local SQLite DB without a new API call')
+            return cached_response, calendar.timegm(cached_time.utctimetuple())
 
-    if response.from_cache:
-        logging.debug('Cache HIT - this response was fetched from the local SQLite DB without a new API call')
-    else:
-        logging.warning('Cache MISS - this response required a new API call')
+    logging.warning('Cache MISS - this response required a new API call')
+    return send_traveltime_request(get_traveltime_request(url, body, headers), cache_key), time.time()
+
+
+@timeit
+@rate_limited('traveltime')  # Shared token bucket across all worker processes, see src/rate_limiter.py
+def send_traveltime_request(traveltime_request, cache_key):
+    # Sent as a plain requests Session would, so it always reaches the API, and only a successful response replaces
+    # whatever is cached for it; a failed refresh leaves the previous response in place
+    response = Session.send(requests_cache, traveltime_request)
+
+    if response.status_code == 200:
+        requests_cache.cache.save_response(cache_key, response)
 
     return response
 
 
 @timeit
-@transient_cache.cached()
 def get_public_transport_isochrone_geometry(target_lng_lat, mode, max_travel_time_mins):
-    traveltime_api_url = 'http://api.traveltimeapp.com/v4/time-map'
+    return get_public_transport_isochrone(target_lng_lat, mode, max_travel_time_mins)['geometry']
+
+
+@timeit
+def get_public_transport_isochrone_fetched(target_lng_lat, mode, max_travel_time_mins):
+    # Anything memoized from an isochrone should include this in its key, so once a stale isochrone is revalidated
+    # the results computed from it are too, rather than the old ones being served on until they expire
+    return get_public_transport_isochrone(target_lng_lat, mode, max_travel_time_mins)['fetched']
+
+
+@timeit
+def get_public_transport_isochrone(target_lng_lat, mode, max_travel_time_mins):
+    search = (target_lng_lat, mode, max_travel_time_mins)
+    search_id = get_isochrone_search_id(*search)
+    isochrones = get_public_transport_isochrones([search])
+
+    if search_id not in isochrones:
+        raise Exception('TravelTime API returned no result for search: ' + search_id)
+
+    return isochrones[search_id]
+
+
+@timeit
+def get_isochrone_search_id(target_lng_lat, mode, max_travel_time_mins):
+    return str(target_lng_lat) + "-" + mode + "-" + str(max_travel_time_mins)
+
+
+@timeit
+def get_next_departure_time(slot_name, now=None):
+    # The next time (at least an hour from now) in the given departure slot, in the format TravelTime expects
+    departure_slot_times = departure_slots[slot_name]
+    earliest = (now or datetime.datetime.now(datetime.timezone.utc)) + datetime.timedelta(hours=1)
+
+    for days_ahead in range(8):
+        departure = (earliest + datetime.timedelta(days=days_ahead)).replace(
+            hour=departure_slot_times['hour'], minute=departure_slot_times['minute'], second=0, microsecond=0)
+
+        if departure.weekday() in departure_slot_times['weekdays'] and departure >= earliest:
+            return departure.strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+    raise ValueError('Departure slot has no weekdays: ' + slot_name)
+
+
+@timeit
+def get_isochrone_cache_key(search_id):
+    return isochrone_cache_prefix + departure_slot + ':' + search_id
+
+
+@timeit
+def get_public_transport_isochrone_geometries(searches):
+    return {
+        search_id: isochrone['geometry'] for search_id, isochrone in get_public_transport_isochrones(searches).items()
+    }
+
+
+@timeit
+def get_public_transport_isochrones(searches):
+    # Each search's geometry, and when it was fetched from the API. Each search is cached on its own, so it doesn't
+    # matter which batch of searches originally fetched it.
+    searches_by_id = {get_isochrone_search_id(*search): search for search in searches}
+    cache_keys = {search_id: get_isochrone_cache_key(search_id) for search_id in searches_by_id}
+
+    cached_isochrones = transient_cache.get_many(list(cache_keys.values())) or {}
+    isochrones = {
+        search_id: cached_isochrones[cache_key] for search_id, cache_key in cache_keys.items()
+        if cache_key in cached_isochrones
+    }
+
+    stale_search_ids = [
+        search_id for search_id, isochrone in isochrones.items()
+        if time.time() - isochrone['fetched'] > isochrone_revalidate_seconds
+    ]
+    pending_search_ids = [search_id for search_id in searches_by_id if search_id not in isochrones]
+
+    logging.debug('Isochrone searches requested: %1.0f - already cached: %1.0f - stale: %1.0f' % (
+        len(searches_by_id), len(isochrones), len(stale_search_ids)
+    ))
+
+    if stale_search_ids:
+        schedule_isochrone_refresh({search_id: searches_by_id[search_id] for search_id in stale_search_ids})
+
+    isochrones.update(fetch_and_cache_isochrones(
+        {search_id: searches_by_id[search_id] for search_id in pending_search_ids}
+    ))
+
+    return isochrones
+
+
+@timeit
+def fetch_and_cache_isochrones(searches_by_id, refresh=False):
+    isochrones = {}
+    search_ids = list(searches_by_id.keys())
+
+    # TravelTime accepts many searches in a single request, which only counts once against the rate limit
+    for batch_start in range(0, len(search_ids), traveltime_max_searches_per_request):
+        batch_search_ids = search_ids[batch_start:batch_start + traveltime_max_searches_per_request]
+        batch_geometries, batch_fetched = fetch_isochrone_geometries_batch(
+            {search_id: searches_by_id[search_id] for search_id in batch_search_ids}, refresh
+        )
+        batch_isochrones = {
+            search_id: {'geometry': geometry, 'fetched': batch_fetched}
+            for search_id, geometry in batch_geometries.items()
+        }
+
+        transient_cache.set_many({
+            get_isochrone_cache_key(search_id): isochrone for search_id, isochrone in batch_isochrones.items()
+        })
+        isochrones.update(batch_isochrones)
+
+    return isochrones
+
+
+@timeit
+def schedule_isochrone_refresh(searches_by_id):
+    # Within this process, each stale search is only queued once however many requests find it stale meanwhile
+    with isochrone_refreshing_lock:
+        searches_by_id = {
+            search_id: search for search_id, search in searches_by_id.items()
+            if get_isochrone_cache_key(search_id) not in isochrone_refreshing_keys
+        }
+        isochrone_refreshing_keys.update(get_isochrone_cache_key(search_id) for search_id in searches_by_id)
+
+    if searches_by_id:
+        logging.info('Refreshing stale isochrones in the background: ' + ', '.join(searches_by_id.keys()))
+        isochrone_refresh_executor.submit(refresh_isochrone_geometries, searches_by_id)
+
+
+def refresh_isochrone_geometries(searches_by_id):
+    try:
+        fetch_and_cache_isochrones(searches_by_id, refresh=True)
+    except Exception as e:
+        # The stale isochrones are still cached, so they'll just be retried by the next search which finds them
+        logging.warning('Background isochrone refresh failed: ' + str(e))
+    finally:
+        with isochrone_refreshing_lock:
+            isochrone_refreshing_keys.difference_update(
+                get_isochrone_cache_key(search_id) for search_id in searches_by_id)
+
+
+@timeit
+def fetch_isochrone_geometries_batch(searches_by_id, refresh=False):
+    # Returns each search's geometry, and when the response they came in was fetched from the API
     public_transport_isochrone_request_headers = {
         'Content-Type': 'application/json',
         "X-Application-Id": os.environ['TRAVELTIME_APP_ID'],
         "X-Api-Key": os.environ['TRAVELTIME_API_KEY'],
     }
-    
-    departure_time = strftime("%Y-%m-%d") + "T08:00:00+0000"
-
-    public_transport_isochrone_request_body = {
-        "departure_searches": [
-            {
-                "id": str(target_lng_lat) + "-" + mode + "-" + str(max_travel_time_mins),
-                "coords": {"lng": target_lng_lat[0], "lat": target_lng_lat[1]},
-                "transportation": {"type": mode},
-                "departure_time": departure_time,
-                "travel_time": int(max_travel_time_mins) * int(60)
-            }
-        ],
-        "arrival_searches": []
-    }
 
-    logging.debug('Making HTTP request to TravelTime API for mode: %s with mins: %1.0f' % (
-        mode, int(max_travel_time_mins)
-    ))
+    def get_request_body(search_departure_time):
+        return {
+            "departure_searches": [
+                {
+                    "id": search_id,
+                    "coords": {"lng": target_lng_lat[0], "lat": target_lng_lat[1]},
+                    "transportation": {"type": mode},
+                    "departure_time": search_departure_time,
+                    "travel_time": int(max_travel_time_mins) * int(60)
+                }
+                for search_id, (target_lng_lat, mode, max_travel_time_mins) in searches_by_id.items()
+            ],
+            "arrival_searches": []
+        }
+
+    # The request departs at the next real time in the slot, but it's cached under the slot's name
+    public_transport_isochrone_request_body = get_request_body(get_next_departure_time(departure_slot))
+    public_transport_isochrone_cache_body = get_request_body(departure_slot)
 
-    response = call_traveltime_api(
+    logging.debug('Making HTTP request to TravelTime API for searches: %s' % ', '.join(searches_by_id.keys()))
+
+    response, fetched = call_traveltime_api(
         traveltime_api_url,
         public_transport_isochrone_request_body,
         public_transport_isochrone_request_headers,
+        public_transport_isochrone_cache_body,
+        refresh
     )
     json_response = response.json()
 
@@ -69,12 +286,22 @@ def get_public_transport_isochrone_geometry(target_lng_lat, mode, max_travel_tim
         logging.debug("Error response from API call: " + str(json_response))
         raise Exception(str(json_response))
 
-    public_transport_isochrone_shapes = json_response['results'][0]['shapes']
+    isochrone_geometries = {}
+    for search_result in json_response['results']:
+        logging.log(logging.DEBUG, 'Received response from TravelTime API for search: %s with shapes: %1.0f' % (
+            search_result['search_id'], len(search_result['shapes'])
+        ))
+
+        isochrone_geometries[search_result['search_id']] = normalise_travel_time_shapes(search_result['shapes'])
 
-    logging.log(logging.DEBUG,
-                'Received response from TravelTime API with shapes: %1.0f' % len(public_transport_isochrone_shapes))
+    # Any search the API didn't answer is left out of the results, so it isn't cached and is asked for again next time
+    missing_search_ids = [search_id for search_id in searches_by_id if search_id not in isochrone_geometries]
+    if missing_search_ids:
+        logging.warning('TravelTime API returned no result for searches: ' + ', '.join(missing_search_ids))
+        uncache_traveltime_response(
+            traveltime_api_url, public_transport_isochrone_cache_body, public_transport_isochrone_request_headers)
 
-    return normalise_travel_time_shapes(public_transport_isochrone_shapes)
+    return isochrone_geometries, fetched
 
 
 @timeit
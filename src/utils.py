@@ -1,12 +1,33 @@
+import fcntl
 import logging
 import os
 import sys
 import time
+from contextlib import contextmanager
 from pyunpack import Archive
 
 methods_timings_cumulative = {}
 
 
+class InvalidRequestError(Exception):
+    # A request we can't serve as asked, e.g. a bad parameter, so the server responds with a 400 rather than a 500
+    pass
+
+
+def parse_boolean_param(value, param_name, default):
+    # JSON booleans, or the strings a query string or form would send; bool() alone would make "false" True
+    if value is None or value == '':
+        return default
+    if value is True or value is False:
+        return value
+    if str(value).lower() in ('true', '1'):
+        return True
+    if str(value).lower() in ('false', '0'):
+        return False
+
+    raise InvalidRequestError("Invalid boolean for " + param_name + ": " + str(value))
+
+
 def timeit(method):
     global methods_timings_cumulative
 
@@ -82,3 +103,14 @@ def preload_files(url_root, files_to_check):
 
         else:
             logging.info("Preload file already exists: " + fetch_filepath)
+
+
+@contextmanager
+def file_lock(lock_filepath):
+    # Held by one process at a time (across every worker process, not just threads), and released if it dies
+    with open(lock_filepath, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
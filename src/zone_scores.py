@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from src.imd_dataset import rank_type_properties
+from src.imd_tools import query_uk_zone_indexes_in_bounds, get_zones_weighted_scores, get_rank_weights_vector, \
+    get_uk_zones_geometries
+from src.level_of_detail import resolve_lod
+from src.utils import timeit, InvalidRequestError, parse_boolean_param
+
+# A UK-wide viewport holds around 40k zones, far too many geometries to encode and send in one response, so the
+# choropleth is only built for bounds with at most this many zones in them
+max_choropleth_zones = int(os.environ.get('HOMEAREA_MAX_CHOROPLETH_ZONES', 5000))
+
+
+# Rather than a hard cutoff for each rank type, every zone in the requested bounds gets a score from a weighted mean
+# of its deciles, and the map shows them as a choropleth with a score threshold. The zone shapes don't depend on the
+# weights, so the browser only asks for them once per bounds; moving a weight slider only re-requests the scores,
+# and moving the threshold slider doesn't need the server at all.
+
+@timeit
+def get_zone_scores(input_bounds, rank_weights, min_score=0, include_geometry=True, lod=None):
+    zone_indexes = query_uk_zone_indexes_in_bounds(Polygon.from_bounds(*input_bounds))
+
+    if include_geometry and len(zone_indexes) > max_choropleth_zones:
+        raise InvalidRequestError("The score map can show up to %d zones at once, but there are %d in view - "
+                                  "please zoom in and try again" % (max_choropleth_zones, len(zone_indexes)))
+
+    zone_scores = get_zones_weighted_scores(zone_indexes, rank_weights)
+    scores_lod = resolve_lod(lod, input_bounds)
+
+    logging.info("Scored %d zones in bounds, %d with score >= %s" % (
+        len(zone_indexes), np.count_nonzero(zone_scores >= min_score), str(min_score)))
+
+    return {
+        'zones': zone_indexes,
+        'scores': zone_scores,
+        'min_score': min_score,
+        'lod': scores_lod,
+        'geometries': get_uk_zones_geometries(zone_indexes, scores_lod) if include_geometry else None
+    }
+
+
+@timeit
+def build_choropleth_geojson(zone_indexes, zone_scores, zone_geometries):
+    # Each zone's geometry is encoded straight to a GeoJSON string by GEOS, which is far quicker than building
+    # nested Python lists with mapping() and then dumping them again. Feature ids are the zone indexes, so the
+    # browser can update each zone's score in place with feature state.
+    features_json = [
+        '{"type":"Feature","id":%d,"properties":{"score":%.2f},"geometry":%s}' % (
+            zone_index, zone_score, geometry_json)
+        for zone_index, zone_score, geometry_json in zip(
+            zone_indexes.tolist(), zone_scores.tolist(), shapely.to_geojson(zone_geometries))
+    ]
+
+    return '{"type":"FeatureCollection","features":[' + ','.join(features_json) + ']}'
+
+
+@timeit
+def parse_score_number(value, param_name):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise InvalidRequestError("Invalid number for " + param_name + ": " + str(value))
+
+    if not np.isfinite(number):
+        raise InvalidRequestError("Invalid number for " + param_name + ": " + str(value))
+
+    return number
+
+
+@timeit
+def parse_score_bounds(bounds):
+    # [min lng, min lat, max lng, max lat], as the map's getBounds().toArray() flattened
+    if not isinstance(bounds, (list, tuple)) or len(bounds) != 4:
+        raise InvalidRequestError("Invalid bounds, expected [min lng, min lat, max lng, max lat]: " + str(bounds))
+
+    input_bounds = [parse_score_number(bound, 'bounds') for bound in bounds]
+    if input_bounds[0] >= input_bounds[2] or input_bounds[1] >= input_bounds[3]:
+        raise InvalidRequestError("Invalid bounds, the minimums must be less than the maximums: " + str(bounds))
+
+    return input_bounds
+
+
+@timeit
+def parse_score_weights(weights):
+    # Blank weights count as 0, the same as a rank type which isn't weighted at all
+    if weights is None:
+        return {}
+    if not isinstance(weights, dict):
+        raise InvalidRequestError("Invalid weights, expected an object: " + str(weights))
+
+    rank_weights = {}
+    for rank_type, weight in weights.items():
+        if rank_type not in rank_type_properties:
+            raise InvalidRequestError("Unknown rank type in weights: " + str(rank_type))
+
+        rank_weights[rank_type] = parse_score_number(weight, 'weights.' + rank_type) if weight not in (None, '') else 0
+
+    return rank_weights
+
+
+@timeit
+def get_zone_scores_json(params: dict):
+    # Anything in the request which isn't what we expect is a mistake in it, so it's a 400 rather than a 500
+    if not isinstance(params, dict):
+        raise InvalidRequestError("Invalid zone scores request, expected an object: " + str(params))
+
+    rank_weights = parse_score_weights(params.get('weights'))
+    zone_scores = get_zone_scores(
+        input_bounds=parse_score_bounds(params.get('bounds')),
+        rank_weights=rank_weights,
+        min_score=parse_score_number(params['minScore'], 'minScore') if params.get('minScore') not in (None, '') else 0,
+        include_geometry=parse_boolean_param(params.get('geometry'), 'geometry', True),
+        lod=params.get('lod')
+    )
+
+    response_object = {
+        'weights': dict(zip(rank_type_properties, get_rank_weights_vector(rank_weights).round(4).tolist())),
+        'min_score': zone_scores['min_score'],
+        'passing_zones': int(np.count_nonzero(zone_scores['scores'] >= zone_scores['min_score'])),
+        'lod': zone_scores['lod'],
+        'zones': zone_scores['zones'].tolist(),
+        'scores': zone_scores['scores'].round(2).tolist()
+    }
+
+    if zone_scores['geometries'] is None:
+        return json.dumps(response_object)
+
+    # The choropleth is already encoded, so it's spliced into the response rather than decoded and dumped again
+    return '{"choropleth":' + build_choropleth_geojson(
+        zone_scores['zones'], zone_scores['scores'], zone_scores['geometries']
+    ) + ',' + json.dumps(response_object)[1:]
@@ -61,6 +61,22 @@ $(function () {
         return false;
     });
 
+    $("#scoreMapButton").click(function (e) {
+        show_score_map();
+        return false;
+    });
+
+    $(".scoreWeightInput").on('input', function (e) {
+        // Only the scores are re-requested as weights change, and only once the slider pauses
+        clearTimeout(window.scoreWeightsTimeout);
+        window.scoreWeightsTimeout = setTimeout(update_score_map_scores, 150);
+    });
+
+    $("#minScoreInput").on('input', function (e) {
+        $('#minScoreValue').text($(this).val());
+        update_score_map_threshold();
+    });
+
     $('#generateSearchAreaForm').submit(function (e) {
         e.stopPropagation();
         e.preventDefault();
@@ -456,6 +472,10 @@ function add_new_target_to_accordion(showTargetCard) {
     newTargetCard.get()[0].scrollIntoView();
     newTargetCard.find('.targetAddressInput').focus();
 
+    newTargetCard.find('.targetAddressInput').on('input', function () {
+        update_address_suggestions($(this).val());
+    });
+
     newTargetCard.find('input').focus(function () {
         let buttonText = get_target_button_text(newTargetKey, newTargetCard);
 
@@ -472,11 +492,56 @@ function add_new_target_to_accordion(showTargetCard) {
     return newTargetCard;
 }
 
+function update_address_suggestions(address_prefix) {
+    // Only ask once typing pauses, and only show the reply to the latest request, so a slow reply for an older
+    // prefix never overwrites the suggestions for what's in the box now
+    clearTimeout(window.addressSuggestionsTimer);
+    window.addressSuggestionsRequest = (window.addressSuggestionsRequest || 0) + 1;
+
+    if (address_prefix.length < 2) return;
+
+    let suggestions_request = window.addressSuggestionsRequest;
+
+    window.addressSuggestionsTimer = setTimeout(function () {
+        $.getJSON('/geocode/suggest', {q: address_prefix}, function (suggestions) {
+            if (suggestions_request !== window.addressSuggestionsRequest) return;
+
+            let suggestions_list = $('#addressSuggestions').empty();
+
+            suggestions.forEach(function (suggestion) {
+                suggestions_list.append($('<option>').attr('value', suggestion['address']));
+            });
+        });
+    }, 200);
+}
+
 function toggle_loading_state() {
     $("#generateButton").toggle();
     $('#generateButtonLoading').toggle();
     $("#propertyButton").hide();
     $('#targetsAccordion .collapse').collapse('hide');
+
+    if ($('#generateButtonLoading').is(':visible')) {
+        window.rateLimitsPoller = setInterval(update_rate_limits_eta, 2000);
+    } else {
+        clearInterval(window.rateLimitsPoller);
+        $('#generateButtonLoadingText').text('Working...');
+    }
+}
+
+function update_rate_limits_eta() {
+    // If we're queued behind an API rate limit, show roughly how long it'll be rather than an unexplained wait
+    $.getJSON('/rate_limits', function (rateLimits) {
+        let waitSeconds = Math.max(0, ...rateLimits.map(function (rateLimit) {
+            return rateLimit.queued > 0 ? rateLimit.wait_seconds : 0;
+        }));
+
+        if (waitSeconds > 0) {
+            $('#generateButtonLoadingText').text('Waiting for API rate limit, ~' + Math.ceil(waitSeconds) + 's...');
+        } else {
+            $('#generateButtonLoadingText').text('Working...');
+        }
+    });
 }
 
 function get_single_target_array(single_card) {
@@ -766,3 +831,90 @@ function plot_results(api_call_data) {
         window.mainMap.map.fitBounds(result_intersection['bounds']);
     }
 }
+
+function get_score_weights() {
+    let weights = {};
+    $('.scoreWeightInput').each(function (index, elem) {
+        weights[$(elem).data('ranktype')] = parseFloat($(elem).val());
+    });
+    return weights;
+}
+
+function request_zone_scores(include_geometry, success_callback) {
+    $.ajax({
+        url: "/zone_scores",
+        type: 'POST',
+        contentType: 'application/json',
+        data: JSON.stringify({
+            bounds: window.scoreMapBounds,
+            weights: get_score_weights(),
+            minScore: parseFloat($('#minScoreInput').val()),
+            geometry: include_geometry
+        }),
+        success: success_callback,
+        error: function (jqXHR) {
+            show_iframe_error_modal(jqXHR.responseText);
+        }
+    });
+}
+
+function show_score_map() {
+    let map_bounds = window.mainMap.map.getBounds();
+    window.scoreMapBounds = [
+        map_bounds.getWest(), map_bounds.getSouth(), map_bounds.getEast(), map_bounds.getNorth()
+    ];
+
+    request_zone_scores(true, function (data) {
+        let map = window.mainMap.map;
+
+        if (map.getLayer('score_choropleth')) {
+            map.removeLayer('score_choropleth');
+            map.removeSource('score_choropleth');
+        }
+
+        map.addLayer({
+            'id': 'score_choropleth',
+            'type': 'fill',
+            'source': {
+                'type': 'geojson',
+                'data': data['choropleth']
+            },
+            'paint': {
+                'fill-color': [
+                    'interpolate', ['linear'], ['coalesce', ['feature-state', 'score'], ['get', 'score']],
+                    1, '#e6194B', 5.5, '#ffe119', 10, '#3cb44b'
+                ],
+                'fill-opacity': get_score_map_opacity()
+            },
+            'metadata': {
+                'home-area-helper': true
+            }
+        });
+    });
+}
+
+function update_score_map_scores() {
+    if (!window.scoreMapBounds || !window.mainMap.map.getLayer('score_choropleth')) return;
+
+    // The zone shapes are already on the map, so only each zone's new score is applied to it
+    request_zone_scores(false, function (data) {
+        data['zones'].forEach(function (zone_id, zone_index) {
+            window.mainMap.map.setFeatureState(
+                {source: 'score_choropleth', id: zone_id},
+                {score: data['scores'][zone_index]}
+            );
+        });
+    });
+}
+
+function get_score_map_opacity() {
+    let min_score = parseFloat($('#minScoreInput').val());
+    return ['case', ['>=', ['coalesce', ['feature-state', 'score'], ['get', 'score']], min_score], 0.6, 0];
+}
+
+function update_score_map_threshold() {
+    // The threshold is applied entirely in the browser, so it follows the slider with no requests at all
+    if (window.mainMap.map.getLayer('score_choropleth')) {
+        window.mainMap.map.setPaintProperty('score_choropleth', 'fill-opacity', get_score_map_opacity());
+    }
+}
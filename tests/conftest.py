@@ -0,0 +1,101 @@
+import importlib
+import json
+import os
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+# The tests import the app's modules as the server does, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests_cache  # noqa: E402
+
+from src import rate_limiter  # noqa: E402
+from src.tiered_cache import TieredSqliteCache  # noqa: E402
+
+# The app's modules which use the caches from run_server, directly or through another of these, so they're imported
+# afresh against each test's caches
+run_server_dependent_modules = [
+    'src.travel_time', 'src.google_maps', 'src.city_gazetteer', 'src.geocode_index', 'src.mapbox',
+    'src.multi_polygons', 'src.imd_tools', 'src.target_area', 'src.target_cities', 'src.zone_scores',
+]
+
+
+@pytest.fixture
+def run_server_caches(tmp_path, monkeypatch):
+    # run_server downloads the datasets and starts the app when imported, so the modules under test get just the
+    # caches they use, backed by temporary files
+    run_server_caches = types.ModuleType('run_server')
+    run_server_caches.requests_cache = requests_cache.core.CachedSession(
+        cache_name=str(tmp_path / 'requests_cache'), backend='sqlite', allowable_methods=('GET', 'POST'))
+
+    for cache_name in ['api_cache', 'static_cache', 'transient_cache']:
+        setattr(run_server_caches, cache_name, TieredSqliteCache(
+            filename=str(tmp_path / (cache_name + '.sqlite')), cache_size=100, timeout=3600))
+
+    monkeypatch.setitem(sys.modules, 'run_server', run_server_caches)
+    monkeypatch.setattr(rate_limiter, 'rate_limits_db_path', str(tmp_path / 'rate_limits.sqlite'))
+
+    for module_name in run_server_dependent_modules:
+        sys.modules.pop(module_name, None)
+
+    yield run_server_caches
+
+    for module_name in run_server_dependent_modules:
+        sys.modules.pop(module_name, None)
+
+
+class TravelTimeStubHandler(BaseHTTPRequestHandler):
+    # Answers a time-map request with one single-square shape per departure search, centred on the search's coords and
+    # shape_size degrees either side of them, leaving out any search whose id is in the server's omit_search_ids
+    def do_POST(self):
+        request_body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.request_bodies.append(request_body)
+
+        results = [
+            {
+                'search_id': search['id'],
+                'shapes': [{'shell': [
+                    {'lng': search['coords']['lng'] + lng_sign * self.server.shape_size,
+                     'lat': search['coords']['lat'] + lat_sign * self.server.shape_size}
+                    for lng_sign, lat_sign in [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+                ], 'holes': []}]
+            }
+            for search in request_body['departure_searches'] if search['id'] not in self.server.omit_search_ids
+        ]
+
+        response_body = json.dumps({'results': results}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def traveltime_stub():
+    stub_server = HTTPServer(('127.0.0.1', 0), TravelTimeStubHandler)
+    stub_server.request_bodies = []
+    stub_server.omit_search_ids = set()
+    stub_server.shape_size = 0.01
+    threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+
+    yield stub_server
+
+    stub_server.shutdown()
+    stub_server.server_close()
+
+
+@pytest.fixture
+def travel_time(run_server_caches, traveltime_stub, monkeypatch):
+    monkeypatch.setenv('TRAVELTIME_API_URL', 'http://127.0.0.1:%d/v4/time-map' % traveltime_stub.server_port)
+    monkeypatch.setenv('TRAVELTIME_APP_ID', 'test-app-id')
+    monkeypatch.setenv('TRAVELTIME_API_KEY', 'test-api-key')
+
+    return importlib.import_module('src.travel_time')
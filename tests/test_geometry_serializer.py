@@ -0,0 +1,70 @@
+import pickle
+
+import pytest
+import shapely
+from shapely.geometry import MultiPolygon, Point
+
+from src.tiered_cache import TieredSqliteCache
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite')
+
+
+def get_stored_blobs_count(cache):
+    return cache._db.execute_sql('SELECT COUNT(*) FROM geometry_blobs').fetchone()[0]
+
+
+def test_geometries_round_trip_through_wkb(cache_path):
+    polygon = Point(-1.9, 52.48).buffer(0.01)
+    value = {'label': 'Birmingham', 'polygon': polygon, 'parts': [MultiPolygon([polygon]), None]}
+    TieredSqliteCache(filename=cache_path).set('value', value)
+
+    # A fresh cache, so the value comes from SQLite rather than the memory tier
+    loaded_value = TieredSqliteCache(filename=cache_path).get('value')
+
+    assert loaded_value['label'] == 'Birmingham'
+    assert shapely.equals_exact(loaded_value['polygon'], polygon, 0)
+    assert shapely.equals_exact(loaded_value['parts'][0], MultiPolygon([polygon]), 0)
+    assert loaded_value['parts'][1] is None
+
+
+def test_same_geometry_is_stored_once(cache_path):
+    cache = TieredSqliteCache(filename=cache_path)
+    polygon = Point(-1.9, 52.48).buffer(0.01)
+
+    cache.set_many({'a': polygon, 'b': (polygon, shapely.from_wkb(shapely.to_wkb(polygon))), 'c': [polygon]})
+    assert get_stored_blobs_count(cache) == 1
+
+    # The blob is looked up by hash, and every value referencing it gets the same decoded geometry
+    loaded_cache = TieredSqliteCache(filename=cache_path)
+    loaded_values = loaded_cache.get_many(['a', 'b', 'c'])
+    assert loaded_values['a'] is loaded_values['b'][0] is loaded_values['c'][0]
+
+
+def test_grid_size_snaps_geometries(cache_path):
+    cache = TieredSqliteCache(filename=cache_path, geometry_grid_size=0.001)
+    cache.set_many({'a': Point(1.00001, 2.00001), 'b': Point(1.00002, 2.00002)})
+
+    assert get_stored_blobs_count(cache) == 1
+    assert TieredSqliteCache(filename=cache_path).get('b').equals(Point(1, 2))
+
+
+def test_pickles_without_geometry_blobs_still_load(cache_path):
+    cache = TieredSqliteCache(filename=cache_path)
+
+    assert cache.unpack(pickle.dumps({'polygon': Point(0, 0).buffer(1)}))['polygon'].area > 3
+
+
+def test_missing_geometry_blob_is_a_miss(cache_path):
+    cache = TieredSqliteCache(filename=cache_path)
+    cache.set('value', Point(0, 0).buffer(1))
+    cache._db.execute_sql('DELETE FROM geometry_blobs')
+
+    loaded_cache = TieredSqliteCache(filename=cache_path)
+    assert loaded_cache.get('value') is None
+
+    # Stored again rather than assumed to still be there
+    loaded_cache.set('value', Point(0, 0).buffer(1))
+    assert get_stored_blobs_count(loaded_cache) == 1
@@ -0,0 +1,42 @@
+import importlib
+
+import pytest
+
+
+class GeocoderStub:
+    # Knows a single address, and records every address it's asked for
+    def __init__(self):
+        self.geocoded_addresses = []
+
+    def geocode(self, address_string):
+        self.geocoded_addresses.append(address_string)
+
+        if address_string == 'Birmingham, UK':
+            return [{'geometry': {'location': {'lng': -1.9, 'lat': 52.48}}}]
+
+        return []
+
+
+@pytest.fixture
+def geocoder_stub(run_server_caches, monkeypatch):
+    geocoder_stub = GeocoderStub()
+    monkeypatch.setattr(importlib.import_module('src.google_maps'), 'get_gmaps_client', lambda: geocoder_stub)
+
+    return geocoder_stub
+
+
+def test_addresses_which_cant_be_found_are_cached(geocoder_stub):
+    google_maps = importlib.import_module('src.google_maps')
+
+    for attempt in range(2):
+        assert google_maps.get_centre_points_lng_lat_for_addresses(['Birmingham, UK']) == [[-1.9, 52.48]]
+        assert google_maps.get_centre_points_lng_lat_for_addresses(['Nowhere, UK']) == [None]
+
+    assert geocoder_stub.geocoded_addresses == ['Birmingham, UK', 'Nowhere, UK']
+
+
+def test_address_which_cant_be_found_doesnt_resolve(geocoder_stub, monkeypatch):
+    geocode_index = importlib.import_module('src.geocode_index')
+    monkeypatch.setattr(geocode_index, 'lookup_address', lambda address_string: None)
+
+    assert geocode_index.resolve_address('Nowhere, UK') is None
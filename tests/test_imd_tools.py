@@ -0,0 +1,52 @@
+import importlib
+
+import numpy as np
+import pytest
+import shapely
+from shapely.strtree import STRtree
+
+
+@pytest.fixture
+def imd_tools(run_server_caches, monkeypatch):
+    imd_tools = importlib.import_module('src.imd_tools')
+
+    # Three unit square zones side by side from lng 0 to 3, each better on a different rank
+    zone_boxes = shapely.box([0, 1, 2], [0, 0, 0], [1, 2, 3], [1, 1, 1])
+    monkeypatch.setattr(imd_tools, 'uk_zones_index', {
+        'tree': STRtree(zone_boxes),
+        'centroids_x': np.array([0.5, 1.5, 2.5]),
+        'centroids_y': np.array([0.5, 0.5, 0.5]),
+        'deciles': {'income': np.array([9, 2, 5]), 'crime': np.array([2, 9, 5])},
+    })
+    monkeypatch.setattr(imd_tools, 'get_rank_layer_index', lambda *args: {'tree': STRtree(zone_boxes)})
+
+    return imd_tools
+
+
+def test_most_selective_filter_is_planned_first(imd_tools):
+    planned_filters, rules_out_everything = imd_tools.plan_min_rank_filters((0, 0, 3, 1), {'income': 2, 'crime': 5})
+
+    assert planned_filters == [('crime', 5), ('income', 2)]
+    assert not rules_out_everything
+
+
+def test_no_zone_passing_every_filter_rules_out_everything(imd_tools):
+    # Each filter alone passes a zone, but no one zone passes both
+    planned_filters, rules_out_everything = imd_tools.plan_min_rank_filters((0, 0, 3, 1), {'income': 9, 'crime': 9})
+
+    assert len(planned_filters) == 2
+    assert rules_out_everything
+
+
+def test_zones_only_touching_the_area_are_considered(imd_tools):
+    # The zone which passes both has its centroid outside the area, but still overlaps it
+    planned_filters, rules_out_everything = imd_tools.plan_min_rank_filters((0, 0, 2.2, 1), {'income': 5, 'crime': 5})
+
+    assert not rules_out_everything
+
+
+def test_no_zones_under_the_area_rules_nothing_out(imd_tools):
+    planned_filters, rules_out_everything = imd_tools.plan_min_rank_filters((10, 10, 11, 11), {'income': 10})
+
+    assert planned_filters == [('income', 10)]
+    assert not rules_out_everything
@@ -0,0 +1,17 @@
+import pytest
+
+from src.level_of_detail import resolve_lod
+from src.utils import InvalidRequestError
+
+city_bounds = (-2.0, 52.3, -1.7, 52.6)
+
+
+@pytest.mark.parametrize('lod, expected_lod', [(None, 1), ('', 1), ('auto', 1), (2, 2), ('2', 2), (-1, 0), ('9', 3)])
+def test_resolve_lod(lod, expected_lod):
+    assert resolve_lod(lod, city_bounds) == expected_lod
+
+
+@pytest.mark.parametrize('lod', ['fine', '1.5', [1], {}])
+def test_invalid_lod_is_a_bad_request(lod):
+    with pytest.raises(InvalidRequestError, match='Invalid level of detail'):
+        resolve_lod(lod, city_bounds)
@@ -0,0 +1,48 @@
+import importlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from src import rate_limiter
+
+
+class MapboxStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.request_paths.append(self.path)
+
+        response_body = json.dumps({'features': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mapbox_stub():
+    stub_server = HTTPServer(('127.0.0.1', 0), MapboxStubHandler)
+    stub_server.request_paths = []
+    threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+
+    yield stub_server
+
+    stub_server.shutdown()
+    stub_server.server_close()
+
+
+def test_cached_responses_dont_use_rate_limit_tokens(run_server_caches, mapbox_stub, monkeypatch):
+    # Refilled slowly enough that every token the test takes is still missing at the end
+    monkeypatch.setitem(rate_limiter.rate_limit_providers, 'mapbox', {'capacity': 10, 'period': 1000000})
+    mapbox = importlib.import_module('src.mapbox')
+    url = 'http://127.0.0.1:%d/isochrone/v1/mapbox/walking/-1.0,52.0' % mapbox_stub.server_port
+
+    for call in range(3):
+        assert mapbox.call_mapbox_api(url).json() == {'features': []}
+
+    assert len(mapbox_stub.request_paths) == 1
+    assert rate_limiter.get_rate_limit_status('mapbox')['tokens'] == pytest.approx(9)
@@ -0,0 +1,45 @@
+import importlib
+
+import pytest
+from shapely.geometry import MultiPolygon, Polygon, box
+
+
+@pytest.fixture
+def multi_polygons(run_server_caches):
+    return importlib.import_module('src.multi_polygons')
+
+
+# Four unit squares: b is 1 to the right of a, c is 2 to the right of b, and d is 2 above a
+squares = {'a': box(0, 0, 1, 1), 'b': box(2, 0, 3, 1), 'c': box(5, 0, 6, 1), 'd': box(0, 3, 1, 4)}
+
+
+def test_fragments_are_joined_along_the_shortest_lines(multi_polygons):
+    connecting_lines = multi_polygons.get_minimum_spanning_connecting_lines(
+        multi_polygons.get_polygons_array(MultiPolygon(list(squares.values()))))
+
+    # The minimum spanning tree is a-b, b-c and a-d; c-d or a-c would be longer
+    joined_pairs = sorted(
+        ''.join(name for name, square in squares.items() if square.intersects(connecting_line))
+        for connecting_line in connecting_lines
+    )
+    assert joined_pairs == ['ab', 'ad', 'bc']
+
+
+def test_fragments_are_joined_into_a_single_polygon(multi_polygons):
+    joined_polygon = multi_polygons.join_multi_to_single_poly(MultiPolygon(list(squares.values())))
+
+    assert isinstance(joined_polygon, Polygon)
+    assert all(joined_polygon.buffer(0.000001).contains(square) for square in squares.values())
+
+    # Only thin corridors are added, not e.g. the convex hull
+    assert joined_polygon.area < sum(square.area for square in squares.values()) + 1
+
+
+def test_overlapping_fragments_are_just_unioned(multi_polygons):
+    joined_polygon = multi_polygons.join_multi_to_single_poly(MultiPolygon([box(0, 0, 2, 1), box(1, 0, 3, 1)]))
+
+    assert joined_polygon.equals(box(0, 0, 3, 1))
+
+
+def test_single_polygon_is_unchanged(multi_polygons):
+    assert multi_polygons.join_multi_to_single_poly(squares['a']).equals(squares['a'])
@@ -0,0 +1,57 @@
+import pytest
+
+from src import rate_limiter
+
+
+@pytest.fixture
+def clock(tmp_path, monkeypatch):
+    # Every reservation happens at the time the test sets, rather than whenever the test gets to it
+    monkeypatch.setattr(rate_limiter, 'rate_limits_db_path', str(tmp_path / 'rate_limits.sqlite'))
+    monkeypatch.setitem(rate_limiter.rate_limit_providers, 'test', {'capacity': 2, 'period': 10})
+
+    clock = {'now': 1000.0}
+    monkeypatch.setattr(rate_limiter.time, 'time', lambda: clock['now'])
+
+    return clock
+
+
+def test_bucket_starts_full_then_queues_callers(clock):
+    assert rate_limiter.reserve_rate_limit_token('test') == 0
+    assert rate_limiter.reserve_rate_limit_token('test') == 0
+
+    # The bucket goes negative, and each caller waits for the next token in turn: one every 5 seconds
+    assert rate_limiter.reserve_rate_limit_token('test') == pytest.approx(5)
+    assert rate_limiter.reserve_rate_limit_token('test') == pytest.approx(10)
+
+    rate_limit_status = rate_limiter.get_rate_limit_status('test')
+    assert rate_limit_status['tokens'] == 0
+    assert rate_limit_status['queued'] == 2
+    assert rate_limit_status['wait_seconds'] == pytest.approx(15)
+
+
+def test_tokens_refill_up_to_capacity(clock):
+    for reservation in range(3):
+        rate_limiter.reserve_rate_limit_token('test')
+
+    clock['now'] += 5
+    assert rate_limiter.get_rate_limit_status('test')['tokens'] == pytest.approx(0)
+
+    clock['now'] += 7.5
+    assert rate_limiter.get_rate_limit_status('test')['tokens'] == pytest.approx(1.5)
+
+    # However long it's been, the bucket never holds more than its capacity
+    clock['now'] += 3600
+    assert rate_limiter.get_rate_limit_status('test')['tokens'] == 2
+    assert rate_limiter.reserve_rate_limit_token('test') == 0
+
+
+def test_rate_limited_waits_for_its_token(clock, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(rate_limiter.time, 'sleep', sleeps.append)
+
+    @rate_limiter.rate_limited('test')
+    def call_api(value):
+        return value
+
+    assert [call_api(call) for call in range(3)] == [0, 1, 2]
+    assert sleeps == [pytest.approx(5)]
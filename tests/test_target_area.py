@@ -0,0 +1,56 @@
+import importlib
+import json
+
+import pytest
+
+
+@pytest.fixture
+def target_area(travel_time, monkeypatch):
+    monkeypatch.setattr(importlib.import_module('src.geocode_index'), 'resolve_address', lambda address: [-1.0, 52.0])
+
+    return importlib.import_module('src.target_area')
+
+
+def get_target_params(**params):
+    target_params = {
+        'target': 'Birmingham', 'walking': 30, 'cycling': 0, 'bus': 0, 'coach': 0, 'train': 0, 'driving': 0,
+        'deprivation': 0, 'income': 0, 'crime': 0, 'health': 0, 'education': 0, 'services': 0, 'environment': 0,
+        'fallbackradius': 0, 'maxradius': 0, 'minarea': 0, 'simplify': 0, 'buffer': 0,
+    }
+    target_params.update(params)
+
+    return target_params
+
+
+def get_result_bounds(target_areas_polygons_json):
+    return json.loads(target_areas_polygons_json)['result_intersection']['bounds']
+
+
+def test_revalidated_isochrones_are_searched_again(target_area, travel_time, traveltime_stub, monkeypatch):
+    targets_params = [get_target_params()]
+    first_bounds = get_result_bounds(target_area.get_target_areas_polygons_json(targets_params))
+    assert first_bounds == pytest.approx([-1.01, 51.99, -0.99, 52.01])
+
+    # The isochrone has changed by the time it's revalidated; the stale search is still served meanwhile
+    traveltime_stub.shape_size = 0.02
+    monkeypatch.setattr(travel_time, 'isochrone_revalidate_seconds', -1)
+    assert get_result_bounds(target_area.get_target_areas_polygons_json(targets_params)) == first_bounds
+    travel_time.isochrone_refresh_executor.shutdown(wait=True)
+
+    # Neither the memoized search nor its memoized isochrone stage hide the revalidated isochrone
+    monkeypatch.setattr(travel_time, 'isochrone_revalidate_seconds', 3600)
+    assert get_result_bounds(target_area.get_target_areas_polygons_json(targets_params)) == pytest.approx(
+        [-1.02, 51.98, -0.98, 52.02])
+    assert len(traveltime_stub.request_bodies) == 2
+
+
+def test_filters_ruling_out_everything_leave_no_result(target_area, monkeypatch):
+    monkeypatch.setattr(target_area, 'plan_min_rank_filters', lambda *args: ([], True))
+
+    target_results = target_area.get_target_area_polygons_for_params(get_target_params(maxradius=5, crime=10))
+
+    # Not the whole radius, which would look like everywhere within it had passed
+    assert target_results['radius']['polygon'] is not None
+    assert target_results['result_intersection']['polygon'] is None
+    assert json.loads(target_area.get_target_areas_polygons_json([get_target_params(maxradius=5, crime=10)]))[
+        'result_intersection'] is None
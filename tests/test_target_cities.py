@@ -0,0 +1,75 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.utils import InvalidRequestError
+
+population = {'category': 'Population', 'indicator': 'Population on the 1st of January, total'}
+
+
+@pytest.fixture
+def target_cities(run_server_caches, monkeypatch):
+    target_cities = importlib.import_module('src.target_cities')
+
+    # Five UK cities, one of them with no population, and a French city which a UK query should never see
+    cities_df = pd.DataFrame({
+        'CODE': ['UK001C1', 'UK002C1', 'UK003C1', 'UK004C1', 'UK005C1', 'FR001C1'],
+        'NAME': ['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echo', 'Foxtrot'],
+    })
+    population_matrix = pd.DataFrame(
+        {population['indicator']: [300000.0, 100000.0, np.nan, 500000.0, 200000.0, 900000.0]},
+        index=cities_df['CODE'])
+
+    monkeypatch.setattr(target_cities, 'get_eurostat_cities', lambda: cities_df)
+    monkeypatch.setattr(target_cities, 'get_eurostat_category_names', lambda: [population['category']])
+    monkeypatch.setattr(target_cities, 'get_category_indicator_matrix', lambda category_name: population_matrix)
+
+    return target_cities
+
+
+def query_city_names(target_cities, **params):
+    cities_query = target_cities.query_country_cities({'countryCodeInput': 'UK', 'sortBy': population, **params})
+
+    return list(cities_query['cities']['NAME']), cities_query
+
+
+def test_sorted_descending_by_default_with_missing_values_last(target_cities):
+    assert query_city_names(target_cities)[0] == ['Delta', 'Alpha', 'Echo', 'Bravo', 'Charlie']
+
+
+@pytest.mark.parametrize('sort_descending', [False, 'false', '0'])
+def test_sorted_ascending(target_cities, sort_descending):
+    city_names = query_city_names(target_cities, sortDescending=sort_descending)[0]
+
+    assert city_names == ['Bravo', 'Echo', 'Alpha', 'Delta', 'Charlie']
+
+
+def test_filtered_then_paginated(target_cities):
+    filters = [{**population, 'min': 150000}]
+    city_names, cities_query = query_city_names(target_cities, filters=filters, pageSize=2, page=2)
+
+    assert city_names == ['Echo']
+    assert (cities_query['total_cities'], cities_query['page'], cities_query['pages']) == (3, 2, 2)
+
+
+def test_page_past_the_end_is_empty(target_cities):
+    city_names, cities_query = query_city_names(target_cities, sortDescending='true', pageSize=2, page='9')
+
+    assert city_names == []
+    assert (cities_query['total_cities'], cities_query['page'], cities_query['pages']) == (5, 9, 3)
+
+
+@pytest.mark.parametrize('params, message', [
+    ({'countryCodeInput': 'united kingdom'}, 'Invalid country code'),
+    ({'countryCodeInput': 'UK', 'sortDescending': 'sideways'}, 'Invalid boolean for sortDescending'),
+    ({'countryCodeInput': 'UK', 'page': 'last'}, 'Invalid number for page'),
+    ({'countryCodeInput': 'UK', 'pageSize': '2.5'}, 'Invalid number for pageSize'),
+    ({'countryCodeInput': 'UK', 'filters': {'min': 1}}, 'Invalid filters'),
+    ({'countryCodeInput': 'UK', 'filters': [{**population, 'min': 'lots'}]}, 'Invalid number for filters\\[0\\].min'),
+    ({'countryCodeInput': 'UK', 'sortBy': {'category': 'Weather', 'indicator': 'Sunshine'}}, 'Unknown Eurostat'),
+])
+def test_invalid_params_are_bad_requests(target_cities, params, message):
+    with pytest.raises(InvalidRequestError, match=message):
+        target_cities.query_country_cities(params)
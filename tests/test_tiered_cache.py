@@ -0,0 +1,68 @@
+import pytest
+import shapely
+from shapely.geometry import Point
+
+from src.tiered_cache import TieredSqliteCache, estimate_value_size
+
+
+@pytest.fixture
+def cache(tmp_path):
+    # Room for four of the 1000 byte values below, so the fifth evicts the least recently used
+    return TieredSqliteCache(filename=str(tmp_path / 'cache.sqlite'), memory_size_bytes=4 * 1000 + 500)
+
+
+def get_value(label):
+    return label.ljust(1000 - estimate_value_size(''), '.')
+
+
+def test_least_recently_used_is_evicted_by_size(cache):
+    for key in ['a', 'b', 'c', 'd']:
+        cache.set(key, get_value(key))
+
+    # Using a makes b the least recently used, so that's the one evicted from memory
+    assert cache.get('a') == get_value('a')
+    cache.set('e', get_value('e'))
+
+    assert list(cache.memory_entries) == ['c', 'd', 'a', 'e']
+    assert cache.memory_stats['evictions'] == 1
+    assert cache.memory_stats['size_bytes'] == 4 * 1000
+
+    # It's still in SQLite though, and comes back into memory from there
+    assert cache.get('b') == get_value('b')
+    assert list(cache.memory_entries) == ['d', 'a', 'e', 'b']
+
+
+def test_values_too_large_for_memory_stay_in_sqlite(cache):
+    cache.set('large', 'x' * 1500)
+
+    assert 'large' not in cache.memory_entries
+    assert cache.get('large') == 'x' * 1500
+    assert 'large' not in cache.memory_entries
+
+
+def test_memory_hits_get_their_own_containers(cache):
+    cache.set('value', {'polygons': [1, 2]})
+    cache.get('value')['polygons'].append(3)
+
+    assert cache.get('value') == {'polygons': [1, 2]}
+    assert cache.memory_stats['hits'] == 2
+
+
+def test_delete_and_flush_clear_memory(cache):
+    cache.set_many({'a': 1, 'b': 2, 'c': 3})
+    cache.delete('a')
+    cache.delete_many(['b'])
+
+    assert cache.get_many(['a', 'b', 'c']) == {'c': 3}
+
+    cache.flush()
+    assert cache.get('c') is None
+    assert cache.memory_stats['size_bytes'] == 0
+
+
+def test_geometry_size_is_estimated_from_its_coordinates():
+    small_polygon = Point(0, 0).buffer(1, quad_segs=4)
+    large_polygon = Point(0, 0).buffer(1, quad_segs=64)
+
+    assert estimate_value_size(large_polygon) - estimate_value_size(small_polygon) == 16 * (
+        shapely.get_num_coordinates(large_polygon) - shapely.get_num_coordinates(small_polygon))
@@ -0,0 +1,105 @@
+import datetime
+import pytest
+
+
+def get_searches(count):
+    return [([-1.0 + search_index * 0.1, 52.0], 'public_transport', 30) for search_index in range(count)]
+
+
+def test_searches_are_batched_and_split_per_search(travel_time, traveltime_stub):
+    searches = get_searches(12)
+    isochrone_geometries = travel_time.get_public_transport_isochrone_geometries(searches)
+
+    # 12 searches fit in two requests of at most 10
+    assert [len(body['departure_searches']) for body in traveltime_stub.request_bodies] == [10, 2]
+
+    # Each search gets back its own shape, not another search's
+    assert len(isochrone_geometries) == 12
+    for target_lng_lat, mode, max_travel_time_mins in searches:
+        search_id = travel_time.get_isochrone_search_id(target_lng_lat, mode, max_travel_time_mins)
+        shell = isochrone_geometries[search_id][0]
+        assert shell[0] == pytest.approx([target_lng_lat[0] - 0.01, target_lng_lat[1] - 0.01])
+
+    # Asking again, in any combination, is answered entirely from the cache
+    travel_time.get_public_transport_isochrone_geometries(searches[5:] + searches[:2])
+    assert len(traveltime_stub.request_bodies) == 2
+
+
+def test_departure_is_the_next_time_in_the_slot(travel_time, traveltime_stub):
+    travel_time.get_public_transport_isochrone_geometries(get_searches(1))
+
+    departure_search = traveltime_stub.request_bodies[0]['departure_searches'][0]
+    departure = datetime.datetime.strptime(departure_search['departure_time'], '%Y-%m-%dT%H:%M:%S%z')
+    assert departure > datetime.datetime.now(datetime.timezone.utc)
+    assert departure.weekday() < 5 and (departure.hour, departure.minute) == (8, 0)
+    assert departure_search['travel_time'] == 30 * 60
+
+
+@pytest.mark.parametrize('now, expected_departure', [
+    # Saturday morning, too late for an 11:00 departure an hour from now, so it's next Saturday
+    (datetime.datetime(2026, 11, 7, 10, 30, tzinfo=datetime.timezone.utc), '2026-11-14T11:00:00+0000'),
+    (datetime.datetime(2026, 11, 7, 9, 0, tzinfo=datetime.timezone.utc), '2026-11-07T11:00:00+0000'),
+    (datetime.datetime(2026, 11, 4, 9, 0, tzinfo=datetime.timezone.utc), '2026-11-07T11:00:00+0000'),
+])
+def test_next_weekend_departure(travel_time, now, expected_departure):
+    assert travel_time.get_next_departure_time('weekend-peak', now) == expected_departure
+
+
+def test_next_weekday_departure_skips_the_weekend(travel_time):
+    friday_evening = datetime.datetime(2026, 11, 6, 18, 0, tzinfo=datetime.timezone.utc)
+    assert travel_time.get_next_departure_time('weekday-peak', friday_evening) == '2026-11-09T08:00:00+0000'
+
+
+def test_cache_is_keyed_on_the_slot_not_the_date(travel_time, traveltime_stub, monkeypatch):
+    searches = get_searches(2)
+    travel_time.get_public_transport_isochrone_geometries(searches)
+
+    # The next day's departure is a different date, but the HTTP cache still answers the same searches
+    travel_time.transient_cache.delete_many(
+        [travel_time.get_isochrone_cache_key(travel_time.get_isochrone_search_id(*search)) for search in searches])
+    monkeypatch.setattr(travel_time, 'get_next_departure_time', lambda slot_name: '2027-01-04T08:00:00+0000')
+    assert len(travel_time.get_public_transport_isochrone_geometries(searches)) == 2
+    assert len(traveltime_stub.request_bodies) == 1
+
+
+def test_unknown_departure_slot_falls_back_to_the_default(travel_time, monkeypatch, caplog):
+    monkeypatch.setenv('HOMEAREA_DEPARTURE_SLOT', 'rush-hour')
+
+    assert travel_time.get_configured_departure_slot() == 'weekday-peak'
+    assert 'weekday-peak, weekend-peak' in caplog.text
+
+
+def test_missing_search_result_is_an_error_and_not_cached(travel_time, traveltime_stub):
+    search = get_searches(1)[0]
+    traveltime_stub.omit_search_ids.add(travel_time.get_isochrone_search_id(*search))
+
+    with pytest.raises(Exception, match='no result for search'):
+        travel_time.get_public_transport_isochrone_geometry(*search)
+
+    # Once the API does answer it, the search succeeds rather than being stuck on the cached incomplete response
+    traveltime_stub.omit_search_ids.clear()
+    assert travel_time.get_public_transport_isochrone_geometry(*search)
+    assert len(traveltime_stub.request_bodies) == 2
+
+
+def test_missing_search_result_leaves_the_rest_of_the_batch(travel_time, traveltime_stub):
+    searches = get_searches(3)
+    traveltime_stub.omit_search_ids.add(travel_time.get_isochrone_search_id(*searches[1]))
+
+    isochrone_geometries = travel_time.get_public_transport_isochrone_geometries(searches)
+
+    assert sorted(isochrone_geometries) == sorted(
+        travel_time.get_isochrone_search_id(*search) for search in [searches[0], searches[2]])
+
+
+def test_stale_isochrones_are_served_then_refreshed(travel_time, traveltime_stub, monkeypatch):
+    searches = get_searches(3)
+    travel_time.get_public_transport_isochrone_geometries(searches)
+
+    # Everything cached is now considered stale, but is still returned straight away
+    monkeypatch.setattr(travel_time, 'isochrone_revalidate_seconds', -1)
+    assert len(travel_time.get_public_transport_isochrone_geometries(searches)) == 3
+
+    travel_time.isochrone_refresh_executor.shutdown(wait=True)
+    assert len(traveltime_stub.request_bodies) == 2
+    assert not travel_time.isochrone_refreshing_keys
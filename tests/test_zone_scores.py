@@ -0,0 +1,74 @@
+import importlib
+import json
+
+import numpy as np
+import pytest
+
+from src.utils import InvalidRequestError
+
+
+@pytest.fixture
+def zone_scores(run_server_caches):
+    return importlib.import_module('src.zone_scores')
+
+
+@pytest.fixture
+def zone_scores_calls(zone_scores, monkeypatch):
+    # The params get_zone_scores is called with, scoring no zones rather than reading the IMD dataset
+    calls = []
+
+    def get_zone_scores(**params):
+        calls.append(params)
+        return {'zones': np.array([], dtype=int), 'scores': np.array([]), 'min_score': params['min_score'], 'lod': 0,
+                'geometries': None}
+
+    monkeypatch.setattr(zone_scores, 'get_zone_scores', get_zone_scores)
+
+    return calls
+
+
+def get_zone_scores_params(zone_scores, zone_scores_calls, params):
+    assert json.loads(zone_scores.get_zone_scores_json(params))['passing_zones'] == 0
+
+    return zone_scores_calls[-1]
+
+
+def test_params_are_parsed(zone_scores, zone_scores_calls):
+    params = get_zone_scores_params(zone_scores, zone_scores_calls, {
+        'bounds': [-2, '52.3', -1.7, 52.6], 'weights': {'crime': '2', 'health': None}, 'minScore': '5.5',
+        'geometry': 'false', 'lod': 1
+    })
+
+    assert params['input_bounds'] == [-2.0, 52.3, -1.7, 52.6]
+    assert params['rank_weights'] == {'crime': 2.0, 'health': 0}
+    assert params['min_score'] == 5.5
+    assert params['include_geometry'] is False
+    assert params['lod'] == 1
+
+
+def test_defaults(zone_scores, zone_scores_calls):
+    params = get_zone_scores_params(zone_scores, zone_scores_calls, {'bounds': [-2, 52.3, -1.7, 52.6]})
+
+    assert params['rank_weights'] == {}
+    assert params['min_score'] == 0
+    assert params['include_geometry'] is True
+
+
+@pytest.mark.parametrize('params, message', [
+    ({}, 'Invalid bounds'),
+    ({'bounds': [-2, 52.3, -1.7]}, 'Invalid bounds'),
+    ({'bounds': 'everywhere'}, 'Invalid bounds'),
+    ({'bounds': [-2, 52.3, 'east', 52.6]}, 'Invalid number for bounds'),
+    ({'bounds': [-2, 52.3, 'nan', 52.6]}, 'Invalid number for bounds'),
+    ({'bounds': [-1.7, 52.3, -2, 52.6]}, 'minimums must be less'),
+    ({'bounds': [-2, 52.3, -1.7, 52.6], 'weights': [1, 2]}, 'Invalid weights'),
+    ({'bounds': [-2, 52.3, -1.7, 52.6], 'weights': {'crime': 'lots'}}, 'Invalid number for weights.crime'),
+    ({'bounds': [-2, 52.3, -1.7, 52.6], 'weights': {'weather': 1}}, 'Unknown rank type'),
+    ({'bounds': [-2, 52.3, -1.7, 52.6], 'minScore': 'high'}, 'Invalid number for minScore'),
+    ({'bounds': [-2, 52.3, -1.7, 52.6], 'geometry': 'no thanks'}, 'Invalid boolean for geometry'),
+])
+def test_invalid_params_are_bad_requests(zone_scores, zone_scores_calls, params, message):
+    with pytest.raises(InvalidRequestError, match=message):
+        zone_scores.get_zone_scores_json(params)
+
+    assert not zone_scores_calls